@@ -1,21 +1,37 @@
 ### Author: Edward Huang
 
+from fold_scheduler import get_num_jobs, run_folds
+import hashlib
+from neighbour_index import get_top_terms
 import numpy as np
-import operator
+import os
+from record_store import get_fold_lines
 import sys
+import tempfile
 import time
 
 ### This script rewrites the test files, except with query expansion performed
 ### on each query patient's list of symptoms. Query expansion is done by
 ### word embeddings.
-### Run time: 73 minutes.
+### Run time: 73 minutes with the tuple-keyed similarity dictionary. The
+### similarity scores are now a dense matrix indexed by code ids, cached in
+### binary form and memory-mapped on later runs.
+
+# Candidates need a similarity above this threshold to any query symptom.
+similarity_threshold = 0.9
+dictionary_fname = './data/herb_symptom_dictionary.txt'
+similarity_fname = './data/similarity_matrix.txt'
+# Binary cache of the similarity matrix, and the stamp of the text files it
+# was built from.
+similarity_cache_fname = './data/similarity_matrix.npy'
+similarity_stamp_fname = './data/similarity_matrix_stamp.txt'
 
 def get_similarity_code_list():
     '''
     Returns the mappings for the columns and rows in the similarity matrix.
     '''
-    similarity_code_list = []
-    f = open('./data/herb_symptom_dictionary.txt', 'r')
+    similarity_code_list, similarity_code_set = [], set([])
+    f = open(dictionary_fname, 'r')
     for i, line in enumerate(f):
         if i == 0:
             continue
@@ -28,32 +44,146 @@ def get_similarity_code_list():
             herb, symptom = line
         elif line_length == 5:
             herb, symptom, english_symptom, db_src, db_src_id = line
-        if herb not in similarity_code_list:
-            similarity_code_list += [herb]
-        if symptom not in similarity_code_list:
-            similarity_code_list += [symptom]
+        for code in (herb, symptom):
+            if code not in similarity_code_set:
+                similarity_code_list += [code]
+                similarity_code_set.add(code)
     f.close()
     return similarity_code_list
 
+def get_code_index(similarity_code_list):
+    '''
+    Returns the inverse of similarity_code_list.
+    Key: medical code -> str
+    Value: row and column of the code in the similarity matrix -> int
+    '''
+    return dict((code, i) for i, code in enumerate(similarity_code_list))
+
 def read_similarity_matrix(similarity_code_list):
     '''
-    Returns a dictionary of similarity scores.
-    Key: (code_a, code_b) -> tuple(str, str)
-    Value: cosine similarity -> float
+    Returns the absolute similarity scores as a dense symmetric float32
+    matrix. Row and column i belong to similarity_code_list[i]. Scores closer
+    than float32 precision (about 1e-7) tie, and are then ordered by position.
     '''
-    similarity_dct = {}
-    f = open('./data/similarity_matrix.txt', 'r')
-    for i, line in enumerate(f):
-        index_a, index_b, score = line.split()
-        # Map the indices to real medical codes.
-        code_a = similarity_code_list[int(index_a) - 1]
-        code_b = similarity_code_list[int(index_b) - 1]
-        if (code_b, code_a) in similarity_dct:
-            continue
-        score = abs(float(score))
-        similarity_dct[(code_a, code_b)] = score
+    index_a, index_b, score_list = np.loadtxt(similarity_fname, unpack=True)
+    # The file's indices start at 1.
+    index_a = index_a.astype(int) - 1
+    index_b = index_b.astype(int) - 1
+    num_codes = len(similarity_code_list)
+    # As with the old dictionary, only the first line of a pair counts.
+    pair_keys = np.minimum(index_a, index_b) * num_codes + np.maximum(index_a,
+        index_b)
+    first_lines = np.unique(pair_keys, return_index=True)[1]
+    index_a, index_b = index_a[first_lines], index_b[first_lines]
+    score_list = np.abs(score_list[first_lines])
+
+    similarity_matrix = np.zeros((num_codes, num_codes), dtype=np.float32)
+    similarity_matrix[index_a, index_b] = score_list
+    similarity_matrix[index_b, index_a] = score_list
+    return similarity_matrix
+
+def get_md5(fname):
+    '''
+    Returns the MD5 hex digest of a file, read in 1 MB blocks.
+    '''
+    md5 = hashlib.md5()
+    f = open(fname, 'rb')
+    for block in iter(lambda: f.read(1 << 20), ''):
+        md5.update(block)
     f.close()
-    return similarity_dct
+    return md5.hexdigest()
+
+def read_similarity_stamp():
+    '''
+    Returns the stamp written when the cache was last built.
+    Key: source file name -> str
+    Value: (size in bytes, modification time, MD5) -> (int, str, str)
+    '''
+    stamp_dct = {}
+    if not os.path.exists(similarity_stamp_fname):
+        return stamp_dct
+    f = open(similarity_stamp_fname, 'r')
+    for line in f:
+        fname, size, mtime, md5 = line.split()
+        stamp_dct[fname] = (int(size), mtime, md5)
+    f.close()
+    return stamp_dct
+
+def open_temp_file(fname):
+    '''
+    Returns (file, name) of a new temporary file in the directory of fname.
+    Its name is unique, so that runs on several folds at once do not write to
+    the same temporary file. It is renamed to fname when complete.
+    '''
+    fd, tmp_fname = tempfile.mkstemp(suffix=os.path.splitext(fname)[1],
+        dir=os.path.dirname(fname))
+    return os.fdopen(fd, 'wb'), tmp_fname
+
+def write_similarity_stamp(stamp_dct):
+    out, tmp_fname = open_temp_file(similarity_stamp_fname)
+    for fname in sorted(stamp_dct):
+        out.write('%s\t%d\t%s\t%s\n' % ((fname,) + stamp_dct[fname]))
+    out.close()
+    os.rename(tmp_fname, similarity_stamp_fname)
+
+def similarity_cache_is_fresh():
+    '''
+    Returns True if the binary cache was built from the current text files.
+    Unchanged sizes and modification times are trusted. A file that was only
+    touched is hashed, and the stamp is refreshed if its content is the same.
+    '''
+    if not os.path.exists(similarity_cache_fname):
+        return False
+    stamp_dct = read_similarity_stamp()
+    is_touched = False
+    for fname in (dictionary_fname, similarity_fname):
+        if fname not in stamp_dct:
+            return False
+        size, mtime, md5 = stamp_dct[fname]
+        stat = os.stat(fname)
+        if (stat.st_size, repr(stat.st_mtime)) == (size, mtime):
+            continue
+        if stat.st_size != size or get_md5(fname) != md5:
+            return False
+        stamp_dct[fname] = (size, repr(stat.st_mtime), md5)
+        is_touched = True
+    if is_touched:
+        write_similarity_stamp(stamp_dct)
+    return True
+
+def build_similarity_cache(similarity_code_list):
+    '''
+    Parses the text similarity matrix once and saves it as a .npy file.
+    '''
+    similarity_matrix = read_similarity_matrix(similarity_code_list)
+    # Write to a temporary file first, so an interrupted run never leaves a
+    # truncated cache behind.
+    out, tmp_fname = open_temp_file(similarity_cache_fname)
+    np.save(out, similarity_matrix)
+    out.close()
+    os.rename(tmp_fname, similarity_cache_fname)
+
+    stamp_dct = {}
+    for fname in (dictionary_fname, similarity_fname):
+        stat = os.stat(fname)
+        stamp_dct[fname] = (stat.st_size, repr(stat.st_mtime), get_md5(fname))
+    write_similarity_stamp(stamp_dct)
+
+def load_similarity_matrix(similarity_code_list):
+    '''
+    Returns the similarity matrix as a read-only memory map of the binary
+    cache, rebuilding the cache first if the text files changed.
+    '''
+    if not similarity_cache_is_fresh():
+        build_similarity_cache(similarity_code_list)
+    similarity_matrix = np.load(similarity_cache_fname, mmap_mode='r')
+    # Caches built before the matrix was float32 are rebuilt once.
+    if similarity_matrix.dtype != np.float32:
+        del similarity_matrix
+        build_similarity_cache(similarity_code_list)
+        similarity_matrix = np.load(similarity_cache_fname, mmap_mode='r')
+    assert similarity_matrix.shape == (len(similarity_code_list),) * 2
+    return similarity_matrix
 
 def get_count_dct(code_type, run_num):
     code_count_dct = {}
@@ -65,43 +195,40 @@ def get_count_dct(code_type, run_num):
     f.close()
     return code_count_dct
 
-def get_expansion_terms(symptom_list, similarity_dct, similarity_code_list,
-    training_code_list):
+def get_expansion_terms(symptom_list, similarity_matrix, similarity_code_list,
+    code_index, training_code_ids):
     '''
     Given a query list, find 10 terms that have the highest similarity scores
     to the symptoms in symptom_list.
     '''
-    candidate_term_dct = {}
-    for query_symptom in symptom_list:
-        # Skip a query if it isn't in the dictionary.
-        if query_symptom not in similarity_code_list:
-            continue
-        for training_code in training_code_list:
-            # Skip candidates that are already in the query.
-            if training_code in symptom_list:
-                continue
-            # Skip candidates that aren't in the dictionary.
-            if training_code not in similarity_code_list:
-                continue
-
-            if (query_symptom, training_code) in similarity_dct:
-                score = similarity_dct[(query_symptom, training_code)]
-            else:
-                score = similarity_dct[(training_code, query_symptom)]
-            # Keep only terms that have a score above a threshold.
-            if score > 0.9:
-                candidate_term_dct[training_code] = score
+    # Skip a query if it isn't in the dictionary.
+    query_ids = [code_index[symptom] for symptom in symptom_list if symptom in
+        code_index]
+    if len(query_ids) == 0:
+        return []
+    # Skip candidates that are already in the query.
+    candidate_ids = training_code_ids[np.in1d(training_code_ids, query_ids,
+        invert=True)]
+    # Row gather: query symptoms x candidate codes.
+    score_matrix = similarity_matrix[np.ix_(query_ids, candidate_ids)]
+    # Keep only terms that have a score above a threshold.
+    is_above = score_matrix > similarity_threshold
+    # Each candidate takes its score from the last query symptom above the
+    # threshold, the one that used to be written last into the dictionary.
+    last_rows = len(query_ids) - 1 - np.argmax(is_above[::-1], axis=0)
+    candidate_scores = score_matrix[last_rows, np.arange(len(candidate_ids))]
+    candidate_ids = candidate_ids[is_above.any(axis=0)]
+    candidate_scores = candidate_scores[is_above.any(axis=0)]
+
     # Get the top 10 terms.
-    expansion_terms = sorted(candidate_term_dct.items(),
-        key=operator.itemgetter(1), reverse=True)[:10]
-    # Extract just the terms from the sorted list.
-    expansion_terms = [term[0] for term in expansion_terms]
-    return expansion_terms
+    top_positions = get_top_terms(candidate_scores, 10)
+    return [similarity_code_list[i] for i in candidate_ids[top_positions]]
 
-def query_expansion(run_num, similarity_dct, similarity_code_list):
+def query_expansion(run_num, similarity_matrix, similarity_code_list):
     '''
     Runs the query expansion.
     '''
+    code_index = get_code_index(similarity_code_list)
     # The list of medical codes in the training set.
     if expansion_type == 'symptoms':
         training_code_list = get_count_dct('symptom', run_num).keys()[:]
@@ -110,31 +237,40 @@ def query_expansion(run_num, similarity_dct, similarity_code_list):
     else:
         training_code_list = get_count_dct('symptom',
             run_num).keys()[:] + get_count_dct('herb', run_num).keys()[:]
-        
+    # Skip candidates that aren't in the dictionary.
+    training_code_ids = np.array([code_index[code] for code in
+        training_code_list if code in code_index], dtype=int)
+
     # Process output filename.
     out_fname = './data/train_test/test_embedding_%s_expansion_%d.txt' % (
         expansion_type, run_num)
     print out_fname
 
     out = open(out_fname, 'w')
-    f = open('./data/train_test/test_no_expansion_%d.txt' % run_num, 'r')
-    for query in f:
+    for query in get_fold_lines(run_num, 'test'):
         # Split by tab, fifth element, split by comma, take out trailing comma.
         query = query.split('\t')
         symptom_list = query[4].split(':')[:-1]
 
-        expansion_terms = get_expansion_terms(symptom_list, similarity_dct,
-            similarity_code_list, training_code_list)
+        expansion_terms = get_expansion_terms(symptom_list, similarity_matrix,
+            similarity_code_list, code_index, training_code_ids)
 
         # Write expanded query to file
         expanded_query = query[:]
         expanded_query[4] += ':'.join(expansion_terms) + ':'
         
         out.write('\t'.join(expanded_query))
-    f.close()
     out.close()
 
+def expand_fold(run_num):
+    '''
+    Runs the query expansion of one fold on the similarity matrix loaded by
+    main. Reading the globals lets forked workers share the matrix.
+    '''
+    query_expansion(run_num, similarity_matrix, similarity_code_list)
+
 def main():
+    num_jobs = get_num_jobs()
     if len(sys.argv) != 2:
         print ('Usage: python %s herbs/symptoms/mixed' % sys.argv[0])
         exit()
@@ -144,11 +280,11 @@ def main():
     assert expansion_type in ['herbs', 'symptoms', 'mixed']
 
     # The keys will become the mappings for the similarity matrix.
+    global similarity_code_list, similarity_matrix
     similarity_code_list = get_similarity_code_list()
-    similarity_dct = read_similarity_matrix(similarity_code_list)
+    similarity_matrix = load_similarity_matrix(similarity_code_list)
 
-    for run_num in range(10):
-        query_expansion(run_num, similarity_dct, similarity_code_list)
+    run_folds(expand_fold, num_jobs)
 
 if __name__ == '__main__':
     start_time = time.time()
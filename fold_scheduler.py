@@ -0,0 +1,55 @@
+### Author: Edward Huang
+
+import multiprocessing
+import sys
+
+### Runs the ten cross-validation folds of a pipeline stage, either one at a
+### time or in a pool of worker processes. Workers are forked, so large
+### read-only inputs that are module globals when run_folds is called (e.g.,
+### the similarity matrix) are shared copy-on-write instead of being pickled.
+### Only the fold arguments and the return values are sent between processes.
+
+num_folds = 10
+
+def get_num_jobs():
+    '''
+    Reads the optional --jobs N argument, and removes it from sys.argv so that
+    the scripts' own argument checks are unchanged. Defaults to 1, which runs
+    the folds serially in the current process.
+    '''
+    num_jobs = 1
+    if '--jobs' in sys.argv:
+        i = sys.argv.index('--jobs')
+        assert i + 1 < len(sys.argv), 'Usage: --jobs N'
+        num_jobs = int(sys.argv[i + 1])
+        del sys.argv[i:i + 2]
+    assert num_jobs >= 1
+    return num_jobs
+
+def call_fold(task):
+    '''
+    Unpacks a (fold_function, run_num, fold_args...) task and runs it.
+    '''
+    fold_function, run_num, fold_args = task[0], task[1], task[2:]
+    return fold_function(run_num, *fold_args)
+
+def run_folds(fold_function, num_jobs, fold_args=()):
+    '''
+    Calls fold_function(run_num, *fold_args) for every fold. fold_function must
+    be a module-level function, and fold_args should be small, since both are
+    pickled for each worker. Returns the list of results in fold order, so
+    outputs assembled from them match the serial run.
+    '''
+    task_list = [(fold_function, run_num) + tuple(fold_args) for run_num in
+        range(num_folds)]
+    if num_jobs == 1:
+        return [call_fold(task) for task in task_list]
+
+    pool = multiprocessing.Pool(min(num_jobs, num_folds))
+    try:
+        # chunksize=1 hands out folds one at a time, since they are long jobs.
+        result_list = pool.map(call_fold, task_list, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return result_list
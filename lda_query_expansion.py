@@ -1,4 +1,7 @@
+from fold_scheduler import get_num_jobs, run_folds
 import numpy as np
+from record_store import get_fold_lines
+from scipy.sparse import csr_matrix
 import sys
 import time
 
@@ -6,6 +9,13 @@ import time
 ### on each query patient's list of symptoms.
 ### Run time: 5 minutes.
 
+# Number of top words to define a topic.
+n_top_words = 200
+# Number of queries rescored by a single matrix product.
+query_batch_size = 1000
+# Number of expansion terms added to each query.
+n_expansion_terms = 10
+
 def read_code_list(run_num):
     code_list = []
     f = open('./data/code_lists/code_list_%d.txt' % run_num, 'r')
@@ -27,49 +37,92 @@ def get_symptom_count_dct(run_num):
     f.close()
     return symptom_count_dct
 
-def get_scaled_topic(symptom_list, word_distr, code_list):
+def get_top_word_matrix(word_distr):
     '''
-    Given a symptom list (i.e., query), and the word distributions output by
-    some LDA run, we want to recompute the topic probabilities. For each topic,
-    we multiply the word probabilities of that topic by the number of query 
-    terms that appear in the top 100 words. Add together these topics
-    elementwise.
+    Returns a boolean topic x code matrix. Entry (i, j) is True if code j is
+    one of the n_top_words highest probability words of topic i. The top words
+    never change within a fold, so this is computed once per fold.
     '''
-    # Number of top words to define a topic.
-    n_top_words = 200
-    scaled_topic = np.zeros(len(code_list))
-
+    top_word_matrix = np.zeros(word_distr.shape, dtype=bool)
     for i, topic_dist in enumerate(word_distr):
-        topic_words = np.array(code_list)[np.argsort(topic_dist)][:-(
-            n_top_words + 1):-1]
-        # Number of query terms in the top n words.
-        num_shared_terms = len(set(topic_words).intersection(symptom_list))
-        scaled_topic += topic_dist * num_shared_terms
-
-    return scaled_topic
-
-def get_highest_prob_words(symptom_list, scaled_topic, code_list,
-    symptom_count_dct):
-    '''
-    Given the scaled topic, find the top words to add to the given query. Add
-    on twice as many expansion terms as there are symptoms.
-    '''
-    expansion_terms = []
-
-    highest_prob_words = np.array(code_list)[np.argsort(scaled_topic)]
-    for candidate in highest_prob_words:
-        # Decide whether to add a candidate based on expansion_type.
-        candidate_is_symptom = candidate in symptom_count_dct
-        if expansion_type == 'herbs' and candidate_is_symptom:
-            continue
-        elif expansion_type == 'symptoms' and not candidate_is_symptom:
-            continue
-        if candidate not in symptom_list:
-            expansion_terms += [candidate]
-        # We only add 10 expansion terms.
-        if len(expansion_terms) == 10:
-            break
-    return expansion_terms
+        # Same argsort as the old per-query loop, so ties at the cutoff
+        # resolve the same way.
+        top_word_matrix[i, np.argsort(topic_dist)[:-(n_top_words + 1):-1]] = True
+    return top_word_matrix
+
+def get_query_matrix(symptom_lists, code_list):
+    '''
+    Returns a binary query x code CSR matrix of the distinct query terms. Terms
+    that are not in code_list cannot be top words, so they are dropped.
+    '''
+    code_index = dict((code, i) for i, code in enumerate(code_list))
+    indptr, indices = [0], []
+    for symptom_list in symptom_lists:
+        indices += [code_index[symptom] for symptom in set(symptom_list) if
+            symptom in code_index]
+        indptr += [len(indices)]
+    return csr_matrix((np.ones(len(indices)), indices, indptr), shape=(len(
+        symptom_lists), len(code_list)))
+
+def get_scaled_topic_matrix(query_matrix, top_word_matrix, word_distr):
+    '''
+    Given a batch of queries encoded by get_query_matrix, and the word
+    distributions output by some LDA run, we want to recompute the topic
+    probabilities. For each topic, we multiply the word probabilities of that
+    topic by the number of query terms that appear in the top 200 words. Add
+    together these topics elementwise. Returns a query x code matrix, one
+    scaled topic per row.
+    '''
+    # Number of query terms in the top n words of each topic.
+    shared_term_counts = query_matrix * top_word_matrix.T.astype(float)
+    return shared_term_counts.dot(word_distr)
+
+def get_candidate_mask(code_list, symptom_count_dct):
+    '''
+    Returns a boolean vector over code_list that is True for the codes of the
+    type given by expansion_type. Computed once per fold.
+    '''
+    is_symptom = np.array([code in symptom_count_dct for code in code_list],
+        dtype=bool)
+    if expansion_type == 'herbs':
+        return ~is_symptom
+    elif expansion_type == 'symptoms':
+        return is_symptom
+    return np.ones(len(code_list), dtype=bool)
+
+def get_highest_prob_word_lists(query_matrix, scaled_topic_matrix, code_list,
+    candidate_mask):
+    '''
+    Given a batch of scaled topics, find the words to add to each query. Walks
+    the codes in np.argsort order of the scaled topic, skipping codes of the
+    wrong type and codes already in the query, and keeps the first
+    n_expansion_terms. Returns one list of expansion terms per query.
+    '''
+    # Rows are sorted by a single argsort call. np.argpartition would not keep
+    # the argsort order among the many codes with tied probabilities.
+    ranking_matrix = np.argsort(scaled_topic_matrix, axis=1)
+    return select_expansion_terms(query_matrix, ranking_matrix, code_list,
+        candidate_mask)
+
+def select_expansion_terms(query_matrix, ranking_matrix, code_list,
+    candidate_mask):
+    '''
+    Walks the codes of each query in the order of its row of ranking_matrix,
+    skipping codes of the wrong type and codes already in the query, and
+    keeps the first n_expansion_terms. Returns one list of expansion terms per
+    query.
+    '''
+    row_indices = np.arange(len(ranking_matrix))[:, None]
+    is_query_term = query_matrix.toarray().astype(bool)
+    is_candidate = candidate_mask[ranking_matrix] & ~is_query_term[row_indices,
+        ranking_matrix]
+    # Keep the first n_expansion_terms candidates of each row.
+    is_selected = is_candidate & (np.cumsum(is_candidate, axis=1) <=
+        n_expansion_terms)
+
+    code_array = np.array(code_list)
+    return [list(code_array[ranking[selected]]) for ranking, selected in zip(
+        ranking_matrix, is_selected)]
 
 def query_expansion(run_num):
     '''
@@ -80,32 +133,39 @@ def query_expansion(run_num):
     code_list = read_code_list(run_num)
     word_distr = np.loadtxt('./results/lda_word_distributions/lda_word_distrib'
         'ution_%d.txt' % run_num)
-    symptom_count_dct = get_symptom_count_dct(run_num)
-    
+    candidate_mask = get_candidate_mask(code_list, get_symptom_count_dct(
+        run_num))
+
+    # Split by tab, fifth element, split by comma, take out trailing comma.
+    query_list = [query.split('\t') for query in get_fold_lines(run_num,
+        'test')]
+    symptom_lists = [query[4].split(':')[:-1] for query in query_list]
+    top_word_matrix = get_top_word_matrix(word_distr)
+
     # Process filename.
     out_fname = './data/train_test/test_lda_%s_expansion_%d.txt' % (
         expansion_type, run_num)
 
     out = open(out_fname, 'w')
-    f = open('./data/train_test/test_no_expansion_%d.txt' % run_num, 'r')
-    for query in f:
-        # Split by tab, fifth element, split by comma, take out trailing comma.
-        query = query.split('\t')
-        symptom_list = query[4].split(':')[:-1]
-
-        scaled_topic = get_scaled_topic(symptom_list, word_distr, code_list)
-        expansion_terms = get_highest_prob_words(symptom_list, scaled_topic,
-            code_list, symptom_count_dct)
-
-        # Write expanded query to file
-        expanded_query = query[:]
-        expanded_query[4] += ':'.join(expansion_terms) + ':'
-        
-        out.write('\t'.join(expanded_query))
-    f.close()
+    for start in range(0, len(query_list), query_batch_size):
+        end = start + query_batch_size
+        # Rescore the topics and pick the terms of a whole batch of queries.
+        query_matrix = get_query_matrix(symptom_lists[start:end], code_list)
+        scaled_topic_matrix = get_scaled_topic_matrix(query_matrix,
+            top_word_matrix, word_distr)
+        expansion_term_lists = get_highest_prob_word_lists(query_matrix,
+            scaled_topic_matrix, code_list, candidate_mask)
+        for query, expansion_terms in zip(query_list[start:end],
+            expansion_term_lists):
+            # Write expanded query to file
+            expanded_query = query[:]
+            expanded_query[4] += ':'.join(expansion_terms) + ':'
+
+            out.write('\t'.join(expanded_query))
     out.close()
 
 def main():
+    num_jobs = get_num_jobs()
     if len(sys.argv) != 2:
         print ('Usage: python %s herbs/symptoms/mixed' % sys.argv[0])
         exit()
@@ -114,8 +174,7 @@ def main():
     expansion_type = sys.argv[1]
     assert expansion_type in ['herbs', 'symptoms', 'mixed']
 
-    for run_num in range(10):
-        query_expansion(run_num)
+    run_folds(query_expansion, num_jobs)
 
 if __name__ == '__main__':
     start_time = time.time()
@@ -3,15 +3,24 @@
 # For bug report, please contact author using the email address
 #################################################################
 
-import sys, random
+import sys, random, os
 import numpy as np
 import cPickle as pickle
 from collections import OrderedDict
 import argparse
-
-import theano
-import theano.tensor as T
-from theano import config
+import Queue
+from scipy import sparse
+from scipy.special import expit
+import threading
+
+try:
+    import theano
+    import theano.tensor as T
+    from theano import config
+except ImportError:
+    # The NumPy trainer runs without Theano, in Theano's default precision.
+    theano = None
+    config = argparse.Namespace(floatX='float64')
 
 def numpy_floatX(data):
     return np.asarray(data, dtype=config.floatX)
@@ -54,6 +63,16 @@ def init_tparams(params):
         tparams[k] = theano.shared(v, name=k)
     return tparams
 
+def get_window_masks(mask, windowSize):
+    # masks[w-1][i] is 1 if visits i to i+w are all of the same patient. Built
+    # by slicing, so it works on NumPy arrays and on Theano tensors alike
+    masks = []
+    for w in range(1, windowSize + 1):
+        maskW = mask[:-w]
+        for k in range(1, w + 1): maskW = maskW * mask[k:(k - w) or None]
+        masks.append(maskW[:,None])
+    return masks
+
 def build_model(tparams, options):
     x = T.matrix('x', dtype=config.floatX)
     d = T.matrix('d', dtype=config.floatX)
@@ -67,62 +86,20 @@ def build_model(tparams, options):
     visit = T.maximum(T.dot(emb, tparams['W_hidden']) + tparams['b_hidden'],0)
     results = T.nnet.softmax(T.dot(visit, tparams['W_output']) + tparams['b_output'])
     
-    mask1 = (mask[:-1] * mask[1:])[:,None]
-    mask2 = (mask[:-2] * mask[1:-1] * mask[2:])[:,None]
-    mask3 = (mask[:-3] * mask[1:-2] * mask[2:-1] * mask[3:])[:,None]
-    mask4 = (mask[:-4] * mask[1:-3] * mask[2:-2] * mask[3:-1] * mask[4:])[:,None]
-    mask5 = (mask[:-5] * mask[1:-4] * mask[2:-3] * mask[3:-2] * mask[4:-1] * mask[5:])[:,None]
-
     t = None
     if options['numYcodes'] > 0: t = y
     else: t = x
 
-    forward_results =  results[:-1] * mask1
-    forward_cross_entropy = -(t[1:] * T.log(forward_results + logEps) + (1. - t[1:]) * T.log(1. - forward_results + logEps))
-
-    forward_results2 =  results[:-2] * mask2
-    forward_cross_entropy2 = -(t[2:] * T.log(forward_results2 + logEps) + (1. - t[2:]) * T.log(1. - forward_results2 + logEps))
-
-    forward_results3 =  results[:-3] * mask3
-    forward_cross_entropy3 = -(t[3:] * T.log(forward_results3 + logEps) + (1. - t[3:]) * T.log(1. - forward_results3 + logEps))
-
-    forward_results4 =  results[:-4] * mask4
-    forward_cross_entropy4 = -(t[4:] * T.log(forward_results4 + logEps) + (1. - t[4:]) * T.log(1. - forward_results4 + logEps))
-
-    forward_results5 =  results[:-5] * mask5
-    forward_cross_entropy5 = -(t[5:] * T.log(forward_results5 + logEps) + (1. - t[5:]) * T.log(1. - forward_results5 + logEps))
+    # Only the terms of offsets 1 to windowSize are built into the graph
+    visit_cost = 0.
+    for w, maskW in enumerate(get_window_masks(mask, options['windowSize']), 1):
+        forward_results =  results[:-w] * maskW
+        forward_cross_entropy = -(t[w:] * T.log(forward_results + logEps) + (1. - t[w:]) * T.log(1. - forward_results + logEps))
 
-    backward_results =  results[1:] * mask1
-    backward_cross_entropy = -(t[:-1] * T.log(backward_results + logEps) + (1. - t[:-1]) * T.log(1. - backward_results + logEps))
+        backward_results =  results[w:] * maskW
+        backward_cross_entropy = -(t[:-w] * T.log(backward_results + logEps) + (1. - t[:-w]) * T.log(1. - backward_results + logEps))
 
-    backward_results2 =  results[2:] * mask2
-    backward_cross_entropy2 = -(t[:-2] * T.log(backward_results2 + logEps) + (1. - t[:-2]) * T.log(1. - backward_results2 + logEps))
-
-    backward_results3 =  results[3:] * mask3
-    backward_cross_entropy3 = -(t[:-3] * T.log(backward_results3 + logEps) + (1. - t[:-3]) * T.log(1. - backward_results3 + logEps))
-
-    backward_results4 =  results[4:] * mask4
-    backward_cross_entropy4 = -(t[:-4] * T.log(backward_results4 + logEps) + (1. - t[:-4]) * T.log(1. - backward_results4 + logEps))
-
-    backward_results5 =  results[5:] * mask5
-    backward_cross_entropy5 = -(t[:-5] * T.log(backward_results5 + logEps) + (1. - t[:-5]) * T.log(1. - backward_results5 + logEps))
-
-    visit_cost1 = (forward_cross_entropy.sum(axis=1).sum(axis=0) + backward_cross_entropy.sum(axis=1).sum(axis=0)) / (mask1.sum() + logEps)
-    visit_cost2 = (forward_cross_entropy2.sum(axis=1).sum(axis=0) + backward_cross_entropy2.sum(axis=1).sum(axis=0)) / (mask2.sum() + logEps)
-    visit_cost3 = (forward_cross_entropy3.sum(axis=1).sum(axis=0) + backward_cross_entropy3.sum(axis=1).sum(axis=0)) / (mask3.sum() + logEps)
-    visit_cost4 = (forward_cross_entropy4.sum(axis=1).sum(axis=0) + backward_cross_entropy4.sum(axis=1).sum(axis=0)) / (mask4.sum() + logEps)
-    visit_cost5 = (forward_cross_entropy5.sum(axis=1).sum(axis=0) + backward_cross_entropy5.sum(axis=1).sum(axis=0)) / (mask5.sum() + logEps)
-
-    windowSize = options['windowSize']
-    visit_cost = visit_cost1
-    if windowSize == 2:
-        visit_cost = visit_cost1 + visit_cost2
-    elif windowSize == 3:
-        visit_cost = visit_cost1 + visit_cost2 + visit_cost3
-    elif windowSize == 4:
-        visit_cost = visit_cost1 + visit_cost2 + visit_cost3 + visit_cost4
-    elif windowSize == 5:
-        visit_cost = visit_cost1 + visit_cost2 + visit_cost3 + visit_cost4 + visit_cost5
+        visit_cost += (forward_cross_entropy.sum(axis=1).sum(axis=0) + backward_cross_entropy.sum(axis=1).sum(axis=0)) / (maskW.sum() + logEps)
 
     iVector = T.vector('iVector', dtype='int32')
     jVector = T.vector('jVector', dtype='int32')
@@ -162,48 +139,348 @@ def adadelta(tparams, grads, x, mask, iVector, jVector, cost, options, d=None, y
 
     return f_grad_shared, f_update
 
+def exact_visit_cost(params, visit, t, mask, options):
+    # Visit cost of build_model, a softmax over all output codes. Returns the
+    # cost, its gradient for visit, and the gradients of the output layer
+    logEps = options['logEps']
+    logits = np.dot(visit, params['W_output']) + params['b_output']
+    results = np.exp(logits - logits.max(axis=1)[:,None])
+    results /= results.sum(axis=1)[:,None]
+
+    cost = 0.
+    dResults = np.zeros_like(results)
+    for w, maskW in enumerate(get_window_masks(mask, options['windowSize']), 1):
+        norm = maskW.sum() + logEps
+        # forward predicts visit i+w from visit i, backward visit i from i+w
+        for resultSlice, targetSlice in ((slice(None, -w), slice(w, None)), (slice(w, None), slice(None, -w))):
+            r = results[resultSlice] * maskW
+            # Every code adds its (1 - target) term, and the target codes swap
+            # it for their target term
+            target = t[targetSlice].tocoo()
+            rTarget = r[target.row, target.col]
+            cost += -(np.log(1. - r + logEps).sum() + (np.log(rTarget + logEps) - np.log(1. - rTarget + logEps)).sum()) / norm
+            dResultsW = dResults[resultSlice]
+            dResultsW += maskW / (1. - r + logEps) / norm
+            dResultsW[target.row, target.col] -= maskW[target.row, 0] * (1. / (rTarget + logEps) + 1. / (1. - rTarget + logEps)) / norm
+
+    dLogits = results * (dResults - (dResults * results).sum(axis=1)[:,None])
+    return cost, np.dot(dLogits, params['W_output'].T), np.dot(visit.T, dLogits), dLogits.sum(axis=0)
+
+def sampled_visit_cost(params, visit, t, mask, negatives, options):
+    # Negative sampling visit cost: a logistic loss of each target code against
+    # the negative codes shared by the batch. Only the output columns of the
+    # target and negative codes are computed
+    logEps = options['logEps']
+    t = t.tocsr()
+    columns = np.union1d(t.indices, negatives)
+    W_columns = params['W_output'][:, columns]
+    logits = np.dot(visit, W_columns) + params['b_output'][columns]
+    negColumns = np.searchsorted(columns, negatives)
+
+    cost = 0.
+    dLogits = np.zeros_like(logits)
+    for w, maskW in enumerate(get_window_masks(mask, options['windowSize']), 1):
+        norm = maskW.sum() + logEps
+        for resultSlice, targetSlice in ((slice(None, -w), slice(w, None)), (slice(w, None), slice(None, -w))):
+            target = t[targetSlice].tocoo()
+            targetColumns = np.searchsorted(columns, target.col)
+            logitsW, dLogitsW = logits[resultSlice], dLogits[resultSlice]
+            pos, maskPos = logitsW[target.row, targetColumns], maskW[target.row, 0]
+            neg = logitsW[:, negColumns]
+            cost += ((maskPos * np.logaddexp(0., -pos)).sum() + (maskW * np.logaddexp(0., neg)).sum()) / norm
+            dLogitsW[target.row, targetColumns] += maskPos * (expit(pos) - 1.) / norm
+            dLogitsW[:, negColumns] += maskW * expit(neg) / norm
+
+    dW_output = np.zeros_like(params['W_output'])
+    dW_output[:, columns] = np.dot(visit.T, dLogits)
+    db_output = np.zeros_like(params['b_output'])
+    db_output[columns] = dLogits.sum(axis=0)
+    return cost, np.dot(dLogits, W_columns.T), dW_output, db_output
+
+def exact_code_cost(preVec, iVector, jVector, logEps):
+    # Code cost of build_model, a softmax over all codes for each co-occurring
+    # pair (i, j). Only the rows of the codes that appear as i are computed.
+    # Returns the cost and its gradient for preVec
+    rows, rowIndex = np.unique(iVector, return_inverse=True)
+    scores = np.dot(preVec[rows], preVec.T)
+    probs = np.exp(scores - scores.max(axis=1)[:,None])
+    probs /= probs.sum(axis=1)[:,None]
+    q = probs[rowIndex, jVector]
+    cost = np.mean(-np.log(q + logEps))
+    # Gradient of the pair costs with respect to the scores of their rows
+    a = -q / (q + logEps) / len(iVector)
+    dScores = -np.bincount(rowIndex, weights=a, minlength=len(rows))[:,None] * probs
+    np.add.at(dScores, (rowIndex, jVector), a)
+    dPreVec = np.dot(dScores.T, preVec[rows])
+    dPreVec[rows] += np.dot(dScores, preVec)
+    return cost, dPreVec
+
+def get_pair_scores(preVec, iVector, jVector, blockSize=100000):
+    # preVec[i] . preVec[j] for each pair, a block of pairs at a time
+    return np.concatenate([np.zeros(0)] + [(preVec[iVector[start:start+blockSize]] * preVec[jVector[start:start+blockSize]]).sum(axis=1) for start in range(0, len(iVector), blockSize)])
+
+def sampled_code_cost(preVec, iVector, jVector, negatives):
+    # Negative sampling code cost: a logistic loss of each pair (i, j) against
+    # (i, n) for the negative codes n shared by the batch. Costs O(pairs * d)
+    # instead of O(rows * V * d)
+    numCodes = len(preVec)
+    pairs, pairCounts = np.unique(iVector * numCodes + jVector, return_counts=True)
+    pairI, pairJ = pairs // numCodes, pairs % numCodes
+    pos = get_pair_scores(preVec, pairI, pairJ)
+    rows, rowCounts = np.unique(iVector, return_counts=True)
+    neg = np.dot(preVec[rows], preVec[negatives].T)
+    cost = ((pairCounts * np.logaddexp(0., -pos)).sum() + (rowCounts[:,None] * np.logaddexp(0., neg)).sum()) / len(iVector)
+
+    dPos = sparse.csr_matrix((pairCounts * (expit(pos) - 1.) / len(iVector), (pairI, pairJ)), shape=(numCodes, numCodes))
+    dNeg = rowCounts[:,None] * expit(neg) / len(iVector)
+    dPreVec = dPos.dot(preVec) + dPos.T.dot(preVec)
+    dPreVec[rows] += np.dot(dNeg, preVec[negatives])
+    dPreVec[negatives] += np.dot(dNeg.T, preVec[rows])
+    return cost, dPreVec
+
+def numpy_cost_grads(params, x, d, y, mask, iVector, jVector, options, negatives=None):
+    # Same cost as build_model, and its gradient with respect to each parameter.
+    # x and y are sparse, so the embedding lookup only reads the rows of the
+    # codes in the batch. Given negatives, the (visit, code) negative codes of
+    # the batch, both costs use negative sampling instead
+    demoSize = options['demoSize']
+
+    embPre = x.dot(params['W_emb']) + params['b_emb']
+    emb = np.maximum(embPre, 0)
+    if demoSize > 0: emb = np.concatenate((emb, d), axis=1)
+    visitPre = np.dot(emb, params['W_hidden']) + params['b_hidden']
+    visit = np.maximum(visitPre, 0)
+
+    t = x
+    if options['numYcodes'] > 0: t = y
+
+    grads = OrderedDict()
+    if negatives is None: cost, dVisit, grads['W_output'], grads['b_output'] = exact_visit_cost(params, visit, t, mask, options)
+    else: cost, dVisit, grads['W_output'], grads['b_output'] = sampled_visit_cost(params, visit, t, mask, negatives[0], options)
+    dVisitPre = dVisit * (visitPre > 0)
+    grads['W_hidden'] = np.dot(emb.T, dVisitPre)
+    grads['b_hidden'] = dVisitPre.sum(axis=0)
+    dEmbPre = np.dot(dVisitPre, params['W_hidden'].T)[:, :options['embDimSize']] * (embPre > 0)
+    grads['W_emb'] = x.T.dot(dEmbPre)
+    grads['b_emb'] = dEmbPre.sum(axis=0)
+
+    preVec = np.maximum(params['W_emb'], 0)
+    iVector, jVector = np.asarray(iVector, dtype=int), np.asarray(jVector, dtype=int)
+    if len(iVector) > 0:
+        if negatives is None: codeCost, dPreVec = exact_code_cost(preVec, iVector, jVector, options['logEps'])
+        else: codeCost, dPreVec = sampled_code_cost(preVec, iVector, jVector, negatives[1])
+        cost += codeCost
+        grads['W_emb'] += dPreVec * (params['W_emb'] > 0)
+
+    cost += options['L2_reg'] * (params['W_emb'] ** 2).sum()
+    grads['W_emb'] += 2. * options['L2_reg'] * params['W_emb']
+    return cost, grads
+
+def get_noise_cdf(seqs, numCodes):
+    # Cumulative unigram^0.75 distribution of the codes, as in word2vec
+    if isinstance(seqs, SequenceFile):
+        # Counted a chunk at a time, without the delimiters
+        counts = np.zeros(numCodes, dtype=int)
+        for start in range(0, len(seqs.codes), 1 << 20):
+            codes = np.array(seqs.codes[start:start + (1 << 20)])
+            counts += np.bincount(codes[codes >= 0], minlength=numCodes)
+    else:
+        codes = np.array([code for seq in seqs if seq[0] != -1 for code in seq], dtype=int)
+        counts = np.bincount(codes, minlength=numCodes)
+    weights = counts ** 0.75
+    return np.cumsum(weights) / weights.sum()
+
+def sample_negatives(noiseCdf, numSamples, randomState):
+    # numSamples distinct negative codes drawn from the noise distribution with
+    # randomState. Repeated draws are redrawn, so the count is only smaller
+    # when fewer codes have a nonzero noise probability
+    numSamples = min(numSamples, np.count_nonzero(np.diff(np.concatenate(([0.], noiseCdf)))))
+    negatives = np.zeros(0, dtype=int)
+    while len(negatives) < numSamples:
+        draws = np.minimum(np.searchsorted(noiseCdf, randomState.rand(numSamples - len(negatives)), side='right'), len(noiseCdf) - 1)
+        negatives = np.union1d(negatives, draws)
+    return negatives
+
+def numpy_adadelta(params, grads, running_up2, running_grads2):
+    # Same update as adadelta, in place
+    for k in params:
+        running_grads2[k] = 0.95 * running_grads2[k] + 0.05 * (grads[k] ** 2)
+        updir = -np.sqrt(running_up2[k] + 1e-6) / np.sqrt(running_grads2[k] + 1e-6) * grads[k]
+        running_up2[k] = 0.95 * running_up2[k] + 0.05 * (updir ** 2)
+        params[k] += updir
+
+def get_batch(seqs, demos, labels, index, options, randomState=None):
+    batchSize = options['batchSize']
+    batchX = seqs[batchSize*index:batchSize*(index+1)]
+    batchD, batchY, y = None, [], None
+    if options['numYcodes'] > 0: batchY = labels[batchSize*index:batchSize*(index+1)]
+    if options['demoSize'] > 0: batchD = demos[batchSize*index:batchSize*(index+1)]
+    if options['numYcodes'] > 0: x, y, mask, iVector, jVector = padSparse(batchX, batchY, options)
+    else: x, mask, iVector, jVector = padSparse(batchX, batchY, options)
+    negatives = None
+    if options['lossMode'] == 'negative':
+        negatives = (sample_negatives(options['visitNoiseCdf'], options['numNegSamples'], randomState), sample_negatives(options['codeNoiseCdf'], options['numNegSamples'], randomState))
+    return x, batchD, y, mask, iVector, jVector, negatives
+
+def prefetchBatches(seqs, demos, labels, batchOrder, options, randomState=None):
+    # Yields the batches in batchOrder. A background thread assembles up to
+    # options['prefetch'] batches ahead, while the trainer works on the last one.
+    # Negatives are drawn from randomState, in batchOrder, by whichever thread
+    # assembles the batches. Nothing else uses randomState
+    if options['prefetch'] == 0:
+        for index in batchOrder: yield get_batch(seqs, demos, labels, index, options, randomState)
+        return
+    batchQueue = Queue.Queue(maxsize=options['prefetch'])
+    def worker():
+        try:
+            for index in batchOrder: batchQueue.put((True, get_batch(seqs, demos, labels, index, options, randomState)))
+        except Exception:
+            batchQueue.put((False, sys.exc_info()))
+    thread = threading.Thread(target=worker)
+    thread.daemon = True
+    thread.start()
+    for i in range(len(batchOrder)):
+        ok, batch = batchQueue.get()
+        if not ok: raise batch[0], batch[1], batch[2]
+        yield batch
+    thread.join()
+
+def train_med2vec_numpy(seqs,
+                demos=[],
+                labels=[],
+                outFile='',
+                L2_reg=0.001,
+                numXcodes=20000,
+                numYcodes=0,
+                embDimSize=200,
+                hiddenDimSize=200,
+                batchSize=1000,
+                demoSize=0,
+                logEps=1e-8,
+                windowSize=1,
+                verbose=False,
+                maxEpochs=10,
+                checkpointInterval=0,
+                prefetch=2,
+                lossMode='exact',
+                numNegSamples=50):
+    # Trains on sequences in memory, or a memory-mapped SequenceFile, with NumPy
+    # instead of Theano. Batches are visited in a random order every epoch, so
+    # a SequenceFile is only read a batch at a time.
+    # Parameters are saved to outFile every checkpointInterval epochs (0 never),
+    # and returned after the last epoch. A background thread assembles up to
+    # prefetch batches ahead (0 assembles them in the training loop). lossMode
+    # 'negative' replaces both softmax costs by negative sampling, against
+    # numNegSamples distinct codes drawn for each batch.
+    options = locals().copy()
+    del options['seqs'], options['demos'], options['labels']
+    if lossMode == 'negative':
+        options['codeNoiseCdf'] = get_noise_cdf(seqs, numXcodes)
+        options['visitNoiseCdf'] = options['codeNoiseCdf']
+        if numYcodes > 0: options['visitNoiseCdf'] = get_noise_cdf(labels, numYcodes)
+    print 'initializing parameters'
+    params = init_params(options)
+    running_up2 = OrderedDict((k, np.zeros_like(v)) for k, v in params.iteritems())
+    running_grads2 = OrderedDict((k, np.zeros_like(v)) for k, v in params.iteritems())
+    n_batches = int(np.ceil(float(len(seqs)) / float(batchSize)))
+    # Seeded from the global generator here, so that a run seeded with
+    # np.random.seed draws the same negatives, whatever the thread timing
+    negRandomState = None
+    if lossMode == 'negative': negRandomState = np.random.RandomState(np.random.randint(1 << 30))
+
+    print 'training start'
+    for epoch in xrange(maxEpochs):
+        iteration = 0
+        costVector = []
+        for x, d, y, mask, iVector, jVector, negatives in prefetchBatches(seqs, demos, labels, random.sample(range(n_batches), n_batches), options, negRandomState):
+            cost, grads = numpy_cost_grads(params, x, d, y, mask, iVector, jVector, options, negatives)
+            costVector.append(cost)
+            numpy_adadelta(params, grads, running_up2, running_grads2)
+            if (iteration % 10 == 0) and verbose: print 'epoch:%d, iteration:%d/%d, cost:%f' % (epoch, iteration, n_batches, cost)
+            iteration += 1
+        print 'epoch:%d, mean_cost:%f' % (epoch, np.mean(costVector))
+        if checkpointInterval > 0 and (epoch + 1) % checkpointInterval == 0:
+            np.savez_compressed(outFile + '.' + str(epoch), **params)
+    return params
+
+class SequenceFile(object):
+    # Visit lists stored in the binary sequence format, memory-mapped. The
+    # codes of all visits are one int32 array, prefix.codes.npy, and visit v is
+    # codes[visitPtr[v]:visitPtr[v+1]], with the int64 offsets in
+    # prefix.visit_ptr.npy. As in the pickled format, patients are separated by
+    # a delimiter visit [-1]. Slicing reads only the visits in the slice, so a
+    # batch is loaded when it is used
+    def __init__(self, prefix):
+        self.codes = np.load(prefix + '.codes.npy', mmap_mode='r')
+        self.visitPtr = np.load(prefix + '.visit_ptr.npy', mmap_mode='r')
+
+    def __len__(self):
+        return len(self.visitPtr) - 1
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice): return self[index:(index + 1) or None][0]
+        start, stop, step = index.indices(len(self))
+        assert step == 1
+        if stop <= start: return []
+        ptr = np.array(self.visitPtr[start:stop + 1])
+        codes = np.array(self.codes[ptr[0]:ptr[-1]])
+        return np.split(codes, ptr[1:-1] - ptr[0])
+
+def is_sequence_file(fname):
+    return os.path.exists(fname + '.codes.npy')
+
 def load_data(xFile, dFile, yFile):
-    seqX = np.array(pickle.load(open(xFile, 'rb')))
+    # Visit and label files are either pickled, or binary sequence files given
+    # by their prefix
+    if is_sequence_file(xFile): seqX = SequenceFile(xFile)
+    else: seqX = np.array(pickle.load(open(xFile, 'rb')))
     seqD = []
     if len(dFile) > 0: seqD = np.asarray(pickle.load(open(dFile, 'rb')), dtype=config.floatX)
     seqY = []
-    if len(yFile) > 0: seqY = np.array(pickle.load(open(yFile, 'rb')))
+    if len(yFile) > 0 and is_sequence_file(yFile): seqY = SequenceFile(yFile)
+    elif len(yFile) > 0: seqY = np.array(pickle.load(open(yFile, 'rb')))
     return seqX, seqD, seqY
 
-def pickTwo(codes, iVector, jVector):
-    for first in codes:
-        for second in codes:
-            if first == second: continue
-            iVector.append(first)
-            jVector.append(second)
-    
-def padMatrix(seqs, labels, options):
-    n_samples = len(seqs)
-    iVector = []
-    jVector = []
-    numXcodes = options['numXcodes']
-    numYcodes = options['numYcodes']
-
-    if numYcodes > 0:
-        x = np.zeros((n_samples, numXcodes)).astype(config.floatX)
-        y = np.zeros((n_samples, numYcodes)).astype(config.floatX)
-        mask = np.zeros((n_samples,)).astype(config.floatX)
-        for idx, (seq, label) in enumerate(zip(seqs, labels)):
-            if not seq[0] == -1:
-                x[idx][seq] = 1.
-                y[idx][label] = 1.
-                pickTwo(seq, iVector, jVector)
-                mask[idx] = 1.
+def pickTwo(codes, codePtr):
+    # Every ordered pair of different codes within each visit, where visit v
+    # is codes[codePtr[v]:codePtr[v+1]], in the order of a nested loop
+    lengths = np.diff(codePtr)
+    pairCounts = lengths ** 2
+    pairVisits = np.repeat(np.arange(len(lengths)), pairCounts)
+    pairIndex = np.arange(pairCounts.sum()) - np.repeat(np.cumsum(pairCounts) - pairCounts, pairCounts)
+    first = codes[codePtr[pairVisits] + pairIndex // lengths[pairVisits]]
+    second = codes[codePtr[pairVisits] + pairIndex % lengths[pairVisits]]
+    keep = first != second
+    return first[keep].astype('int32'), second[keep].astype('int32')
+
+def multiHot(seqs, mask, numCodes):
+    # Multi-hot CSR rows of the code lists, empty where the mask is 0.
+    # Returns the matrix, and the code indices and row offsets with duplicates
+    lengths = np.array([len(seq) for seq in seqs], dtype=int) * (mask > 0)
+    codePtr = np.concatenate(([0], np.cumsum(lengths)))
+    codes = np.concatenate([np.zeros(0, dtype=int)] + [np.asarray(seq, dtype=int) for seq, length in zip(seqs, lengths) if length > 0])
+    matrix = sparse.csr_matrix((np.ones(len(codes), dtype=config.floatX), codes, codePtr), shape=(len(seqs), numCodes))
+    matrix.sum_duplicates()
+    matrix.data[:] = 1.
+    return matrix, codes, codePtr
+
+def padSparse(seqs, labels, options):
+    # Same as padMatrix, except that x and y are sparse
+    mask = np.array([0. if seq[0] == -1 else 1. for seq in seqs], dtype=config.floatX)
+    x, codes, codePtr = multiHot(seqs, mask, options['numXcodes'])
+    iVector, jVector = pickTwo(codes, codePtr)
+    if options['numYcodes'] > 0:
+        y = multiHot(labels, mask, options['numYcodes'])[0]
         return x, y, mask, iVector, jVector
+    return x, mask, iVector, jVector
+
+def padMatrix(seqs, labels, options):
+    if options['numYcodes'] > 0:
+        x, y, mask, iVector, jVector = padSparse(seqs, labels, options)
+        return x.toarray(), y.toarray(), mask, iVector, jVector
     else:
-        x = np.zeros((n_samples, numXcodes)).astype(config.floatX)
-        mask = np.zeros((n_samples,)).astype(config.floatX)
-        for idx, seq in enumerate(seqs):
-            if not seq[0] == -1:
-                x[idx][seq] = 1.
-                pickTwo(seq, iVector, jVector)
-                mask[idx] = 1.
-        return x, mask, iVector, jVector
+        x, mask, iVector, jVector = padSparse(seqs, labels, options)
+        return x.toarray(), mask, iVector, jVector
 
 def train_med2vec(seqFile='seqFile.txt', 
                 demoFile='demoFile.txt',
@@ -220,7 +497,8 @@ def train_med2vec(seqFile='seqFile.txt',
                 logEps=1e-8,
                 windowSize=1,
                 verbose=False,
-                maxEpochs=1000):
+                maxEpochs=1000,
+                checkpointInterval=1):
 
     options = locals().copy()
     print 'initializing parameters'
@@ -281,11 +559,12 @@ def train_med2vec(seqFile='seqFile.txt',
             if (iteration % 10 == 0) and verbose: print 'epoch:%d, iteration:%d/%d, cost:%f' % (epoch, iteration, n_batches, cost)
             iteration += 1
         print 'epoch:%d, mean_cost:%f' % (epoch, np.mean(costVector))
-        tempParams = unzip(tparams)
-        np.savez_compressed(outFile + '.' + str(epoch), **tempParams)
+        if checkpointInterval > 0 and (epoch + 1) % checkpointInterval == 0:
+            tempParams = unzip(tparams)
+            np.savez_compressed(outFile + '.' + str(epoch), **tempParams)
 
 def parse_arguments(parser):
-    parser.add_argument('seq_file', type=str, metavar='<visit_file>', help='The path to the Pickled file containing visit information of patients')
+    parser.add_argument('seq_file', type=str, metavar='<visit_file>', help='The path to the Pickled file containing visit information of patients, or the prefix of a binary sequence file')
     parser.add_argument('n_input_codes', type=int, metavar='<n_input_codes>', help='The number of unique input medical codes')
     parser.add_argument('out_file', type=str, metavar='<out_file>', help='The path to the output models. The models will be saved after every epoch')
     parser.add_argument('--label_file', type=str, default='', help='The path to the Pickled file containing grouped visit information of patients. If you are not using a grouped output, do not use this option')
@@ -297,9 +576,13 @@ def parse_arguments(parser):
     parser.add_argument('--batch_size', type=int, default=1000, help='The size of a single mini-batch (default value: 1000)')
     parser.add_argument('--n_epoch', type=int, default=10, help='The number of training epochs (default value: 10)')
     parser.add_argument('--L2_reg', type=float, default=0.001, help='L2 regularization for the code representation matrix W_c (default value: 0.001)')
-    parser.add_argument('--window_size', type=int, default=1, choices=[1,2,3,4,5], help='The size of the visit context window (range: 1,2,3,4,5), (default value: 1)')
+    parser.add_argument('--window_size', type=int, default=1, help='The size of the visit context window (at least 1), (default value: 1)')
     parser.add_argument('--log_eps', type=float, default=1e-8, help='A small value to prevent log(0) (default value: 1e-8)')
     parser.add_argument('--verbose', action='store_true', help='Print output after every 10 mini-batches')
+    parser.add_argument('--checkpoint_interval', type=int, default=1, help='The number of epochs between saved models, 0 for none (default value: 1)')
+    parser.add_argument('--backend', type=str, default='theano', choices=['theano', 'numpy'], help='Train with Theano, or with NumPy on the CPU without Theano (default value: theano)')
+    parser.add_argument('--loss', type=str, default='exact', choices=['exact', 'negative'], help='The softmax costs, or negative sampling for the visit and code costs. negative needs --backend numpy (default value: exact)')
+    parser.add_argument('--n_neg_samples', type=int, default=50, help='The number of negative codes drawn for each mini-batch with --loss negative (default value: 50)')
     args = parser.parse_args()
     return args
 
@@ -307,4 +590,10 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     args = parse_arguments(parser)
 
-    train_med2vec(seqFile=args.seq_file, demoFile=args.demo_file, labelFile=args.label_file, outFile=args.out_file, numXcodes=args.n_input_codes, numYcodes=args.n_output_codes, embDimSize=args.cr_size, hiddenDimSize=args.vr_size, batchSize=args.batch_size, maxEpochs=args.n_epoch, L2_reg=args.L2_reg, demoSize=args.demo_size, windowSize=args.window_size, logEps=args.log_eps, verbose=args.verbose)
\ No newline at end of file
+    if args.backend == 'numpy':
+        seqs, demos, labels = load_data(args.seq_file, args.demo_file, args.label_file)
+        train_med2vec_numpy(seqs, demos=demos, labels=labels, outFile=args.out_file, numXcodes=args.n_input_codes, numYcodes=args.n_output_codes, embDimSize=args.cr_size, hiddenDimSize=args.vr_size, batchSize=args.batch_size, maxEpochs=args.n_epoch, L2_reg=args.L2_reg, demoSize=args.demo_size, windowSize=args.window_size, logEps=args.log_eps, verbose=args.verbose, checkpointInterval=args.checkpoint_interval, lossMode=args.loss, numNegSamples=args.n_neg_samples)
+        sys.exit()
+    assert args.loss == 'exact', 'Negative sampling needs --backend numpy'
+
+    train_med2vec(seqFile=args.seq_file, demoFile=args.demo_file, labelFile=args.label_file, outFile=args.out_file, numXcodes=args.n_input_codes, numYcodes=args.n_output_codes, embDimSize=args.cr_size, hiddenDimSize=args.vr_size, batchSize=args.batch_size, maxEpochs=args.n_epoch, L2_reg=args.L2_reg, demoSize=args.demo_size, windowSize=args.window_size, logEps=args.log_eps, verbose=args.verbose, checkpointInterval=args.checkpoint_interval)
\ No newline at end of file
@@ -1,20 +1,38 @@
 ### Author: Edward Huang
 
+from fold_scheduler import get_num_jobs, run_folds
+from med2vec import SequenceFile, train_med2vec_numpy
 from monolingual_lda_baseline import get_patient_dct
+from neighbour_index import (build_index, get_neighbour_lists, normalize_rows,
+    save_index)
 import numpy as np
-import operator
 import os
-import cPickle
-from scipy.spatial.distance import pdist, squareform
-import subprocess
+import random
+from record_store import (convert_raw_file, get_fold_code_records,
+    get_fold_lines, get_fold_records)
 import sys
 import time
 
 ### Rewrites the query test files by adding on the most similar medical codes
-### to the symptom section. Query expansion is done by med2vec.
+### to the symptom section. Query expansion is done by med2vec, trained in
+### process by the NumPy trainer of med2vec.py, so Theano is not needed.
 ### Run time:
+### Benchmark of the time per epoch and the expansion quality of the exact and
+### negative sampling losses, on a fold:
+###     python med2vec_query_expansion.py benchmark run_num n_epochs
 
 n_iterations = 100
+# Epochs between saved med2vec parameters, 0 for none. The expansion uses the
+# final embeddings in memory, so by default only the last epoch is saved.
+checkpoint_interval = n_iterations
+# 'exact' trains with the softmax costs of med2vec. 'negative' uses negative
+# sampling, which does not grow with the square of the number of codes.
+loss_mode = 'exact'
+# Number of queries whose neighbours are found with one matrix product.
+query_batch_size = 1000
+# 'exact' scores every candidate code. 'ivf' is approximate, and only scores
+# the candidates in the k-means clusters closest to the query.
+neighbour_backend = 'exact'
 
 def generate_directories():
     data_dir = './data/med2vec/'
@@ -29,44 +47,67 @@ def read_code_list(run_num):
     f.close()
     return code_list
 
-def create_med2vec_input(run_num, pickle_fname):
+def get_seq_prefix(run_num):
+    return './data/med2vec/train_%s' % run_num
+
+def create_med2vec_input(run_num):
     '''
-    Generates the pickle lists for running with med2vec. Writes it out to
-    file. Returns the codes for this training set.
+    Writes the visits of this training set as a binary sequence file, read by
+    med2vec.SequenceFile. The codes of the visits, as ids in the code list,
+    are appended to one int32 array, and the offset where each visit ends to
+    an int64 array. A visit [-1] is the delimiter between patients. Returns
+    the codes for this training set.
     '''
-    test_fname = './data/train_test/train_no_expansion_%s.txt' % run_num
-    patient_dct, disease_set = get_patient_dct(test_fname)
+    record_list, store_code_list = get_fold_code_records(run_num, 'train')
+    patient_dct, disease_set = get_patient_dct(record_list)
     code_list = read_code_list(run_num)
-    # Make the pickle list.
-    pickle_list = []
+    # Index in code_list of each code id of the record store.
+    store_index = dict((code, i) for i, code in enumerate(store_code_list))
+    code_index = np.zeros(len(store_code_list), dtype=np.int32)
+    code_index[[store_index[code] for code in code_list]] = np.arange(len(
+        code_list))
+    seq_prefix = get_seq_prefix(run_num)
+    codes_out = open(seq_prefix + '.codes.bin', 'wb')
+    ptr_out = open(seq_prefix + '.visit_ptr.bin', 'wb')
+    np.zeros(1, dtype=np.int64).tofile(ptr_out)
+    num_codes, is_first_patient = 0, True
     for key in patient_dct:
         visit_dct = patient_dct[key]
         if len(visit_dct) == 1:
             continue
+        # Each visit is all symptoms and herbs, preceded by the delimiter
+        # unless this is the first patient.
+        visit_list = [] if is_first_patient else [np.array([-1])]
         for date in sorted(visit_dct.keys()):
             disease_list, symptom_list, herb_list = visit_dct[date]
-            # Convert each symptom/herb to their index in the code list.
-            symptom_list = [code_list.index(symp) for symp in symptom_list]
-            herb_list = [code_list.index(herb) for herb in herb_list]
-            # pickle_list is where each visit is all symptoms and herbs.
-            pickle_list += [symptom_list + herb_list]
-        # A [-1] is the delimiter between patients.
-        pickle_list += [[-1]]
-    # Remove the trailing delimiter.
-    pickle_list = pickle_list[:-1]
-    with open(pickle_fname, 'wb') as out:
-        cPickle.dump(pickle_list, out)   
+            visit_list += [code_index[np.concatenate((symptom_list,
+                herb_list))]]
+        is_first_patient = False
+        np.concatenate(visit_list).astype(np.int32).tofile(codes_out)
+        visit_ptr = num_codes + np.cumsum([len(visit) for visit in visit_list])
+        visit_ptr.astype(np.int64).tofile(ptr_out)
+        num_codes = visit_ptr[-1]
+    codes_out.close()
+    ptr_out.close()
+    convert_raw_file(seq_prefix + '.codes.bin', seq_prefix + '.codes.npy',
+        np.int32)
+    convert_raw_file(seq_prefix + '.visit_ptr.bin', seq_prefix +
+        '.visit_ptr.npy', np.int64)
     return code_list
 
-def run_med2vec(run_num, num_codes, pickle_fname):
+def run_med2vec(run_num, num_codes, seq_list, n_epochs=n_iterations,
+    loss=None):
     '''
-    Calls the external med2vec.py script.
+    Trains med2vec on the visit lists, with the defaults of the med2vec.py
+    script. Returns the code embeddings of the last epoch.
     '''
+    if loss is None:
+        loss = loss_mode
     emb_fname = './data/med2vec/embeddings_%s' % run_num
-    command = 'python med2vec.py %s --n_epoch %d %d %s' % (pickle_fname,
-        n_iterations, num_codes, emb_fname)
-    subprocess.call(command, shell=True)
-    return emb_fname
+    params = train_med2vec_numpy(seq_list, outFile=emb_fname,
+        numXcodes=num_codes, maxEpochs=n_epochs,
+        checkpointInterval=checkpoint_interval, lossMode=loss)
+    return params['W_emb']
 
 def get_count_dct(code_type, run_num):
     code_count_dct = {}
@@ -78,58 +119,43 @@ def get_count_dct(code_type, run_num):
     f.close()
     return code_count_dct
 
-def get_similarity_dct(emb_fname, code_list):
-    data = np.load('%s.%d.npz' % (emb_fname, n_iterations - 1))
-    embedding_matrix = data['W_emb']
-    # Compute pairwise cosine similarity.
-    similarity_matrix = squareform(pdist(embedding_matrix, 'cosine'))
-    assert len(similarity_matrix) == len(embedding_matrix)
-    similarity_dct = {}
-    for row_i, row in enumerate(similarity_matrix):
-        row_code = code_list[row_i]
-        for col_i in range(row_i + 1, len(row)):
-            col_code = code_list[col_i]
-            similarity_dct[(row_code, col_code)] = 1 - row[col_i]
-    return similarity_dct
-
-def get_expansion_terms(symptom_list, similarity_dct, code_list,
-    training_code_list):
+def get_expansion_term_lists(symptom_lists, neighbour_index, code_list,
+    code_index, training_code_ids):
     '''
-    Given a query list, find 10 terms that have the highest similarity scores
-    to the symptoms in symptom_list.
+    Given a batch of query lists, find for each query the 10 training codes
+    with the highest similarity scores to the symptoms in its symptom list.
     '''
-    candidate_term_dct = {}
-    for query_symptom in symptom_list:
+    # The old dictionary loop let each query symptom overwrite the scores of
+    # the one before it, so candidates are ranked by their similarity to the
+    # last query symptom in the code list.
+    query_id_lists, last_ids, excluded_id_lists = [], [], []
+    for symptom_list in symptom_lists:
         # Skip a query if it isn't in the dictionary.
-        if query_symptom not in code_list:
-            continue
-        for training_code in training_code_list:
+        query_ids = [code_index[symptom] for symptom in symptom_list if symptom
+            in code_index]
+        query_id_lists += [query_ids]
+        if len(query_ids) > 0:
+            last_ids += [query_ids[-1]]
             # Skip candidates that are already in the query.
-            if training_code in symptom_list:
-                continue
-            # Skip candidates that aren't in the dictionary.
-            if training_code not in code_list:
-                continue
-
-            if (query_symptom, training_code) in similarity_dct:
-                score = similarity_dct[(query_symptom, training_code)]
-            else:
-                score = similarity_dct[(training_code, query_symptom)]
-            # Don't threshold, since med2vec embeddings are not that close.
-            candidate_term_dct[training_code] = score
-    # Get the top 10 terms.
-    expansion_terms = sorted(candidate_term_dct.items(),
-        key=operator.itemgetter(1), reverse=True)[:10]
-    # Extract just the terms from the sorted list.
-    expansion_terms = [term[0] for term in expansion_terms]
-    return expansion_terms
-
-def query_expansion(run_num, emb_fname, code_list, expansion_type):
+            excluded_id_lists += [query_ids]
+
+    # Don't threshold, since med2vec embeddings are not that close.
+    neighbour_lists = iter(get_neighbour_lists(neighbour_index, last_ids,
+        excluded_id_lists, training_code_ids, 10))
+
+    expansion_term_lists = []
+    for query_ids in query_id_lists:
+        if len(query_ids) == 0:
+            expansion_term_lists += [[]]
+            continue
+        expansion_term_lists += [[code_list[i] for i in next(neighbour_lists)]]
+    return expansion_term_lists
+
+def get_training_code_ids(run_num, code_index, expansion_type):
     '''
-    Gets the top 10 most similar codes to each query's symptom set, based on
-    the embeddings computed by med2vec.
+    Returns the ids of the training codes of the expansion type, which are the
+    expansion candidates.
     '''
-    similarity_dct = get_similarity_dct(emb_fname, code_list)
     # The list of medical codes in the training set.
     if expansion_type == 'symptoms':
         training_code_list = get_count_dct('symptom', run_num).keys()
@@ -138,41 +164,111 @@ def query_expansion(run_num, emb_fname, code_list, expansion_type):
     else:
         training_code_list = get_count_dct('symptom', run_num
             ).keys() + get_count_dct('herb', run_num).keys()
+    # Skip candidates that aren't in the dictionary.
+    return np.array([code_index[code] for code in training_code_list if code
+        in code_index], dtype=int)
+
+def query_expansion(run_num, neighbour_index, code_list, expansion_type):
+    '''
+    Gets the top 10 most similar codes to each query's symptom set, based on
+    the neighbour index over the embeddings computed by med2vec.
+    '''
+    code_index = dict((code, i) for i, code in enumerate(code_list))
+    training_code_ids = get_training_code_ids(run_num, code_index,
+        expansion_type)
+
+    # Split by tab, fifth element, split by comma, take out trailing comma.
+    query_list = [query.split('\t') for query in get_fold_lines(run_num,
+        'test')]
+    symptom_lists = [query[4].split(':')[:-1] for query in query_list]
 
     # Process output filename.
     out_fname = './data/train_test/test_med2vec_%s_expansion_%d.txt' % (
         expansion_type, run_num)
 
     out = open(out_fname, 'w')
-    f = open('./data/train_test/test_no_expansion_%d.txt' % run_num, 'r')
-    for query in f:
-        # Split by tab, fifth element, split by comma, take out trailing comma.
-        query = query.split('\t')
-        symptom_list = query[4].split(':')[:-1]
-
-        expansion_terms = get_expansion_terms(symptom_list, similarity_dct,
-            code_list, training_code_list)
-
-        # Write expanded query to file
-        expanded_query = query[:]
-        expanded_query[4] += ':'.join(expansion_terms) + ':'
-        
-        out.write('\t'.join(expanded_query))
-    f.close()
+    for start in range(0, len(query_list), query_batch_size):
+        end = start + query_batch_size
+        expansion_term_lists = get_expansion_term_lists(symptom_lists[
+            start:end], neighbour_index, code_list, code_index,
+            training_code_ids)
+        for query, expansion_terms in zip(query_list[start:end],
+            expansion_term_lists):
+            # Write expanded query to file
+            expanded_query = query[:]
+            expanded_query[4] += ':'.join(expansion_terms) + ':'
+
+            out.write('\t'.join(expanded_query))
     out.close()
 
+def run_fold(run_num):
+    '''
+    Trains med2vec on one training set and expands its test queries.
+    '''
+    code_list = create_med2vec_input(run_num)
+    seq_list = SequenceFile(get_seq_prefix(run_num))
+    emb_matrix = run_med2vec(run_num, len(code_list), seq_list)
+
+    # Build the neighbour index once per fold, and keep it on disk. Normalized
+    # embeddings make dot products cosine similarities, and memory stays
+    # O(V * d), since the V x V similarity matrix is never built.
+    neighbour_index = build_index(normalize_rows(emb_matrix),
+        neighbour_backend)
+    save_index(neighbour_index, './data/med2vec/neighbour_index_%s.npz' %
+        run_num)
+    query_expansion(run_num, neighbour_index, code_list, 'herbs')
+    query_expansion(run_num, neighbour_index, code_list, 'symptoms')
+    query_expansion(run_num, neighbour_index, code_list, 'mixed')
+
+def benchmark_loss(run_num, n_epochs):
+    '''
+    Trains a fold with each loss from the same initial parameters. Prints the
+    time per epoch, and the precision of the herb expansions of the test
+    queries, i.e., the fraction of expansion terms that were prescribed in the
+    query visit. Also prints the overlap of each loss's expansions with the
+    exact loss's.
+    '''
+    code_list = create_med2vec_input(run_num)
+    seq_list = SequenceFile(get_seq_prefix(run_num))
+    code_index = dict((code, i) for i, code in enumerate(code_list))
+    training_code_ids = get_training_code_ids(run_num, code_index, 'herbs')
+    record_list = get_fold_records(run_num, 'test')
+    symptom_lists = [record[4] for record in record_list]
+    herb_sets = [set(record[5]) for record in record_list]
+
+    print 'loss\tsec/epoch\tprecision@10\toverlap'
+    exact_term_lists = None
+    for loss in ['exact', 'negative']:
+        np.random.seed(run_num)
+        random.seed(run_num)
+        start_time = time.time()
+        emb_matrix = run_med2vec(run_num, len(code_list), seq_list, n_epochs,
+            loss)
+        seconds = (time.time() - start_time) / n_epochs
+        neighbour_index = build_index(normalize_rows(emb_matrix), 'exact')
+        term_lists = []
+        for start in range(0, len(symptom_lists), query_batch_size):
+            term_lists += get_expansion_term_lists(symptom_lists[start:start +
+                query_batch_size], neighbour_index, code_list, code_index,
+                training_code_ids)
+        if exact_term_lists is None:
+            exact_term_lists = term_lists
+        num_terms = max(sum(len(terms) for terms in term_lists), 1)
+        precision = sum(len(herb_set.intersection(terms)) for herb_set, terms
+            in zip(herb_sets, term_lists)) / float(num_terms)
+        overlap = sum(len(set(terms).intersection(exact_terms)) for terms,
+            exact_terms in zip(term_lists, exact_term_lists)) / float(num_terms)
+        print '%s\t%f\t%f\t%f' % (loss, seconds, precision, overlap)
+
 def main():
+    if len(sys.argv) == 4 and sys.argv[1] == 'benchmark':
+        generate_directories()
+        benchmark_loss(int(sys.argv[2]), int(sys.argv[3]))
+        return
+    num_jobs = get_num_jobs()
     generate_directories()
 
-    for run_num in range(10):
-        pickle_fname = './data/med2vec/train_%s.pickle' % run_num
-        code_list = create_med2vec_input(run_num, pickle_fname)
-        emb_fname = run_med2vec(run_num, len(code_list), pickle_fname)
-        
-        emb_fname = './data/med2vec/embeddings_%s' % run_num
-        query_expansion(run_num, emb_fname, code_list, 'herbs')
-        query_expansion(run_num, emb_fname, code_list, 'symptoms')
-        query_expansion(run_num, emb_fname, code_list, 'mixed')
+    run_folds(run_fold, num_jobs)
 
 if __name__ == '__main__':
     start_time = time.time()
@@ -2,18 +2,32 @@
 # -*- coding: utf-8 -*-
 
 import datetime
+from fold_scheduler import get_num_jobs, run_folds
 import numpy as np
 import os
 import lda
+from online_lda import train_fold
+from parallel_lda import (fit_tokens, get_csr_matrix, get_num_threads,
+    read_token_arrays)
+from record_store import get_fold_code_records
 import time
 
 ### This script runs regular LDA on a patient record training set (90% of the
 ### original data). Writes out the herb counts, symptom counts, code list (for
 ### mapping symptoms/herbs to integers), and the word distributions for each
 ### topic. The number of topics will match the number of unique diseases.
-### Run time for 5000 iterations: 3.5 hours.
+### Run time for 5000 iterations: 3.5 hours with the lda package. It keeps no
+### checkpoint, so a killed run trains its unfinished folds from the start.
+### The other values of lda_trainer are described in the README.
 
 date_format = '%Y-%m-%d'
+# 'lda', 'ad_lda' or 'online'. Only 'ad_lda' resumes a killed fold and can
+# stop early. The lda package cannot continue a fit, so the 'lda' trainer runs
+# all n_iter iterations of a fold at once.
+lda_trainer = 'lda'
+n_iter = 5000
+# Sampler state of the 'ad_lda' trainer. A restarted fold resumes from it.
+checkpoint_fname = './data/lda_checkpoints/ad_lda_%s.npz'
 
 def generate_folders():
     '''
@@ -32,31 +46,30 @@ def generate_folders():
     if not os.path.exists(lda_res_dir):
         os.makedirs(lda_res_dir)
 
-def get_patient_dct(filename):
+def get_patient_dct(record_list):
     '''
+    Takes records as (disease ids, name, dob, visit date, symptom ids, herb
+    ids), as returned by record_store.get_fold_code_records.
     Returns dictionary
     Key: (name, date of birth) -> (str, str)
     Value: dictionary, where keys are (name, DOB) pairs and values are tuples
-    containing the diseases, diagnosis dates, symptoms, and herbs of each visit.
+    containing the disease, symptom and herb ids of each visit, keyed by
+    diagnosis date.
     '''
     # Keep track of the unique set of diseases so we know n_topics.
     patient_dct, disease_set = {}, set([])
 
-    f = open(filename, 'r')
-    for i, line in enumerate(f):
-        diseases, name, dob, visit_date, symptoms, herbs = line.split('\t')
-        # Always ends with a colon, so the last element of the split will be
-        # the empty string.
-        disease_list = diseases.split(':')[:-1]
-        disease_set = disease_set.union(disease_list)
+    for disease_list, name, dob, visit_date, symptom_list, herb_list in (
+        record_list):
+        disease_set.update(disease_list.tolist())
 
         visit_date = visit_date.split('，')[1][:len('xxxx-xx-xx')]
         # Format the diagnosis date.
         visit_date = datetime.datetime.strptime(visit_date, date_format)
 
-        # Format symptom and herb lists and remove duplicates.
-        symptom_list = list(set(symptoms.split(':')[:-1]))
-        herb_list = list(set(herbs.split(':')[:-1]))
+        # Remove duplicate symptoms and herbs.
+        symptom_list = np.unique(symptom_list)
+        herb_list = np.unique(herb_list)
 
         # Name, date of birth pair uniquely identifies a patient.
         key = (name, dob)
@@ -66,48 +79,39 @@ def get_patient_dct(filename):
         # If multiple visits in one day, add on a second to the visit.
         while visit_date in patient_dct[key]:
             visit_date += datetime.timedelta(0,1)
-        # list(set()) removes duplicates.
         patient_dct[key][visit_date] = (disease_list, symptom_list, herb_list)
-    f.close()
 
     return patient_dct, disease_set
 
-def get_symptom_and_herb_counts(patient_dct, run_num):
+def get_visit_arrays(patient_dct, field):
     '''
-    Given the patient dictionary, count the symptom and herb occurrences in
-    patients with more than one visit. Writes the counts out to file.
-    Returns the list of unique medical codes.
+    Returns the ids of one field of every visit, concatenated. Field 1 is the
+    symptoms and field 2 the herbs.
     '''
-    herb_count_dct, symptom_count_dct = {}, {}
-    for key in patient_dct:
-        visit_dct = patient_dct[key]
-        for date in visit_dct:
-            disease_list, symptom_list, herb_list = visit_dct[date]
+    return np.concatenate([np.zeros(0, dtype=np.int32)] + [visit[field] for
+        visit_dct in patient_dct.itervalues() for visit in
+        visit_dct.itervalues()])
+
+def write_count_dct(code_counts, code_list, fname):
+    out = open(fname, 'w')
+    for code_id in np.nonzero(code_counts)[0]:
+        out.write('%s\t%d\n' % (code_list[code_id], code_counts[code_id]))
+    out.close()
 
-            # Update the counts of each symptom and herb.
-            for symptom in symptom_list:
-                if symptom not in symptom_count_dct:
-                    symptom_count_dct[symptom] = 0
-                symptom_count_dct[symptom] += 1
-            for herb in herb_list:
-                if herb not in herb_count_dct:
-                    herb_count_dct[herb] = 0
-                herb_count_dct[herb] += 1
-
-    # Write out the unique symptoms and herbs to file.
-    herb_out = open('./data/count_dictionaries/herb_count_dct_%s.txt' %
-        run_num, 'w')
-    for herb in herb_count_dct:
-        herb_out.write('%s\t%d\n' % (herb, herb_count_dct[herb]))
-    herb_out.close()
-
-    symptom_out = open('./data/count_dictionaries/symptom_count_dct_%s.txt' %
-        run_num, 'w')
-    for symptom in symptom_count_dct:
-        symptom_out.write('%s\t%d\n' % (symptom, symptom_count_dct[symptom]))
-    symptom_out.close()
-
-    return list(set(symptom_count_dct.keys()).union(herb_count_dct.keys()))
+def get_symptom_and_herb_counts(patient_dct, code_list, run_num):
+    '''
+    Given the patient dictionary, count the symptom and herb occurrences in
+    patients with more than one visit. Writes the counts out to file, with
+    the codes decoded from code_list, the record store's vocabulary.
+    Returns the sorted ids of the unique medical codes.
+    '''
+    symptom_ids = get_visit_arrays(patient_dct, 1)
+    herb_ids = get_visit_arrays(patient_dct, 2)
+    write_count_dct(np.bincount(herb_ids), code_list,
+        './data/count_dictionaries/herb_count_dct_%s.txt' % run_num)
+    write_count_dct(np.bincount(symptom_ids), code_list,
+        './data/count_dictionaries/symptom_count_dct_%s.txt' % run_num)
+    return np.union1d(symptom_ids, herb_ids)
 
 def write_code_list(code_list, run_num):
     '''
@@ -118,46 +122,83 @@ def write_code_list(code_list, run_num):
         out.write('%s\n' % code)
     out.close()
 
-def get_matrix_from_dct(patient_dct, code_list):
+def get_visit_code_ids(patient_dct, code_ids):
     '''
-    Convert the patient dictionary to a document-term matrix.
+    Yields the sorted column ids of the codes of each patient visit, one visit
+    at a time, in the row order of the document-term matrix. Column j is the
+    code whose id is code_ids[j].
     '''
-    patient_matrix = []
+    column_map = np.zeros(code_ids.max() + 1 if len(code_ids) > 0 else 0,
+        dtype=np.int32)
+    column_map[code_ids] = np.arange(len(code_ids))
     for key in patient_dct:
         visit_dct = patient_dct[key]
         for date in sorted(visit_dct.keys()):
             disease_list, symptom_list, herb_list = visit_dct[date]
-            curr_code_list = symptom_list + herb_list
-            # Create binary vectors for each patient visit.
-            curr_row = [1 if c in curr_code_list else 0 for c in code_list]
-            patient_matrix += [curr_row]
-    return np.array(patient_matrix)
-
-def run_baseline_lda(patient_matrix, code_list, disease_set):
-    model = lda.LDA(n_topics=len(disease_set), n_iter=5000, random_state=1)
-    model.fit(patient_matrix)
+            # Each visit's codes are binary, so a code is counted once.
+            yield np.unique(column_map[np.concatenate((symptom_list,
+                herb_list))]).tolist()
+
+def get_patient_tokens(patient_dct, code_ids):
+    '''
+    Returns the token arrays (doc_ptr, word_ids) of the patient visits.
+    '''
+    return read_token_arrays(get_visit_code_ids(patient_dct, code_ids))
+
+def get_matrix_from_dct(patient_dct, code_ids):
+    '''
+    Convert the patient dictionary to a sparse binary document-term matrix.
+    '''
+    doc_ptr, word_ids = get_patient_tokens(patient_dct, code_ids)
+    return get_csr_matrix(doc_ptr, word_ids, len(code_ids))
+
+def run_baseline_lda(doc_ptr, word_ids, code_list, disease_set, run_num,
+    num_threads=1):
+    if lda_trainer == 'ad_lda':
+        topic_word, perplexity = fit_tokens(doc_ptr, word_ids, len(code_list),
+            len(disease_set), n_iter, random_state=1, n_threads=num_threads,
+            checkpoint_fname=checkpoint_fname % run_num)
+        print 'Training perplexity: %f' % perplexity
+        return topic_word
+    model = lda.LDA(n_topics=len(disease_set), n_iter=n_iter, random_state=1)
+    # The lda package accepts the sparse matrix without densifying it.
+    model.fit(get_csr_matrix(doc_ptr, word_ids, len(code_list)))
     topic_word = model.topic_word_
     return topic_word
 
+def run_fold(run_num, num_threads=1):
+    '''
+    Trains LDA on one training set and writes out its results.
+    '''
+    # Fetch the training patient record dictionary.
+    record_list, store_code_list = get_fold_code_records(run_num, 'train')
+    patient_dct, disease_set = get_patient_dct(record_list)
+
+    # code_list is the vocabulary list.
+    code_ids = get_symptom_and_herb_counts(patient_dct, store_code_list,
+        run_num)
+    code_list = [store_code_list[i] for i in code_ids]
+    write_code_list(code_list, run_num)
+
+    # Convert the patient dictionary to token arrays for LDA.
+    doc_ptr, word_ids = get_patient_tokens(patient_dct, code_ids)
+
+    # Run LDA.
+    if lda_trainer == 'online':
+        topic_word = train_fold(doc_ptr, word_ids, code_list, len(
+            disease_set), run_num)
+    else:
+        topic_word = run_baseline_lda(doc_ptr, word_ids, code_list,
+            disease_set, run_num, num_threads)
+    np.savetxt('./results/lda_word_distributions/lda_word_distribution_%s'
+        '.txt' % run_num, topic_word)
+
 def main():
+    num_jobs = get_num_jobs()
+    num_threads = get_num_threads()
     generate_folders()
 
-    for run_num in range(10):
-        # Fetch the training patient record dictionary.
-        patient_fname = './data/train_test/train_no_expansion_%s.txt' % run_num
-        patient_dct, disease_set = get_patient_dct(patient_fname)
-
-        # code_list is the vocabulary list.
-        code_list = get_symptom_and_herb_counts(patient_dct, run_num)
-        write_code_list(code_list, run_num)
-
-        # Convert the patient dictionary to a matrix for LDA.
-        patient_matrix = get_matrix_from_dct(patient_dct, code_list)
-
-        # Run LDA.
-        topic_word = run_baseline_lda(patient_matrix, code_list, disease_set)
-        np.savetxt('./results/lda_word_distributions/lda_word_distribution_%s'
-            '.txt' % run_num, topic_word)
+    run_folds(run_fold, num_jobs, (num_threads,))
 
 if __name__ == '__main__':
     start_time = time.time()
@@ -0,0 +1,213 @@
+### Author: Edward Huang
+
+import numpy as np
+import sys
+import time
+
+### Nearest-neighbour search over L2-normalized code embeddings, restricted to
+### a set of candidate codes. The 'exact' backend scores every candidate. The
+### 'ivf' backend clusters the codes with spherical k-means, and only scores
+### the candidates in the clusters closest to the query, so query time stays
+### roughly constant as the vocabulary grows.
+### Running this script prints recall@k of 'ivf' against 'exact' on a saved
+### med2vec embedding file:
+###     python neighbour_index.py ./data/med2vec/embeddings_0.99.npz
+
+# Number of k-means clusters is cluster_factor * sqrt(number of codes).
+cluster_factor = 1.0
+num_kmeans_iterations = 10
+# Number of clusters scored per query by the 'ivf' backend.
+num_probes = 8
+# Rows assigned to clusters by a single matrix product.
+block_size = 10000
+# Query by candidate scores computed by a single matrix product of the
+# 'exact' backend.
+score_block_size = 1 << 22
+
+def normalize_rows(embedding_matrix):
+    '''
+    Returns the embeddings scaled to unit length, so that dot products are
+    cosine similarities. Zero rows stay zero, and score 0 against every code.
+    '''
+    norms = np.sqrt((embedding_matrix ** 2).sum(axis=1))
+    # Guards against 0 / 0 for zero rows, e.g., the centroid of a cluster
+    # whose members cancel out.
+    norms = np.maximum(norms, np.finfo(embedding_matrix.dtype).tiny)
+    return embedding_matrix / norms[:, None]
+
+def get_top_terms(score_list, k):
+    '''
+    Returns the positions of the k highest scores, ordered by decreasing score.
+    Ties are broken by position.
+    '''
+    k = min(k, len(score_list))
+    if k == 0:
+        return np.array([], dtype=int)
+    threshold = -np.partition(-score_list, k - 1)[k - 1]
+    # Keep every score tied with the k-th one before breaking ties.
+    top_positions = np.nonzero(score_list >= threshold)[0]
+    order = np.lexsort((top_positions, -score_list[top_positions]))
+    return top_positions[order[:k]]
+
+def assign_clusters(embedding_matrix, centroids):
+    '''
+    Returns the index of the most similar centroid for every embedding.
+    '''
+    assignment = np.zeros(len(embedding_matrix), dtype=int)
+    for start in range(0, len(embedding_matrix), block_size):
+        block = embedding_matrix[start:start + block_size]
+        assignment[start:start + block_size] = np.argmax(block.dot(
+            centroids.T), axis=1)
+    return assignment
+
+def run_kmeans(embedding_matrix, num_clusters):
+    '''
+    Spherical k-means on normalized embeddings. Returns the unit-length
+    centroids and the cluster of every embedding.
+    '''
+    random_state = np.random.RandomState(0)
+    centroids = embedding_matrix[random_state.choice(len(embedding_matrix),
+        num_clusters, replace=False)]
+    for iteration in range(num_kmeans_iterations):
+        assignment = assign_clusters(embedding_matrix, centroids)
+        for cluster in range(num_clusters):
+            members = embedding_matrix[assignment == cluster]
+            # Empty clusters keep their old centroid.
+            if len(members) > 0:
+                centroids[cluster] = members.sum(axis=0)
+        centroids = normalize_rows(centroids)
+    return centroids, assign_clusters(embedding_matrix, centroids)
+
+def build_index(embedding_matrix, backend):
+    '''
+    Builds a neighbour index over normalized embeddings. The index is a
+    dictionary of arrays, so it can be saved with np.savez.
+    '''
+    assert backend in ['exact', 'ivf']
+    index = {'backend': np.array(backend), 'embedding_matrix':
+        embedding_matrix}
+    if backend == 'ivf':
+        num_clusters = max(1, min(len(embedding_matrix), int(round(
+            cluster_factor * np.sqrt(len(embedding_matrix))))))
+        centroids, assignment = run_kmeans(embedding_matrix, num_clusters)
+        # Inverted lists, stored CSR style: the codes of cluster c are
+        # list_ids[list_ptr[c]:list_ptr[c + 1]].
+        index['centroids'] = centroids
+        index['list_ids'] = np.argsort(assignment, kind='mergesort')
+        index['list_ptr'] = np.concatenate(([0], np.cumsum(np.bincount(
+            assignment, minlength=num_clusters))))
+    return index
+
+def save_index(index, fname):
+    np.savez(fname, **index)
+
+def load_index(fname):
+    data = np.load(fname)
+    return dict((key, data[key]) for key in data.files)
+
+def get_exact_neighbour_lists(index, query_ids, excluded_id_lists,
+    candidate_ids, k):
+    embedding_matrix = index['embedding_matrix']
+    candidate_matrix = embedding_matrix[candidate_ids]
+    # Query codes x candidate codes, a block of queries at a time, so the
+    # scores held at once do not grow with the number of queries.
+    num_block_queries = max(1, score_block_size // max(1, len(candidate_ids)))
+    neighbour_lists = []
+    for start in range(0, len(query_ids), num_block_queries):
+        score_matrix = embedding_matrix[query_ids[start:start +
+            num_block_queries]].dot(candidate_matrix.T)
+        for scores, excluded_ids in zip(score_matrix, excluded_id_lists[start:
+            start + num_block_queries]):
+            is_candidate = np.in1d(candidate_ids, excluded_ids, invert=True)
+            top_positions = get_top_terms(scores[is_candidate], k)
+            neighbour_lists += [candidate_ids[is_candidate][top_positions]]
+    return neighbour_lists
+
+def get_ivf_neighbour_lists(index, query_ids, excluded_id_lists,
+    candidate_ids, k):
+    embedding_matrix = index['embedding_matrix']
+    list_ids, list_ptr = index['list_ids'], index['list_ptr']
+    # Position of every code in candidate_ids, or -1 if it is not a candidate.
+    candidate_positions = -np.ones(len(embedding_matrix), dtype=int)
+    candidate_positions[candidate_ids] = np.arange(len(candidate_ids))
+
+    centroid_score_matrix = embedding_matrix[query_ids].dot(index[
+        'centroids'].T)
+    neighbour_lists = []
+    for query_id, centroid_scores, excluded_ids in zip(query_ids,
+        centroid_score_matrix, excluded_id_lists):
+        probe_order = np.argsort(-centroid_scores, kind='mergesort')
+        num_probed, positions = 0, np.array([], dtype=int)
+        # Probe more clusters if the closest ones hold fewer than k candidates.
+        while len(positions) < k and num_probed < len(probe_order):
+            num_probed = min(len(probe_order), max(num_probed * 2, num_probes))
+            probed_ids = np.concatenate([list_ids[list_ptr[c]:list_ptr[c + 1]]
+                for c in probe_order[:num_probed]])
+            probed_ids = probed_ids[np.in1d(probed_ids, excluded_ids,
+                invert=True)]
+            positions = candidate_positions[probed_ids]
+            # Sorting by position breaks ties the same way as 'exact'.
+            positions = np.sort(positions[positions >= 0])
+        probed_ids = candidate_ids[positions]
+        scores = embedding_matrix[probed_ids].dot(embedding_matrix[query_id])
+        neighbour_lists += [probed_ids[get_top_terms(scores, k)]]
+    return neighbour_lists
+
+def get_neighbour_lists(index, query_ids, excluded_id_lists, candidate_ids, k):
+    '''
+    For each query code, returns the ids of its k most similar codes among
+    candidate_ids, skipping the codes in its list of excluded_id_lists. Ids are
+    ordered by decreasing cosine similarity, and ties are broken by position
+    in candidate_ids.
+    '''
+    query_ids = np.asarray(query_ids, dtype=int)
+    backend = str(index['backend'])
+    if backend == 'exact':
+        return get_exact_neighbour_lists(index, query_ids, excluded_id_lists,
+            candidate_ids, k)
+    elif backend == 'ivf':
+        return get_ivf_neighbour_lists(index, query_ids, excluded_id_lists,
+            candidate_ids, k)
+
+def get_recall_report(embedding_matrix, num_queries=1000, k=10):
+    '''
+    Returns (backend, num_probes, recall@k, milliseconds per query) for the
+    exact backend and for the ivf backend at several numbers of probes. Every
+    code is a candidate, and each query excludes only itself.
+    '''
+    random_state = np.random.RandomState(0)
+    query_ids = random_state.choice(len(embedding_matrix), min(num_queries,
+        len(embedding_matrix)), replace=False)
+    excluded_id_lists = [[query_id] for query_id in query_ids]
+    candidate_ids = np.arange(len(embedding_matrix))
+
+    global num_probes
+    default_num_probes = num_probes
+    report = []
+    for backend, probe_list in (('exact', [0]), ('ivf', [1, 2, 4, 8, 16, 32])):
+        index = build_index(embedding_matrix, backend)
+        for num_probes in probe_list:
+            start_time = time.time()
+            neighbour_lists = get_neighbour_lists(index, query_ids,
+                excluded_id_lists, candidate_ids, k)
+            ms_per_query = 1000 * (time.time() - start_time) / len(query_ids)
+            if backend == 'exact':
+                exact_lists = neighbour_lists
+            recall = np.mean([len(np.intersect1d(a, b)) / float(len(b)) for a,
+                b in zip(neighbour_lists, exact_lists)])
+            report += [(backend, num_probes, recall, ms_per_query)]
+    num_probes = default_num_probes
+    return report
+
+def main():
+    if len(sys.argv) != 2:
+        print 'Usage: python %s embedding_file.npz' % sys.argv[0]
+        exit()
+    embedding_matrix = normalize_rows(np.load(sys.argv[1])['W_emb'])
+    print 'backend\tnum_probes\trecall@10\tms_per_query'
+    for backend, probes, recall, ms_per_query in get_recall_report(
+        embedding_matrix):
+        print '%s\t%d\t%f\t%f' % (backend, probes, recall, ms_per_query)
+
+if __name__ == '__main__':
+    main()
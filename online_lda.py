@@ -0,0 +1,236 @@
+### Author: Edward Huang
+
+import numpy as np
+from record_store import read_record_file
+from scipy.sparse import csr_matrix
+from scipy.special import psi
+import sys
+import time
+from training_checkpoint import load_checkpoint, save_checkpoint
+
+### Online variational Bayes for LDA (Hoffman, Blei and Bach, 2010). Visits
+### are consumed in mini-batches, and each batch updates the variational
+### topic-word parameters lambda in place. lambda, the number of updates and
+### the number of visits seen are the sufficient statistics of the model, and
+### are checkpointed per fold with the code list, so that new records can be
+### folded in without retraining. Checkpoints are saved and loaded by
+### training_checkpoint.py, and are only updated with the priors and learning
+### rate they were trained with.
+### Training from scratch is done by monolingual_lda_baseline.py with
+### lda_trainer = 'online'. Folding in a file of new records, in the format of
+### clean_HIS_tuple_word.txt, refreshes the fold's word distribution, code list
+### and count dictionaries:
+###     python online_lda.py run_num new_records_file
+
+batch_size = 256
+# Learning rate (tau0 + number of updates) ^ -kappa.
+tau0 = 64.0
+kappa = 0.7
+# Dirichlet priors, same as parallel_lda.py.
+alpha = 0.1
+eta = 0.01
+# Passes over the training visits when training from scratch.
+n_passes = 5
+# Per-batch E-step stops once the mean change of gamma is below e_step_tol.
+max_e_steps = 100
+e_step_tol = 0.001
+checkpoint_dir = './data/online_lda/'
+
+def dirichlet_expectation(param_matrix):
+    '''
+    Returns E[log x] for x ~ Dirichlet(row), for each row.
+    '''
+    return psi(param_matrix) - psi(param_matrix.sum(axis=1))[:, None]
+
+def init_state(vocab_size, n_topics, random_state=1):
+    '''
+    Returns the model state before any update.
+    '''
+    random_state = np.random.RandomState(random_state)
+    return {'lambda': random_state.gamma(100.0, 0.01, (n_topics, vocab_size)),
+        'num_updates': 0, 'num_docs': 0}
+
+def get_batch_tokens(doc_ptr, word_ids, doc_ids):
+    '''
+    Returns the token arrays (batch_ptr, batch_word_ids) of a subset of
+    documents.
+    '''
+    doc_lens = doc_ptr[doc_ids + 1] - doc_ptr[doc_ids]
+    batch_ptr = np.concatenate(([0], np.cumsum(doc_lens)))
+    # Position of each batch token in word_ids.
+    token_ids = np.arange(batch_ptr[-1]) - np.repeat(batch_ptr[:-1] -
+        doc_ptr[doc_ids], doc_lens)
+    return batch_ptr, word_ids[token_ids]
+
+def e_step(batch_ptr, batch_word_ids, exp_elog_beta, random_state):
+    '''
+    Fits the per-visit topic proportions of a batch, all visits at once.
+    Returns the batch's sufficient statistics for lambda, with the
+    exp(E[log beta]) factor included.
+    '''
+    n_topics, vocab_size = exp_elog_beta.shape
+    num_docs, num_tokens = len(batch_ptr) - 1, len(batch_word_ids)
+    token_docs = np.repeat(np.arange(num_docs), np.diff(batch_ptr))
+    # Sums token rows into their visits, and into their words.
+    doc_token = csr_matrix((np.ones(num_tokens), (token_docs, np.arange(
+        num_tokens))), shape=(num_docs, num_tokens))
+    word_token = csr_matrix((np.ones(num_tokens), (batch_word_ids, np.arange(
+        num_tokens))), shape=(vocab_size, num_tokens))
+    beta_tokens = exp_elog_beta[:, batch_word_ids].T
+
+    gamma = random_state.gamma(100.0, 0.01, (num_docs, n_topics))
+    exp_elog_theta = np.exp(dirichlet_expectation(gamma))
+    for iteration in range(max_e_steps):
+        last_gamma = gamma
+        phi_norm = (exp_elog_theta[token_docs] * beta_tokens).sum(axis=1
+            ) + 1e-100
+        gamma = alpha + exp_elog_theta * doc_token.dot(beta_tokens /
+            phi_norm[:, None])
+        exp_elog_theta = np.exp(dirichlet_expectation(gamma))
+        if np.mean(np.abs(gamma - last_gamma)) < e_step_tol:
+            break
+    phi_norm = (exp_elog_theta[token_docs] * beta_tokens).sum(axis=1) + 1e-100
+    return word_token.dot(exp_elog_theta[token_docs] * beta_tokens /
+        phi_norm[:, None]).T
+
+def update_batch(state, batch_ptr, batch_word_ids, random_state):
+    '''
+    Updates lambda in place with one mini-batch of visits.
+    '''
+    exp_elog_beta = np.exp(dirichlet_expectation(state['lambda']))
+    sstats = e_step(batch_ptr, batch_word_ids, exp_elog_beta, random_state)
+    rho = (tau0 + state['num_updates']) ** -kappa
+    # Scale the batch up to the number of visits seen.
+    batch_scale = state['num_docs'] / float(len(batch_ptr) - 1)
+    state['lambda'] *= 1 - rho
+    state['lambda'] += rho * (eta + batch_scale * sstats)
+    state['num_updates'] += 1
+
+def fit_online(state, doc_ptr, word_ids, passes, random_state=1):
+    '''
+    Adds the visits to the number seen, then updates the model with
+    mini-batches of them, in a seeded random order on every pass.
+    '''
+    random_state = np.random.RandomState(random_state)
+    num_docs = len(doc_ptr) - 1
+    state['num_docs'] += num_docs
+    for i in range(passes):
+        doc_order = random_state.permutation(num_docs)
+        for start in range(0, num_docs, batch_size):
+            batch_ptr, batch_word_ids = get_batch_tokens(doc_ptr, word_ids,
+                doc_order[start:start + batch_size])
+            update_batch(state, batch_ptr, batch_word_ids, random_state)
+
+def get_topic_word(state):
+    '''
+    Returns the expected topic-word distributions, one topic per row.
+    '''
+    return state['lambda'] / state['lambda'].sum(axis=1)[:, None]
+
+def get_checkpoint_fname(run_num):
+    return '%scheckpoint_%s.npz' % (checkpoint_dir, run_num)
+
+def get_config_dct():
+    '''
+    Returns the settings that a checkpoint must have been trained with to be
+    updated.
+    '''
+    return {'alpha': alpha, 'eta': eta, 'tau0': tau0, 'kappa': kappa}
+
+def train_fold(doc_ptr, word_ids, code_list, n_topics, run_num):
+    '''
+    Trains a fold's model from scratch, and checkpoints it. Returns the
+    topic-word distributions.
+    '''
+    state = init_state(len(code_list), n_topics)
+    fit_online(state, doc_ptr, word_ids, n_passes)
+    save_checkpoint(get_checkpoint_fname(run_num), dict(get_config_dct(),
+        code_list=np.array(code_list), **state))
+    return get_topic_word(state)
+
+def add_codes(state, code_list, record_list):
+    '''
+    Appends the codes of the records that the model has not seen to the code
+    list. Their lambda columns start at the prior.
+    '''
+    code_set = set(code_list)
+    for disease_list, name, dob, visit_date, symptom_list, herb_list in (
+        record_list):
+        for code in symptom_list + herb_list:
+            if code not in code_set:
+                code_set.add(code)
+                code_list += [code]
+    num_new_codes = len(code_list) - state['lambda'].shape[1]
+    state['lambda'] = np.hstack((state['lambda'], np.tile(eta, (state[
+        'lambda'].shape[0], num_new_codes))))
+
+def update_count_dcts(record_list, run_num):
+    '''
+    Adds the symptom and herb counts of the records to the fold's count
+    dictionaries, counting each code once per visit.
+    '''
+    for code_type, field in (('symptom', 4), ('herb', 5)):
+        fname = './data/count_dictionaries/%s_count_dct_%s.txt' % (code_type,
+            run_num)
+        count_dct = {}
+        f = open(fname, 'r')
+        for line in f:
+            code, count = line.split('\t')
+            count_dct[code] = int(count)
+        f.close()
+        for record in record_list:
+            for code in set(record[field]):
+                if code not in count_dct:
+                    count_dct[code] = 0
+                count_dct[code] += 1
+        out = open(fname, 'w')
+        for code in count_dct:
+            out.write('%s\t%d\n' % (code, count_dct[code]))
+        out.close()
+
+def fold_in(run_num, record_fname):
+    '''
+    Updates a fold's checkpointed model with the records of a file, and
+    rewrites its outputs.
+    '''
+    # Imported here, since monolingual_lda_baseline imports this module.
+    from monolingual_lda_baseline import write_code_list
+    from parallel_lda import read_token_arrays
+    checkpoint_dct = load_checkpoint(get_checkpoint_fname(run_num),
+        get_config_dct())
+    if checkpoint_dct is None:
+        print ('No checkpoint of fold %s to update. Train it with '
+            "lda_trainer = 'online' in monolingual_lda_baseline.py first." %
+            run_num)
+        exit()
+    state = {'lambda': checkpoint_dct['lambda'], 'num_updates': int(
+        checkpoint_dct['num_updates']), 'num_docs': int(checkpoint_dct[
+        'num_docs'])}
+    code_list = checkpoint_dct['code_list'].tolist()
+    record_list = read_record_file(record_fname)
+    add_codes(state, code_list, record_list)
+    code_index = dict((code, i) for i, code in enumerate(code_list))
+    doc_ptr, word_ids = read_token_arrays(sorted(set(code_index[code] for code
+        in symptom_list + herb_list)) for (disease_list, name, dob,
+        visit_date, symptom_list, herb_list) in record_list)
+    # One pass, since the rest of the corpus has already been learned.
+    fit_online(state, doc_ptr, word_ids, 1, random_state=state[
+        'num_updates'])
+    save_checkpoint(get_checkpoint_fname(run_num), dict(get_config_dct(),
+        code_list=np.array(code_list), **state))
+
+    write_code_list(code_list, run_num)
+    update_count_dcts(record_list, run_num)
+    np.savetxt('./results/lda_word_distributions/lda_word_distribution_%s'
+        '.txt' % run_num, get_topic_word(state))
+
+def main():
+    if len(sys.argv) != 3:
+        print 'Usage: python %s run_num new_records_file' % sys.argv[0]
+        exit()
+    fold_in(int(sys.argv[1]), sys.argv[2])
+
+if __name__ == '__main__':
+    start_time = time.time()
+    main()
+    print "---%f seconds---" % (time.time() - start_time)
@@ -0,0 +1,320 @@
+### Author: Edward Huang
+
+import array
+import multiprocessing
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.special import gammaln
+import sys
+import time
+from training_checkpoint import (has_converged, is_checkpoint_iteration,
+    is_likelihood_iteration, load_checkpoint, save_checkpoint)
+import zlib
+
+### Collapsed Gibbs sampler for LDA, parallelized over documents in the style
+### of AD-LDA (approximate distributed LDA). Documents are split across worker
+### processes, which share the topic-word counts through shared memory. Every
+### sweep, each worker samples its documents against a copy of the shared
+### counts taken at the start of the sweep, and the workers' changes are
+### merged into the shared counts once all of them are done. Within a worker,
+### the tokens at the same position of different documents are sampled
+### together, which is the same approximation applied to a batch of documents.
+### The corpus is a pair of token arrays (doc_ptr, word_ids): the word ids of
+### document d are word_ids[doc_ptr[d]:doc_ptr[d + 1]]. fit_tokens returns the
+### topic_word_ matrix of the lda package: one row per topic, each a
+### distribution over the vocabulary. Given a checkpoint file, the topic
+### assignments are saved periodically and a restarted run resumes from them.
+### Since every sweep is seeded by its number, a resumed run samples the same
+### topics as an uninterrupted one with the same number of threads. Training
+### can stop early once the log-likelihood converges, if enabled in
+### training_checkpoint.py.
+### Benchmark of wall time and perplexity by number of threads, on the
+### training set of a fold:
+###     python parallel_lda.py run_num n_iter
+
+# Number of worker processes sampling documents.
+num_threads = 1
+# Dirichlet priors, same defaults as the lda package.
+alpha = 0.1
+eta = 0.01
+# Most tokens sampled together by a worker.
+batch_size = 10000
+
+# Shared arrays and token layout of the current fit. Module globals, so that
+# forked workers inherit them instead of receiving them pickled.
+shared_dct = {}
+
+def get_num_threads():
+    '''
+    Reads the optional --threads N argument, and removes it from sys.argv.
+    Defaults to num_threads.
+    '''
+    n_threads = num_threads
+    if '--threads' in sys.argv:
+        i = sys.argv.index('--threads')
+        assert i + 1 < len(sys.argv), 'Usage: --threads N'
+        n_threads = int(sys.argv[i + 1])
+        del sys.argv[i:i + 2]
+    assert n_threads >= 1
+    return n_threads
+
+def get_shared_array(shape):
+    '''
+    Returns a zeroed int32 array in shared memory.
+    '''
+    raw = multiprocessing.RawArray('i', int(np.prod(shape)))
+    return np.frombuffer(raw, dtype=np.int32).reshape(shape)
+
+def read_token_arrays(doc_word_lists):
+    '''
+    Returns the token arrays (doc_ptr, word_ids) of an iterable of documents,
+    each a list of word ids. Documents are read one at a time.
+    '''
+    doc_ptr, word_ids = array.array('i', [0]), array.array('i')
+    for word_list in doc_word_lists:
+        word_ids.extend(word_list)
+        doc_ptr.append(len(word_ids))
+    return (np.frombuffer(doc_ptr, dtype=np.int32), np.frombuffer(word_ids,
+        dtype=np.int32))
+
+def get_token_arrays(doc_term_matrix):
+    '''
+    Returns the token arrays (doc_ptr, word_ids) of a document-term matrix of
+    counts, dense or sparse.
+    '''
+    doc_term_matrix = csr_matrix(doc_term_matrix)
+    counts = doc_term_matrix.data.astype(int)
+    word_ids = np.repeat(doc_term_matrix.indices, counts)
+    doc_lens = np.asarray(doc_term_matrix.sum(axis=1)).ravel().astype(int)
+    doc_ptr = np.concatenate(([0], np.cumsum(doc_lens)))
+    return doc_ptr, word_ids
+
+def get_csr_matrix(doc_ptr, word_ids, vocab_size):
+    '''
+    Returns the document-term matrix of counts of the token arrays.
+    '''
+    doc_term_matrix = csr_matrix((np.ones(len(word_ids), dtype=int), word_ids,
+        doc_ptr), shape=(len(doc_ptr) - 1, vocab_size))
+    # Adds up repeated words.
+    doc_term_matrix.sum_duplicates()
+    return doc_term_matrix
+
+def get_position_token_lists(doc_ptr, worker_doc_ids):
+    '''
+    Returns batches of token ids for a worker's documents: the j-th tokens of
+    its documents, for each position j, in batches of at most batch_size. No
+    document appears twice in a batch.
+    '''
+    doc_lens = doc_ptr[worker_doc_ids + 1] - doc_ptr[worker_doc_ids]
+    order = np.argsort(-doc_lens, kind='mergesort')
+    worker_doc_ids, doc_lens = worker_doc_ids[order], doc_lens[order]
+    position_token_lists = []
+    for j in range(doc_lens.max() if len(doc_lens) > 0 else 0):
+        # Documents are sorted by decreasing length.
+        num_active = np.searchsorted(-doc_lens, -j, side='left')
+        token_ids = doc_ptr[worker_doc_ids[:num_active]] + j
+        for start in range(0, num_active, batch_size):
+            position_token_lists += [token_ids[start:start + batch_size]]
+    return position_token_lists
+
+def sweep_worker(task):
+    '''
+    Samples every token of a worker's documents once, and stores the
+    worker's changes to the topic-word counts in its delta array.
+    '''
+    worker, sweep = task
+    topic_word_count = shared_dct['topic_word_count']
+    doc_topic_count, z = shared_dct['doc_topic_count'], shared_dct['z']
+    doc_ids, word_ids = shared_dct['doc_ids'], shared_dct['word_ids']
+    n_topics, vocab_size = topic_word_count.shape
+
+    # Word-major copy, so that gathering the counts of a batch's words reads
+    # contiguous rows.
+    local_count = topic_word_count.T.astype(float)
+    topic_count = local_count.sum(axis=0)
+    random_state = np.random.RandomState([shared_dct['random_state'], sweep,
+        worker])
+    for token_ids in shared_dct['position_token_lists'][worker]:
+        docs, words, old_topics = doc_ids[token_ids], word_ids[token_ids], z[
+            token_ids]
+        # Remove the tokens from the counts.
+        doc_topic_count[docs, old_topics] -= 1
+        np.subtract.at(local_count, (words, old_topics), 1)
+        topic_count -= np.bincount(old_topics, minlength=n_topics)
+
+        prob_matrix = (doc_topic_count[docs] + alpha) * (local_count[words] +
+            eta)
+        prob_matrix *= 1.0 / (topic_count + vocab_size * eta)
+        cumulative = prob_matrix.cumsum(axis=1)
+        draws = random_state.rand(len(token_ids)) * cumulative[:, -1]
+        # First topic whose cumulative probability reaches the draw.
+        new_topics = np.argmax(cumulative >= draws[:, None], axis=1).astype(
+            np.int32)
+
+        # Add them back with their new topics.
+        doc_topic_count[docs, new_topics] += 1
+        np.add.at(local_count, (words, new_topics), 1)
+        topic_count += np.bincount(new_topics, minlength=n_topics)
+        z[token_ids] = new_topics
+    shared_dct['delta_list'][worker][:] = np.rint(local_count.T -
+        topic_word_count)
+
+def get_topic_word(topic_word_count):
+    '''
+    Returns the smoothed topic-word distributions, one topic per row.
+    '''
+    topic_word = topic_word_count + eta
+    return topic_word / topic_word.sum(axis=1)[:, None]
+
+def get_log_likelihood(topic_word_count, doc_topic_count):
+    '''
+    Returns the log joint likelihood of the words and topic assignments, with
+    the topic-word and doc-topic distributions integrated out.
+    '''
+    n_topics, vocab_size = topic_word_count.shape
+    num_docs = doc_topic_count.shape[0]
+    log_likelihood = n_topics * (gammaln(vocab_size * eta) - vocab_size *
+        gammaln(eta))
+    log_likelihood += gammaln(topic_word_count + eta).sum() - gammaln(
+        topic_word_count.sum(axis=1) + vocab_size * eta).sum()
+    log_likelihood += num_docs * (gammaln(n_topics * alpha) - n_topics *
+        gammaln(alpha))
+    log_likelihood += gammaln(doc_topic_count + alpha).sum() - gammaln(
+        doc_topic_count.sum(axis=1) + n_topics * alpha).sum()
+    return log_likelihood
+
+def get_perplexity(topic_word, doc_topic_count, doc_ptr, doc_ids, word_ids,
+    block_size=100000):
+    '''
+    Returns the perplexity of the training tokens under the fitted model.
+    '''
+    n_topics = doc_topic_count.shape[1]
+    doc_topic = (doc_topic_count + alpha) / (np.diff(doc_ptr)[:, None] +
+        n_topics * alpha)
+    log_likelihood = 0.0
+    for start in range(0, len(word_ids), block_size):
+        docs = doc_ids[start:start + block_size]
+        words = word_ids[start:start + block_size]
+        log_likelihood += np.log((doc_topic[docs] * topic_word[:, words].T
+            ).sum(axis=1)).sum()
+    return np.exp(-log_likelihood / max(len(word_ids), 1))
+
+def fit_tokens(doc_ptr, word_ids, vocab_size, n_topics, n_iter,
+    random_state=1, n_threads=None, checkpoint_fname=None):
+    '''
+    Runs the sampler on the token arrays of a corpus, for n_iter sweeps or
+    until convergence. Returns (topic_word, perplexity).
+    '''
+    if n_threads is None:
+        n_threads = num_threads
+    # Pool workers, e.g., folds run by fold_scheduler, cannot fork workers of
+    # their own.
+    if multiprocessing.current_process().daemon:
+        n_threads = 1
+    num_docs = len(doc_ptr) - 1
+    doc_ids = np.repeat(np.arange(num_docs), np.diff(doc_ptr))
+
+    # Random initial topics, or the topics of the last checkpoint.
+    z = get_shared_array(len(word_ids))
+    z[:] = np.random.RandomState(random_state).randint(n_topics, size=len(
+        word_ids))
+    start_sweep, log_likelihood_list, converged = 0, [], False
+    config_dct = {'n_topics': n_topics, 'vocab_size': vocab_size,
+        'num_tokens': len(word_ids), 'random_state': random_state,
+        'corpus_crc': zlib.crc32(np.ascontiguousarray(word_ids, dtype=np.int32
+        ).tostring()) ^ zlib.crc32(np.ascontiguousarray(doc_ptr, dtype=np.int64
+        ).tostring())}
+    checkpoint_dct = None
+    if checkpoint_fname is not None:
+        checkpoint_dct = load_checkpoint(checkpoint_fname, config_dct)
+    if checkpoint_dct is not None:
+        z[:] = checkpoint_dct['z']
+        start_sweep = int(checkpoint_dct['sweep'])
+        log_likelihood_list = checkpoint_dct['log_likelihood_list'].tolist()
+        converged = bool(checkpoint_dct['converged'])
+    doc_topic_count = get_shared_array((num_docs, n_topics))
+    np.add.at(doc_topic_count, (doc_ids, z), 1)
+    topic_word_count = get_shared_array((n_topics, vocab_size))
+    np.add.at(topic_word_count, (z, word_ids), 1)
+
+    worker_doc_lists = np.array_split(np.arange(num_docs), n_threads)
+    shared_dct.clear()
+    shared_dct.update({'topic_word_count': topic_word_count, 'doc_topic_count':
+        doc_topic_count, 'z': z, 'doc_ids': doc_ids, 'word_ids': word_ids,
+        'random_state': random_state, 'position_token_lists': [
+        get_position_token_lists(doc_ptr, worker_doc_ids) for worker_doc_ids
+        in worker_doc_lists], 'delta_list': [get_shared_array((n_topics,
+        vocab_size)) for worker in range(n_threads)]})
+
+    pool = None
+    if n_threads > 1 and not converged and start_sweep < n_iter:
+        pool = multiprocessing.Pool(n_threads)
+    try:
+        for sweep in range(start_sweep, n_iter):
+            if converged:
+                break
+            task_list = [(worker, sweep) for worker in range(n_threads)]
+            if pool is None:
+                map(sweep_worker, task_list)
+            else:
+                pool.map(sweep_worker, task_list, chunksize=1)
+            # Synchronize: merge every worker's changes into the shared counts.
+            for delta in shared_dct['delta_list']:
+                topic_word_count += delta
+
+            if is_likelihood_iteration(sweep):
+                log_likelihood_list += [get_log_likelihood(topic_word_count,
+                    doc_topic_count)]
+                converged = has_converged(log_likelihood_list)
+                if converged:
+                    print 'Converged after %d sweeps' % (sweep + 1)
+            if checkpoint_fname is not None and (converged or
+                is_checkpoint_iteration(sweep) or sweep == n_iter - 1):
+                save_checkpoint(checkpoint_fname, dict(config_dct, z=z,
+                    sweep=sweep + 1, log_likelihood_list=np.array(
+                    log_likelihood_list), converged=converged))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    topic_word = get_topic_word(topic_word_count)
+    perplexity = get_perplexity(topic_word, doc_topic_count, doc_ptr, doc_ids,
+        word_ids)
+    shared_dct.clear()
+    return topic_word, perplexity
+
+def fit_lda(doc_term_matrix, n_topics, n_iter, random_state=1,
+    n_threads=None):
+    '''
+    Runs the sampler on a document-term matrix of counts, dense or sparse.
+    Returns (topic_word, perplexity).
+    '''
+    doc_ptr, word_ids = get_token_arrays(doc_term_matrix)
+    return fit_tokens(doc_ptr, word_ids, doc_term_matrix.shape[1], n_topics,
+        n_iter, random_state, n_threads)
+
+def main():
+    if len(sys.argv) != 3:
+        print 'Usage: python %s run_num n_iter' % sys.argv[0]
+        exit()
+    # Imported here, since monolingual_lda_baseline imports this module.
+    from monolingual_lda_baseline import (get_patient_dct, get_patient_tokens,
+        get_visit_arrays)
+    from record_store import get_fold_code_records
+    run_num, n_iter = int(sys.argv[1]), int(sys.argv[2])
+    patient_dct, disease_set = get_patient_dct(get_fold_code_records(run_num,
+        'train')[0])
+    code_ids = np.union1d(get_visit_arrays(patient_dct, 1), get_visit_arrays(
+        patient_dct, 2))
+    doc_ptr, word_ids = get_patient_tokens(patient_dct, code_ids)
+
+    print 'threads\tseconds\tperplexity'
+    for n_threads in [1, 2, 4, 8]:
+        start_time = time.time()
+        topic_word, perplexity = fit_tokens(doc_ptr, word_ids, len(
+            code_ids), len(disease_set), n_iter, n_threads=n_threads)
+        print '%d\t%f\t%f' % (n_threads, time.time() - start_time, perplexity)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,258 @@
+### Author: Edward Huang
+
+import numpy as np
+from parallel_lda import get_position_token_lists
+from scipy.special import gammaln, psi
+from training_checkpoint import (has_converged, is_checkpoint_iteration,
+    is_likelihood_iteration, load_checkpoint, save_checkpoint)
+import zlib
+
+### Collapsed Gibbs sampler for the polylingual topic model (Mimno et al.,
+### 2009), the model of MALLET's PolylingualTopicModel. Every document has a
+### token list in each language, and all of them share the document's topic
+### counts, while each language has its own topic-word counts. With the herb
+### and symptom languages, it reduces to BiLDA. As in MALLET, the document-topic
+### prior alpha is asymmetric, each language has a symmetric topic-word prior
+### beta, and both are re-estimated every optimize_interval sweeps after the
+### burn-in, by Minka's fixed-point updates.
+### The corpus of a language is a pair of token arrays (doc_ptr, word_ids), as
+### in parallel_lda.py, and every language has the same documents. The tokens
+### of all languages are sampled in one array, with the word ids of each
+### language offset past the vocabularies of the languages before it. Tokens at
+### the same position of different documents are sampled together, as in
+### parallel_lda.py.
+
+# Sum of the initial alpha, and the initial beta, same defaults as MALLET.
+alpha_sum = 50.0
+beta = 0.01
+# Sweeps between hyperparameter updates, and sweeps before the first one.
+optimize_interval = 10
+optimize_burn_in = 200
+# Iterations of each fixed-point update.
+optimize_iterations = 200
+# Gamma prior on each alpha, same as MALLET.
+alpha_shape = 1.00001
+alpha_scale = 1.0
+
+def get_corpus_arrays(language_token_list, vocab_size_list):
+    '''
+    Merges the token arrays of the languages into one set of token arrays.
+    Returns (doc_ptr, word_ids, language_ids, word_offsets): the merged word
+    ids of a document are its words in every language, in language order.
+    '''
+    num_docs = len(language_token_list[0][0]) - 1
+    word_offsets = np.concatenate(([0], np.cumsum(vocab_size_list)))
+    doc_lens = np.zeros(num_docs, dtype=int)
+    for language_doc_ptr, language_word_ids in language_token_list:
+        assert len(language_doc_ptr) - 1 == num_docs
+        doc_lens += np.diff(language_doc_ptr)
+    doc_ptr = np.concatenate(([0], np.cumsum(doc_lens)))
+
+    word_ids = np.zeros(doc_ptr[-1], dtype=np.int32)
+    language_ids = np.zeros(doc_ptr[-1], dtype=np.int32)
+    # Position of the next token of each document.
+    doc_pos = doc_ptr[:-1].copy()
+    for language, (language_doc_ptr, language_word_ids) in enumerate(
+        language_token_list):
+        language_doc_lens = np.diff(language_doc_ptr)
+        token_ids = np.arange(len(language_word_ids)) + np.repeat(doc_pos -
+            language_doc_ptr[:-1], language_doc_lens)
+        word_ids[token_ids] = language_word_ids + word_offsets[language]
+        language_ids[token_ids] = language
+        doc_pos += language_doc_lens
+    return doc_ptr, word_ids, language_ids, word_offsets
+
+def sample_sweep(state, corpus_dct, random_state):
+    '''
+    Samples every token once.
+    '''
+    alpha, beta_list = state['alpha'], state['beta_list']
+    doc_topic_count, word_topic_count = state['doc_topic_count'], state[
+        'word_topic_count']
+    topic_count, z = state['topic_count'], state['z']
+    doc_ids, word_ids = corpus_dct['doc_ids'], corpus_dct['word_ids']
+    language_ids = corpus_dct['language_ids']
+    beta_sum_list = beta_list * corpus_dct['vocab_size_list']
+    # Batches hold at most parallel_lda.batch_size tokens, so the probability
+    # matrix of a batch is at most batch_size x n_topics, whatever the number
+    # of documents.
+    for token_ids in corpus_dct['position_token_list']:
+        docs, words, languages, old_topics = doc_ids[token_ids], word_ids[
+            token_ids], language_ids[token_ids], z[token_ids]
+        # Remove the tokens from the counts.
+        doc_topic_count[docs, old_topics] -= 1
+        np.subtract.at(word_topic_count, (words, old_topics), 1)
+        np.subtract.at(topic_count, (languages, old_topics), 1)
+
+        prob_matrix = (doc_topic_count[docs] + alpha) * (word_topic_count[
+            words] + beta_list[languages][:, None]) / (topic_count[languages] +
+            beta_sum_list[languages][:, None])
+        cumulative = prob_matrix.cumsum(axis=1, out=prob_matrix)
+        draws = random_state.rand(len(token_ids)) * cumulative[:, -1]
+        # First topic whose cumulative probability reaches the draw.
+        new_topics = np.argmax(cumulative >= draws[:, None], axis=1).astype(
+            np.int32)
+
+        # Add them back with their new topics.
+        doc_topic_count[docs, new_topics] += 1
+        np.add.at(word_topic_count, (words, new_topics), 1)
+        np.add.at(topic_count, (languages, new_topics), 1)
+        z[token_ids] = new_topics
+
+def get_digamma_sum(param, value_list, freq_list):
+    '''
+    Returns the sum of freq * (psi(param + value) - psi(param)) over the
+    values and their frequencies. param broadcasts against the values.
+    '''
+    return (freq_list * (psi(param + value_list) - psi(param))).sum(axis=-1)
+
+def optimize_alpha(alpha, doc_topic_count):
+    '''
+    Returns the fixed-point estimate of the asymmetric alpha, with a Gamma prior
+    on each component. Works on histograms of the counts, as MALLET's
+    Dirichlet.learnParameters does.
+    '''
+    n_topics = len(alpha)
+    doc_lens, doc_len_freqs = np.unique(doc_topic_count.sum(axis=1),
+        return_counts=True)
+    # topic_count_hist[k, n] is the number of documents with n tokens of k.
+    max_count = doc_topic_count.max()
+    topic_count_hist = np.bincount((np.arange(n_topics) * (max_count + 1) +
+        doc_topic_count).ravel(), minlength=n_topics * (max_count + 1)
+        ).reshape(n_topics, max_count + 1)
+    count_list = np.arange(max_count + 1)
+    for iteration in range(optimize_iterations):
+        denominator = get_digamma_sum(alpha.sum(), doc_lens, doc_len_freqs
+            ) - 1.0 / alpha_scale
+        alpha = alpha * (get_digamma_sum(alpha[:, None], count_list,
+            topic_count_hist) + alpha_shape) / denominator
+    return alpha
+
+def optimize_beta(beta, word_topic_count, topic_count):
+    '''
+    Returns the fixed-point estimate of the symmetric beta of a language, from
+    its topic-word counts, as MALLET's Dirichlet.learnSymmetricConcentration
+    does.
+    '''
+    vocab_size = word_topic_count.shape[0]
+    counts, count_freqs = np.unique(word_topic_count[word_topic_count > 0],
+        return_counts=True)
+    topic_sizes, topic_size_freqs = np.unique(topic_count, return_counts=True)
+    for iteration in range(optimize_iterations):
+        beta = beta * get_digamma_sum(beta, counts, count_freqs) / (vocab_size *
+            get_digamma_sum(vocab_size * beta, topic_sizes, topic_size_freqs))
+    return beta
+
+def get_log_likelihood(state, corpus_dct):
+    '''
+    Returns the log joint likelihood of the words and topic assignments, with
+    the topic-word and doc-topic distributions integrated out.
+    '''
+    alpha, doc_topic_count = state['alpha'], state['doc_topic_count']
+    n_topics = len(alpha)
+    num_docs = doc_topic_count.shape[0]
+    log_likelihood = num_docs * (gammaln(alpha.sum()) - gammaln(alpha).sum())
+    log_likelihood += gammaln(doc_topic_count + alpha).sum() - gammaln(
+        doc_topic_count.sum(axis=1) + alpha.sum()).sum()
+    word_offsets = corpus_dct['word_offsets']
+    for language, language_beta in enumerate(state['beta_list']):
+        vocab_size = corpus_dct['vocab_size_list'][language]
+        log_likelihood += n_topics * (gammaln(vocab_size * language_beta) -
+            vocab_size * gammaln(language_beta))
+        log_likelihood += gammaln(state['word_topic_count'][word_offsets[
+            language]:word_offsets[language + 1]] + language_beta).sum(
+            ) - gammaln(state['topic_count'][language] + vocab_size *
+            language_beta).sum()
+    return log_likelihood
+
+def is_optimize_iteration(iteration):
+    '''
+    Whether the hyperparameters are updated after iteration, counted from 0.
+    '''
+    return (optimize_interval != 0 and iteration + 1 > optimize_burn_in and
+        (iteration + 1) % optimize_interval == 0)
+
+def fit_polylingual(language_token_list, vocab_size_list, n_topics, n_iter,
+    random_state=1, checkpoint_fname=None):
+    '''
+    Runs the sampler for n_iter sweeps or until convergence, given the token
+    arrays and vocabulary size of each language. Returns the model, a
+    dictionary of the per-language topic-word distributions
+    'topic_word_list', each with one topic per row, their counts
+    'topic_word_count_list', and the hyperparameters 'alpha' and 'beta_list'.
+    '''
+    doc_ptr, word_ids, language_ids, word_offsets = get_corpus_arrays(
+        language_token_list, vocab_size_list)
+    num_docs = len(doc_ptr) - 1
+    doc_ids = np.repeat(np.arange(num_docs), np.diff(doc_ptr))
+    corpus_dct = {'doc_ids': doc_ids, 'word_ids': word_ids, 'language_ids':
+        language_ids, 'word_offsets': word_offsets, 'vocab_size_list':
+        np.array(vocab_size_list), 'position_token_list':
+        get_position_token_lists(doc_ptr, np.arange(num_docs))}
+
+    # Random initial topics, or the state of the last checkpoint.
+    z = np.random.RandomState(random_state).randint(n_topics, size=len(
+        word_ids)).astype(np.int32)
+    alpha = np.tile(alpha_sum / n_topics, n_topics)
+    beta_list = np.tile(beta, len(vocab_size_list))
+    start_sweep, log_likelihood_list, converged = 0, [], False
+    config_dct = {'n_topics': n_topics, 'vocab_size_list': np.array(
+        vocab_size_list), 'num_tokens': len(word_ids), 'random_state':
+        random_state, 'corpus_crc': zlib.crc32(word_ids.tostring()) ^
+        zlib.crc32(np.ascontiguousarray(doc_ptr, dtype=np.int64).tostring())}
+    checkpoint_dct = None
+    if checkpoint_fname is not None:
+        checkpoint_dct = load_checkpoint(checkpoint_fname, config_dct)
+    if checkpoint_dct is not None:
+        z[:] = checkpoint_dct['z']
+        alpha, beta_list = checkpoint_dct['alpha'], checkpoint_dct['beta_list']
+        start_sweep = int(checkpoint_dct['sweep'])
+        log_likelihood_list = checkpoint_dct['log_likelihood_list'].tolist()
+        converged = bool(checkpoint_dct['converged'])
+    state = {'z': z, 'alpha': alpha, 'beta_list': beta_list}
+    state['doc_topic_count'] = np.zeros((num_docs, n_topics), dtype=np.int32)
+    np.add.at(state['doc_topic_count'], (doc_ids, z), 1)
+    # Word-major, so that gathering the counts of a batch's words reads
+    # contiguous rows.
+    state['word_topic_count'] = np.zeros((word_offsets[-1], n_topics))
+    np.add.at(state['word_topic_count'], (word_ids, z), 1)
+    state['topic_count'] = np.zeros((len(vocab_size_list), n_topics))
+    np.add.at(state['topic_count'], (language_ids, z), 1)
+
+    for sweep in range(start_sweep, n_iter):
+        if converged:
+            break
+        sample_sweep(state, corpus_dct, np.random.RandomState([random_state,
+            sweep]))
+        if is_optimize_iteration(sweep):
+            state['alpha'] = optimize_alpha(state['alpha'], state[
+                'doc_topic_count'])
+            state['beta_list'] = np.array([optimize_beta(language_beta,
+                state['word_topic_count'][word_offsets[language]:word_offsets[
+                language + 1]], state['topic_count'][language]) for language,
+                language_beta in enumerate(state['beta_list'])])
+
+        if is_likelihood_iteration(sweep):
+            log_likelihood_list += [get_log_likelihood(state, corpus_dct)]
+            # Not before the hyperparameters have been optimized.
+            converged = sweep + 1 > optimize_burn_in and has_converged(
+                log_likelihood_list)
+            if converged:
+                print 'Converged after %d sweeps' % (sweep + 1)
+        if checkpoint_fname is not None and (converged or
+            is_checkpoint_iteration(sweep) or sweep == n_iter - 1):
+            save_checkpoint(checkpoint_fname, dict(config_dct, z=z, alpha=state[
+                'alpha'], beta_list=state['beta_list'], sweep=sweep + 1,
+                log_likelihood_list=np.array(log_likelihood_list),
+                converged=converged))
+
+    topic_word_count_list, topic_word_list = [], []
+    for language, language_beta in enumerate(state['beta_list']):
+        topic_word_count = np.rint(state['word_topic_count'][word_offsets[
+            language]:word_offsets[language + 1]].T).astype(int)
+        topic_word = topic_word_count + language_beta
+        topic_word_count_list += [topic_word_count]
+        topic_word_list += [topic_word / topic_word.sum(axis=1)[:, None]]
+    return {'topic_word_list': topic_word_list, 'topic_word_count_list':
+        topic_word_count_list, 'alpha': state['alpha'], 'beta_list': state[
+        'beta_list']}
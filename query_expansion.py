@@ -1,11 +1,31 @@
 import collections
+import cPickle
+from fold_scheduler import get_num_jobs, run_folds
+from lda_query_expansion import (get_query_matrix, get_scaled_topic_matrix,
+    get_top_word_matrix, query_batch_size, select_expansion_terms)
 import os 
 import numpy as np
+from record_store import get_fold_lines
 import sys
 import time
 
 ### This script rewrites the test files, except with query expansion performed
-### on each query patient's list of symptoms.
+### on each query patient's list of symptoms. Both LDA and BiLDA rescore the
+### topic-word distributions of a batch of queries at once, weighting each
+### topic by the number of query terms in its top words. BiLDA adds the
+### highest scoring codes of the requested languages. Folds trained before
+### train_pltm.py saved the topic-word distributions, e.g., by MALLET, only
+### have topic keys, and are expanded by co-occurrence in the topic keys as
+### before, until train_pltm.py is rerun.
+
+# Topic-word distributions of each fold's PLTM model.
+bilda_model_fname = './data/sequence/pltm_topic_word%d.npz'
+# Parsed PLTM topic indices, keyed by run_num. Each fold's topic keys file is
+# parsed once and then shared by all of its queries.
+topic_index_cache = {}
+# If True, parsed topic indices are also pickled next to the topic keys files
+# and reused by later runs, as long as the text file is not newer.
+persist_topic_index = True
 
 def read_code_list(run_num):
     code_list = []
@@ -15,26 +35,6 @@ def read_code_list(run_num):
     f.close()
     return code_list
 
-def get_scaled_topic(symptom_list, word_distr, code_list):
-    '''
-    Given a symptom list (i.e., query), and the word distributions output by
-    some LDA run, we want to recompute the topic probabilities. For each topic,
-    we multiply the word probabilities of that topic by the number of query 
-    terms that appear in the top 200 words. Add together these topics
-    elementwise.
-    '''
-    n_top_words = 200
-    scaled_topic = np.zeros(len(code_list))
-
-    for i, topic_dist in enumerate(word_distr):
-        topic_words = np.array(code_list)[np.argsort(topic_dist)][:-(
-            n_top_words + 1):-1]
-        # Number of query terms in the top n words.
-        num_shared_terms = len(set(topic_words).intersection(symptom_list))
-        scaled_topic += topic_dist * num_shared_terms
-
-    return scaled_topic
-
 def get_highest_prob_words(symptom_list, scaled_topic, code_list):
     '''
     Given the scaled topic, find the top words to add to the given query. Add
@@ -52,49 +52,132 @@ def get_highest_prob_words(symptom_list, scaled_topic, code_list):
         if len(expansion_terms) == 10:#2 * num_symptoms:
             break
     return expansion_terms
+def get_bilda_candidate_mask(language_ptr, sh_mixed):
+    '''
+    Returns a boolean vector over the PLTM code list that is True for the
+    codes of the languages given by sh_mixed. Herbs are language 0 and
+    symptoms language 1. As before, any other sh_mixed adds no terms.
+    '''
+    candidate_mask = np.zeros(language_ptr[-1], dtype=bool)
+    language_dct = {'herb': [0], 'sympt': [1], 'mixed': [0, 1]}
+    for language in language_dct.get(sh_mixed, []):
+        candidate_mask[language_ptr[language]:language_ptr[language + 1]] = True
+    return candidate_mask
+
+def get_bilda_top_word_matrix(word_distr, language_ptr):
+    '''
+    Returns the top word matrix of a PLTM model. The top words of each topic
+    are picked in each language separately.
+    '''
+    return np.hstack([get_top_word_matrix(word_distr[:, language_ptr[
+        language]:language_ptr[language + 1]]) for language in range(len(
+        language_ptr) - 1)])
+
+def load_bilda_model(run_num):
+    '''
+    Returns (code_list, word_distr, top_word_matrix, language_ptr) of a fold's
+    PLTM model, saved by train_pltm.py.
+    '''
+    data = np.load(bilda_model_fname % run_num)
+    word_distr, language_ptr = data['topic_word'], data['language_ptr']
+    return data['code_list'].tolist(), word_distr, get_bilda_top_word_matrix(
+        word_distr, language_ptr), language_ptr
+
+def get_bilda_expansion_term_lists(query_matrix, scaled_topic_matrix,
+    code_list, candidate_mask):
+    '''
+    Returns the codes to add to each query of a batch: the highest scoring
+    candidates that are not query terms, by decreasing score. Ties go to the
+    code that comes first in code_list.
+    '''
+    ranking_matrix = np.argsort(-scaled_topic_matrix, axis=1, kind='mergesort')
+    return select_expansion_terms(query_matrix, ranking_matrix, code_list,
+        candidate_mask)
+
+def parse_topic_keys(topic_fname):
+    '''
+    Parses the topic keys written by MALLET's PolylingualTopicModel.
+    Returns (herb topic word lists, symptom topic word lists, symptom
+    postings). The postings map each symptom to the ids of the symptom topics
+    whose top words contain it, repeated once per occurrence.
+    '''
+    #Process the MALLET output into a list of list of top topic words 
+    herb_top_topic_words =[]
+    sympt_top_topic_words =[]
+    f = open(topic_fname, 'r')
+    for l in f:
+        ls =l.split('\t')
+        if len(ls) ==2:
+            #Beginning of a new topic
+            continue
+        word_lst = ls[3].split(" ")
+        if int(ls[0])==0:
+            #HERB language
+            herb_top_topic_words.append(word_lst)
+        elif int(ls[0])==1:
+            #SYMPT language
+            sympt_top_topic_words.append(word_lst)
+    f.close()
+
+    sympt_postings = {}
+    for topic_i, topic_lst in enumerate(sympt_top_topic_words):
+        for word in topic_lst:
+            if word not in sympt_postings:
+                sympt_postings[word] = []
+            sympt_postings[word] += [topic_i]
+    for word in sympt_postings:
+        sympt_postings[word] = np.array(sympt_postings[word], dtype=int)
+    return herb_top_topic_words, sympt_top_topic_words, sympt_postings
+
+def load_topic_index(run_num):
+    '''
+    Returns the parsed topic index of a fold. Parses the topic keys file at
+    most once per process, or not at all if an up-to-date pickle exists.
+    '''
+    if run_num in topic_index_cache:
+        return topic_index_cache[run_num]
+    topic_fname = './data/sequence/pltm_output_topics%d.txt' % run_num
+    pickle_fname = './data/sequence/pltm_topic_index%d.pickle' % run_num
+    if persist_topic_index and os.path.exists(pickle_fname) and (
+        os.path.getmtime(pickle_fname) >= os.path.getmtime(topic_fname)):
+        with open(pickle_fname, 'rb') as f:
+            topic_index = cPickle.load(f)
+    else:
+        topic_index = parse_topic_keys(topic_fname)
+        if persist_topic_index:
+            with open(pickle_fname, 'wb') as out:
+                cPickle.dump(topic_index, out, cPickle.HIGHEST_PROTOCOL)
+    topic_index_cache[run_num] = topic_index
+    return topic_index
+
 def get_highest_cooccuring_words(symptom_list,run_num,sh_mixed='sympt_only'):
     '''
     Given the symptom list, find the highest co-occuring topics
     then find the highest co-occuring words in those topics. 
     '''
-    with open("./data/sequence/pltm_output_topics{}.txt".format(run_num)) as f : 
-        lines = f.readlines()
-        #Process the MALLET output into a list of list of top topic words 
-        herb_top_topic_words =[]
-        sympt_top_topic_words =[]
-        for l in lines: 
-            ls =l.split('\t')
-            if len(ls) ==2:
-                #Beginning of a new topic
-                pass
-            else:
-        #         print ls[0]
-        #         print ls[3]
-                word_lst = ls[3].split(" ")
-                if int(ls[0])==0:
-                    #HERB language
-                    herb_top_topic_words.append(word_lst)
-                elif int(ls[0])==1:
-                    #SYMPT language
-                    sympt_top_topic_words.append(word_lst)
+    (herb_top_topic_words, sympt_top_topic_words,
+        sympt_postings) = load_topic_index(run_num)
 
     num_symptom = len(symptom_list)
     #Mixing together symptom and herb
     #if sh_mixed: sympt_top_topic_words.extend(herb_top_topic_words)
 
-    sympt_cooccurence =[filter(lambda x: x in symptom_list, topic_lst) for topic_lst in sympt_top_topic_words]
-    sympt_cooccurence_count = [len(c) for c in sympt_cooccurence] #cooccurence count for each topic 
+    #cooccurence count for each topic, from the postings of the query symptoms
+    postings_lst = [sympt_postings[symptom] for symptom in set(symptom_list) if
+        symptom in sympt_postings]
+    sympt_cooccurence_count = np.bincount(np.concatenate(postings_lst + [
+        np.array([], dtype=int)]), minlength=len(sympt_top_topic_words))
     #top-k cooccurence topics index
     sympt_topk_topics  = np.argsort(sympt_cooccurence_count)[::-1][:3*num_symptom+1]
     
     expansion_terms = []
     if (sh_mixed=='mixed'):
-        topk_sympt_top_topic_words = np.array(sympt_top_topic_words)[sympt_topk_topics]
+        topk_sympt_top_topic_words = [sympt_top_topic_words[i] for i in sympt_topk_topics]
         
         flatten_lst = []
         for word_lst in topk_sympt_top_topic_words:
             flatten_lst+=word_lst
-        topk_herb_top_topic_words = np.array(herb_top_topic_words)[sympt_topk_topics]
+        topk_herb_top_topic_words = [herb_top_topic_words[i] for i in sympt_topk_topics]
 
         for word_lst in topk_herb_top_topic_words:
             flatten_lst+=word_lst
@@ -105,7 +188,7 @@ def get_highest_cooccuring_words(symptom_list,run_num,sh_mixed='sympt_only'):
     #Compute co-occurence
     elif ( sh_mixed=='sympt' ):
         #find query expansion terms by looking at top-occuring words in those topics 
-        topk_sympt_top_topic_words = np.array(sympt_top_topic_words)[sympt_topk_topics]
+        topk_sympt_top_topic_words = [sympt_top_topic_words[i] for i in sympt_topk_topics]
         
         flatten_lst = []
         for word_lst in topk_sympt_top_topic_words:
@@ -117,7 +200,7 @@ def get_highest_cooccuring_words(symptom_list,run_num,sh_mixed='sympt_only'):
                 expansion_terms.append(k)
         
     elif (sh_mixed=='herb'): 
-        topk_herb_top_topic_words = np.array(herb_top_topic_words)[sympt_topk_topics]
+        topk_herb_top_topic_words = [herb_top_topic_words[i] for i in sympt_topk_topics]
         # print "topk_herb_top_topic_words: "
         flatten_lst = []
         for word_lst in topk_herb_top_topic_words:
@@ -136,36 +219,63 @@ def query_expansion(run_num,sh_mixed='sympt_only'):
     on the words that most co-occur with the query symptoms. Co-occurrence is
     computed by appearances in the topics output by the different LDA models.
     '''
+    # Split by tab, fifth element, split by comma, take out trailing comma.
+    query_list = [query.split('\t') for query in get_fold_lines(run_num,
+        'test')]
+    # Queries without symptoms are left out of the expanded file.
+    query_list = [query for query in query_list if len(query[4].split(':')[:-1]
+        ) != 0]
+    symptom_lists = [query[4].split(':')[:-1] for query in query_list]
+
     if lda_type=='lda':
         code_list = read_code_list(run_num)
         word_distr = np.loadtxt('./results/%s_word_distributions/'
             '%s_word_distribution_%d.txt' % (lda_type, lda_type, run_num))
+        top_word_matrix = get_top_word_matrix(word_distr)
+    use_topic_keys = lda_type == 'bilda' and not os.path.exists(
+        bilda_model_fname % run_num)
+    if use_topic_keys:
+        print 'No %s, expanding from the topic keys' % (bilda_model_fname %
+            run_num)
+    elif lda_type == 'bilda':
+        code_list, word_distr, top_word_matrix, language_ptr = (
+            load_bilda_model(run_num))
+        candidate_mask = get_bilda_candidate_mask(language_ptr, sh_mixed)
     
     if sh_mixed!='sympt_only':
         out = open('./data/train_test/test_%s_%s_expansion_%d.txt' %(lda_type,sh_mixed,run_num) , 'w')
     else:
         out = open('./data/train_test/test_%s_expansion_%d.txt' %(lda_type,run_num) , 'w')
-    f = open('./data/train_test/test_no_expansion_%d.txt' % run_num, 'r')
-    for query in f:
-        # Split by tab, fifth element, split by comma, take out trailing comma.
-        query = query.split('\t') 
-        symptom_list = query[4].split(':')[:-1]
-        if len(symptom_list)!=0:
+    for start in range(0, len(query_list), query_batch_size):
+        end = start + query_batch_size
+        if not use_topic_keys:
+            # Rescore the topics of a whole batch of queries at once.
+            query_matrix = get_query_matrix(symptom_lists[start:end],
+                code_list)
+            scaled_topic_matrix = get_scaled_topic_matrix(query_matrix,
+                top_word_matrix, word_distr)
+        if lda_type == 'bilda' and not use_topic_keys:
+            expansion_term_lists = get_bilda_expansion_term_lists(
+                query_matrix, scaled_topic_matrix, code_list, candidate_mask)
+        for i in range(start, min(end, len(query_list))):
+            query, symptom_list = query_list[i], symptom_lists[i]
             if lda_type =='lda':
-                scaled_topic = get_scaled_topic(symptom_list, word_distr, code_list)
-                expansion_terms = get_highest_prob_words(symptom_list, scaled_topic,
-                    code_list)
+                expansion_terms = get_highest_prob_words(symptom_list,
+                    scaled_topic_matrix[i - start], code_list)
+            elif use_topic_keys:
+                expansion_terms = get_highest_cooccuring_words(symptom_list,
+                    run_num, sh_mixed=sh_mixed)
             elif lda_type=='bilda':
-                expansion_terms = get_highest_cooccuring_words(symptom_list,run_num,sh_mixed=sh_mixed)
+                expansion_terms = expansion_term_lists[i - start]
             # Write expanded query to file
             expanded_query = query[:]
             expanded_query[4] += ':'.join(expansion_terms) + ':'
             
             out.write('\t'.join(expanded_query))
-    f.close()
     out.close()
 
 def main():
+    num_jobs = get_num_jobs()
     if len(sys.argv) != 3:
         print 'Usage: python %s lda/bilda sh_mixed' % sys.argv[0]
         exit()
@@ -179,8 +289,7 @@ def main():
     #     sh_mixed='sympt_only'
 
 
-    for run_num in range(10):
-        query_expansion(run_num,sh_mixed=sh_mixed)
+    run_folds(query_expansion, num_jobs, (sh_mixed,))
 
 if __name__ == '__main__':
     start_time = time.time()
@@ -0,0 +1,358 @@
+### Author: Edward Huang
+
+import numpy as np
+import os
+import time
+
+### Compact, integer-encoded store of the cleaned patient records. The cleaned
+### file is parsed once, in chunks, so memory stays bounded by the chunk size
+### and the vocabulary. Every disease, symptom and herb code is interned into
+### a single vocabulary, and each field is kept CSR style: the codes of record
+### i are field_codes[field_ptr[i]:field_ptr[i + 1]], in file order with
+### duplicates kept, so every record line can be rebuilt exactly. Names, dates
+### of birth and visit dates are kept the same way, as bytes. Arrays are saved
+### as .npy files and memory-mapped when loaded. Folds are a single vector
+### holding the test fold of every record, instead of copies of the records.
+### A fold's records can be selected from the store, or streamed from the
+### cleaned file (record_source = 'clean_file'). Consumers that count or index
+### codes take the records with their codes as int32 id arrays, one slice of a
+### single array per field, and only the writers of text files decode them.
+### Run time: Built by train_test_split.py, or directly with
+###     python record_store.py
+
+clean_fname = './data/clean_HIS_tuple_word.txt'
+store_dir = './data/record_store/'
+field_list = ['disease', 'symptom', 'herb']
+string_field_list = ['name', 'dob', 'visit_date']
+# Where get_fold_records reads records from: 'store' or 'clean_file'.
+record_source = 'store'
+# Approximate number of bytes read, or array elements copied, at a time.
+chunk_size = 1 << 20
+
+def generate_directories():
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+
+def read_line_chunks(in_fname):
+    '''
+    Yields the lines of a file in lists of about chunk_size bytes.
+    '''
+    f = open(in_fname, 'r')
+    while True:
+        line_list = f.readlines(chunk_size)
+        if len(line_list) == 0:
+            break
+        yield line_list
+    f.close()
+
+def get_array_dtype_dct():
+    '''
+    Returns the name and type of every array in the store, except the
+    vocabulary and the fold ids.
+    '''
+    array_dtype_dct = {}
+    for field in field_list:
+        array_dtype_dct['%s_ptr' % field] = np.int32
+        array_dtype_dct['%s_codes' % field] = np.int32
+    for field in string_field_list:
+        array_dtype_dct['%s_ptr' % field] = np.int32
+        array_dtype_dct['%s_chars' % field] = np.uint8
+    return array_dtype_dct
+
+def convert_raw_file(raw_fname, npy_fname, dtype):
+    '''
+    Copies an array written with tofile into a .npy file, in chunks, and
+    deletes the raw file.
+    '''
+    num_values = os.path.getsize(raw_fname) / np.dtype(dtype).itemsize
+    out = np.lib.format.open_memmap(npy_fname, mode='w+', dtype=dtype,
+        shape=(num_values,))
+    if num_values > 0:
+        raw = np.memmap(raw_fname, dtype=dtype, mode='r')
+        for start in range(0, num_values, chunk_size):
+            out[start:start + chunk_size] = raw[start:start + chunk_size]
+        del raw
+    out.flush()
+    del out
+    os.remove(raw_fname)
+
+def build_record_store(in_fname=clean_fname):
+    '''
+    Parses the cleaned record file and writes the record store to store_dir.
+    Returns the number of records.
+    '''
+    generate_directories()
+    array_dtype_dct = get_array_dtype_dct()
+    out_dct = dict((array, open('%s%s.bin' % (store_dir, array), 'wb')) for
+        array in array_dtype_dct)
+    # Running end offset of each field's values.
+    offset_dct = dict((field, 0) for field in field_list + string_field_list)
+    for field in offset_dct:
+        np.zeros(1, dtype=np.int32).tofile(out_dct['%s_ptr' % field])
+    code_index, num_records = {}, 0
+
+    for line_list in read_line_chunks(in_fname):
+        value_dct = dict((array, []) for array in array_dtype_dct)
+        for line in line_list:
+            diseases, name, dob, visit_date, symptoms, herbs = line.split('\t')
+            # Always ends with a colon, so the last element of the split will
+            # be the empty string.
+            for field, codes in zip(field_list, (diseases, symptoms,
+                herbs.rstrip('\n'))):
+                record_code_list = codes.split(':')[:-1]
+                for code in record_code_list:
+                    if code not in code_index:
+                        code_index[code] = len(code_index)
+                    value_dct['%s_codes' % field] += [code_index[code]]
+                offset_dct[field] += len(record_code_list)
+                value_dct['%s_ptr' % field] += [offset_dct[field]]
+            for field, value in zip(string_field_list, (name, dob,
+                visit_date)):
+                value_dct['%s_chars' % field] += [value]
+                offset_dct[field] += len(value)
+                value_dct['%s_ptr' % field] += [offset_dct[field]]
+        num_records += len(line_list)
+
+        # Append the chunk to the raw array files.
+        for array, dtype in array_dtype_dct.iteritems():
+            if array.endswith('_chars'):
+                np.frombuffer(''.join(value_dct[array]), dtype=dtype).tofile(
+                    out_dct[array])
+            else:
+                np.array(value_dct[array], dtype=dtype).tofile(out_dct[array])
+
+    for array, dtype in array_dtype_dct.iteritems():
+        out_dct[array].close()
+        convert_raw_file('%s%s.bin' % (store_dir, array), '%s%s.npy' % (
+            store_dir, array), dtype)
+    code_list = sorted(code_index, key=code_index.get)
+    np.save('%scode_list.npy' % store_dir, np.array(code_list))
+    return num_records
+
+def load_record_store():
+    '''
+    Returns the record store as a dictionary. Arrays are read-only memory
+    maps, and 'code_list' is the vocabulary as a list of strings.
+    '''
+    store = {}
+    for array in get_array_dtype_dct():
+        store[array] = np.load('%s%s.npy' % (store_dir, array), mmap_mode='r')
+    store['code_list'] = np.load('%scode_list.npy' % store_dir).tolist()
+    return store
+
+def get_num_records(store):
+    return len(store['name_ptr']) - 1
+
+def get_code_ids(store, field, record_id):
+    '''
+    Returns the integer ids of a record's codes for field, in file order.
+    '''
+    ptr = store['%s_ptr' % field]
+    return store['%s_codes' % field][ptr[record_id]:ptr[record_id + 1]]
+
+def get_codes(store, field, record_id):
+    '''
+    Returns a record's codes for field, in file order.
+    '''
+    code_list = store['code_list']
+    return [code_list[i] for i in get_code_ids(store, field, record_id)]
+
+def get_record(store, record_id):
+    '''
+    Returns the fields of a record as they are split from a line of the
+    cleaned file.
+    (disease list, name, dob, visit date, symptom list, herb list) -> (
+        list(str), str, str, str, list(str), list(str))
+    '''
+    return get_records(store, [record_id])[0]
+
+def decode_record(code_record, code_list):
+    '''
+    Returns the fields of a record as returned by get_record, given the record
+    as returned by get_code_records.
+    '''
+    disease_ids, name, dob, visit_date, symptom_ids, herb_ids = code_record
+    return ([code_list[i] for i in disease_ids.tolist()], name, dob,
+        visit_date, [code_list[i] for i in symptom_ids.tolist()], [code_list[i]
+        for i in herb_ids.tolist()])
+
+def encode_record(record, code_index):
+    '''
+    Returns a record as returned by get_code_records, given its fields as
+    returned by get_record. Codes missing from code_index are added to it,
+    with the next free ids.
+    '''
+    disease_list, name, dob, visit_date, symptom_list, herb_list = record
+    disease_ids, symptom_ids, herb_ids = [np.array([code_index.setdefault(
+        code, len(code_index)) for code in code_list], dtype=np.int32) for
+        code_list in (disease_list, symptom_list, herb_list)]
+    return disease_ids, name, dob, visit_date, symptom_ids, herb_ids
+
+def get_records(store, record_ids):
+    '''
+    Returns the fields of several records, as returned by get_record.
+    '''
+    return [decode_record(code_record, store['code_list']) for code_record in
+        get_code_records(store, record_ids)]
+
+def get_code_records(store, record_ids):
+    '''
+    Returns the fields of several records, with their codes as ids in the
+    store's code list.
+    (disease ids, name, dob, visit date, symptom ids, herb ids) -> (
+        np.array(int32), str, str, str, np.array(int32), np.array(int32))
+    The id arrays of a field are consecutive slices of one array.
+    '''
+    record_ids = np.asarray(record_ids, dtype=int)
+    column_list = []
+    for field in field_list:
+        ptr, codes = store['%s_ptr' % field], store['%s_codes' % field]
+        starts, ends = ptr[record_ids], ptr[record_ids + 1]
+        record_ptr = np.concatenate(([0], np.cumsum(ends - starts)))
+        # Position in the store of every code of the records.
+        positions = np.arange(record_ptr[-1]) - np.repeat(record_ptr[:-1] -
+            starts, ends - starts)
+        column_list += [np.split(np.asarray(codes[positions]), record_ptr[1:
+            -1])]
+    for field in string_field_list:
+        ptr, chars = store['%s_ptr' % field], store['%s_chars' % field]
+        start_list, end_list = ptr[record_ids].tolist(), ptr[record_ids + 1
+            ].tolist()
+        column_list += [[chars[start:end].tostring() for start, end in zip(
+            start_list, end_list)]]
+    disease_lists, symptom_lists, herb_lists, names, dobs, visit_dates = (
+        column_list)
+    return zip(disease_lists, names, dobs, visit_dates, symptom_lists,
+        herb_lists)
+
+def get_record_line(record):
+    '''
+    Rebuilds the line of the cleaned file for a record, with its newline.
+    '''
+    disease_list, name, dob, visit_date, symptom_list, herb_list = record
+    return '%s:\t%s\t%s\t%s\t%s:\t%s:\n' % (':'.join(disease_list), name, dob,
+        visit_date, ':'.join(symptom_list), ':'.join(herb_list))
+
+def save_fold_id_chunks(fold_id_chunks):
+    '''
+    Saves the vector holding the test fold of every record, from an iterable
+    of consecutive pieces of it.
+    '''
+    generate_directories()
+    raw_fname = '%sfold_ids.bin' % store_dir
+    out = open(raw_fname, 'wb')
+    for fold_ids in fold_id_chunks:
+        np.asarray(fold_ids, dtype=np.int8).tofile(out)
+    out.close()
+    convert_raw_file(raw_fname, '%sfold_ids.npy' % store_dir, np.int8)
+
+def save_fold_ids(fold_ids):
+    save_fold_id_chunks([fold_ids])
+
+def load_fold_ids():
+    return np.load('%sfold_ids.npy' % store_dir, mmap_mode='r')
+
+def get_fold_record_ids(run_num):
+    '''
+    Returns (train record ids, test record ids) of a fold, both in file order.
+    '''
+    fold_ids = load_fold_ids()
+    return np.nonzero(fold_ids != run_num)[0], np.nonzero(fold_ids == run_num
+        )[0]
+
+def split_record_line(line):
+    '''
+    Returns the fields of a line of a record file, as returned by get_record.
+    '''
+    diseases, name, dob, visit_date, symptoms, herbs = line.split('\t')
+    # Always ends with a colon, so the last element of the split will be the
+    # empty string.
+    return (diseases.split(':')[:-1], name, dob, visit_date, symptoms.split(
+        ':')[:-1], herbs.split(':')[:-1])
+
+def read_record_file(in_fname):
+    '''
+    Returns the records of every line of a file in the cleaned format.
+    '''
+    record_list = []
+    for line_list in read_line_chunks(in_fname):
+        record_list += [split_record_line(line) for line in line_list]
+    return record_list
+
+def read_clean_file_lines(run_num, split, in_fname=clean_fname):
+    '''
+    Streams the cleaned file, and yields the lines of a fold's training or
+    test set.
+    '''
+    fold_ids = load_fold_ids()
+    num_read = 0
+    for line_list in read_line_chunks(in_fname):
+        is_test_list = (fold_ids[num_read:num_read + len(line_list)] ==
+            run_num).tolist()
+        num_read += len(line_list)
+        for line, is_test in zip(line_list, is_test_list):
+            if is_test == (split == 'test'):
+                yield line
+
+def read_clean_file_records(run_num, split, in_fname=clean_fname):
+    '''
+    Streams the cleaned file, and returns the records of a fold's training or
+    test set, as returned by get_record. The store's arrays are not needed.
+    '''
+    return [split_record_line(line) for line in read_clean_file_lines(run_num,
+        split, in_fname)]
+
+def get_fold_records(run_num, split):
+    '''
+    Returns the records of a fold's training or test set, as returned by
+    get_record, in file order.
+    '''
+    assert split in ['train', 'test']
+    if record_source == 'clean_file':
+        return read_clean_file_records(run_num, split)
+    store = load_record_store()
+    train_ids, test_ids = get_fold_record_ids(run_num)
+    if split == 'train':
+        return get_records(store, train_ids)
+    return get_records(store, test_ids)
+
+def get_fold_code_records(run_num, split, code_list=None):
+    '''
+    Returns (record list, code list) of a fold's training or test set, in file
+    order. Records are as returned by get_code_records, and code list is the
+    store's vocabulary, or code_list if given, which must start with the
+    store's vocabulary. Codes of the cleaned file that are missing from it are
+    appended to the end of the returned code list. Only the vocabulary is read
+    from the store when streaming the cleaned file.
+    '''
+    assert split in ['train', 'test']
+    if record_source == 'clean_file':
+        if code_list is None:
+            code_list = np.load('%scode_list.npy' % store_dir).tolist()
+        code_index = dict((code, i) for i, code in enumerate(code_list))
+        record_list = [encode_record(split_record_line(line), code_index) for
+            line in read_clean_file_lines(run_num, split)]
+        return record_list, sorted(code_index, key=code_index.get)
+    store = load_record_store()
+    if code_list is None:
+        code_list = store['code_list']
+    train_ids, test_ids = get_fold_record_ids(run_num)
+    if split == 'train':
+        return get_code_records(store, train_ids), code_list
+    return get_code_records(store, test_ids), code_list
+
+def get_fold_lines(run_num, split):
+    '''
+    Returns the lines of a fold's training or test set, with their newlines.
+    '''
+    return [get_record_line(record) for record in get_fold_records(run_num,
+        split)]
+
+def main():
+    num_records = build_record_store()
+    print 'Stored %d records in %s' % (num_records, store_dir)
+
+if __name__ == '__main__':
+    start_time = time.time()
+    main()
+    print "---%f seconds---" % (time.time() - start_time)
@@ -1,12 +1,20 @@
 ### Author: Edward Huang
 
+from record_store import read_line_chunks
+
 ### This script rewrites the input file, removing any patient records that have
-### blank symptom or herb lists.
+### blank symptom or herb lists. The file is streamed in chunks through a filter
+### stage and a dosage-stripping stage, and each chunk is written at once, so
+### memory does not grow with the size of the input.
 
-def rewrite_input_file():
-    out = open('./data/clean_HIS_tuple_word.txt', 'w')
-    f = open('./data/HIS_tuple_word.txt', 'r')
-    for line in f:
+def filter_records(line_list):
+    '''
+    Filter stage. Splits a chunk of lines and drops the records with a null
+    name, dob or visit date, or a blank disease, symptom or herb list.
+    Returns a list of (diseases, name, dob, visit date, symptoms, herb list).
+    '''
+    record_list = []
+    for line in line_list:
         diseases, name, dob, visit_date, symptoms, herbs = line.split('\t')
         if name == 'null' or dob == 'null' or visit_date == 'null':
             continue
@@ -17,20 +25,34 @@ def rewrite_input_file():
         if len(disease_list) == 0 or len(symptom_list) == 0 or len(herb_list
             ) == 0:
             continue
+        record_list += [(diseases, name, dob, visit_date, symptoms, herb_list)]
+    return record_list
 
+def strip_dosages(record_list):
+    '''
+    Dosage-stripping stage. Returns the records without the herb codes that
+    are dosages.
+    '''
+    stripped_record_list = []
+    for diseases, name, dob, visit_date, symptoms, herb_list in record_list:
         # We want to take out dosages. Dosages are in grams, so they have a 'G'.
-        filtered_herb_list = []
-        for herb in herb_list:
-            if 'G' in herb:
-                continue
-            filtered_herb_list += [herb]
-        out.write('%s\t%s\t%s\t%s\t%s\t%s:\n' % (diseases, name, dob,
-            visit_date, symptoms, ':'.join(filtered_herb_list)))
-    f.close()
+        filtered_herb_list = [herb for herb in herb_list if 'G' not in herb]
+        stripped_record_list += [(diseases, name, dob, visit_date, symptoms,
+            filtered_herb_list)]
+    return stripped_record_list
+
+def rewrite_input_file():
+    out = open('./data/clean_HIS_tuple_word.txt', 'w')
+    for line_list in read_line_chunks('./data/HIS_tuple_word.txt'):
+        record_list = strip_dosages(filter_records(line_list))
+        out.write(''.join('%s\t%s\t%s\t%s\t%s\t%s:\n' % (diseases, name, dob,
+            visit_date, symptoms, ':'.join(filtered_herb_list)) for (diseases,
+            name, dob, visit_date, symptoms, filtered_herb_list) in
+            record_list))
     out.close()
 
 def main():
     rewrite_input_file()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
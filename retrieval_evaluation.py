@@ -1,70 +1,94 @@
 ### Author: Edward Huang
 
 from collections import OrderedDict
+from fold_scheduler import get_num_jobs, run_folds
 import math
-import operator
-from rank_metrics import ndcg_at_k, precision_at_k
+import numpy as np
+from rank_metrics import dcg_at_k, precision_at_k
+from record_store import (encode_record, get_fold_code_records,
+    split_record_line)
+from scipy.sparse import csr_matrix
 import sys
 import time
 
 # This script takes as input a biLDA or baseline, and evaluates based on the
 # the queries of the test data. 10 fold CV.
-# Run time: 9 minutes.
+# Run time: 9 minutes with the per-pair okapi_bm25 loop. Scores are now
+# computed by walking the postings lists of the query terms, or with one sparse
+# matrix product per query batch.
 
 avg_doc_len = 0.0
 k_1 = 1.6
 b = 0.75
 k_list = [10, 20, 30]
+# Number of queries scored by a single sparse matrix product.
+query_batch_size = 1000
+# 'postings' walks the postings lists of each query's terms. 'matrix' scores
+# every query-document pair with batched sparse matrix products.
+scoring_mode = 'postings'
+# 'partial' selects the top max(k_list) documents of each query without sorting
+# the corpus. 'full' sorts every score, and is kept to check 'partial' against.
+ranking_mode = 'partial'
 
-def read_input_file(fname):
+def get_record_dct(record_list):
     '''
     Returns a dictionary of a set of patient records, either training or test.
+    Each record is (disease ids, name, dob, visit date, symptom ids, herb
+    ids), as returned by record_store.get_fold_code_records.
     Key: (name, dob, visit_date) -> (str, str, str)
-    Value: (disease list, symptom list, herb list) -> (list(str), list(str),
-            list(str))
+    Value: (disease ids, symptom ids, herb ids) -> (np.array(int),
+            np.array(int), np.array(int))
     '''
     record_dct = OrderedDict({})
-    f = open(fname, 'r')
-    for i, line in enumerate(f):
-        diseases, name, dob, visit_date, symptoms, herbs = line.split('\t')
-        
-        disease_list = diseases.split(':')[:-1]
-        symptom_list = list(set(symptoms.split(':')[:-1]))
-        herb_list = list(set(herbs.split(':')[:-1]))
+    for disease_list, name, dob, visit_date, symptom_list, herb_list in (
+        record_list):
+        symptom_list = np.unique(symptom_list)
+        herb_list = np.unique(herb_list)
         key = (name, dob, visit_date)
         while key in record_dct:
             key = (name, dob, visit_date + '1')
         record_dct[key] = (disease_list, symptom_list, herb_list)
-    f.close()
     return record_dct
 
+def read_input_file(fname, code_list):
+    '''
+    Returns the dictionary of the patient records in a file, as built by
+    get_record_dct. Codes are encoded as their index in code_list. Codes
+    missing from it get ids past its end, so they match no document.
+    '''
+    code_index = dict((code, i) for i, code in enumerate(code_list))
+    record_list = []
+    f = open(fname, 'r')
+    for line in f:
+        record_list += [encode_record(split_record_line(line), code_index)]
+    f.close()
+    return get_record_dct(record_list)
+
 def get_inverted_index(corpus_dct, method_type):
     '''
     Given the corpus dictionary, build the inverted dictionary.
-    Key: herb or symptom -> str
+    Key: herb or symptom id -> int
     Value: number of patient visits in which the key occurs -> int
     '''
     global avg_doc_len
-    inverted_index = {}
+    # Reset, so that a fold does not depend on the folds evaluated before it.
+    avg_doc_len = 0.0
+    code_id_list = []
     for key in corpus_dct:
         disease_list, symptom_list, herb_list = corpus_dct[key]
 
         # Mixed and synonym expansions all have herbs.
         avg_doc_len += len(symptom_list)
         if 'mixed' in method_type or 'synonym' in method_type:
-            avg_doc_len += len(symptom_list+ herb_list)
-
-        # Update the entry for each symptom and each herb.
-        for symptom in symptom_list:
-            if symptom not in inverted_index:
-                inverted_index[symptom] = 0
-            inverted_index[symptom] += 1
-        for herb in herb_list:
-            if herb not in inverted_index:
-                inverted_index[herb] = 0
-            inverted_index[herb] += 1
+            avg_doc_len += len(symptom_list) + len(herb_list)
+
+        # Count each symptom and each herb.
+        code_id_list += [symptom_list, herb_list]
     avg_doc_len /= float(len(corpus_dct))
-    return inverted_index
+    code_counts = np.bincount(np.concatenate([np.zeros(0, dtype=int)] +
+        code_id_list))
+    code_ids = np.nonzero(code_counts)[0]
+    return dict(zip(code_ids.tolist(), code_counts[code_ids].tolist()))
 
 def okapi_bm25(query_list, document, inverted_index, num_docs):
     '''
@@ -98,50 +122,364 @@ def get_rel_score(query_disease_list, doc_disease_list):
         return 1
     return 0
 
-def evaluate_retrieval(query_dct, corpus_dct, inverted_index, method_type):
+def get_document(d_symptom_list, d_herb_list, method_type):
     '''
-    Given a query dictionary and a corpus dictionary, go through each query and
-    determine the NDCG for its retrieval with the disease labels as relevance
-    measures.
+    Returns the array of code ids that make up a training document.
     '''
-    metric_dct = {}
+    # With no query expansion, our document is just the set of symptoms.
+    if 'mixed' in method_type or 'synonym' in method_type:
+        return np.concatenate((d_symptom_list, d_herb_list))
+    return d_symptom_list
 
-    for query_key in query_dct:
-        doc_score_dct = {}
+def get_code_index(inverted_index, code_list):
+    '''
+    Maps each herb or symptom id in the inverted index to a column index.
+    Columns follow the order of the codes' names, so that a query's terms,
+    and its score sums, have the same order for any code numbering.
+    Key: herb or symptom id -> int
+    Value: column index -> int
+    '''
+    return dict((code_id, i) for i, code_id in enumerate(sorted(
+        inverted_index, key=lambda code_id: code_list[code_id])))
+
+def get_idf_vector(inverted_index, code_index, num_docs):
+    '''
+    Returns the BM25 IDF of every code, ordered by column index.
+    '''
+    idf_vector = np.zeros(len(code_index))
+    for code, i in code_index.iteritems():
+        n_docs_term = inverted_index[code]
+        # Same expression as okapi_bm25, so the weights are bitwise equal.
+        idf_vector[i] = math.log((num_docs - n_docs_term + 0.5) / (
+            n_docs_term + 0.5), math.e)
+    return idf_vector
+
+def get_doc_term_matrix(corpus_dct, code_index, method_type):
+    '''
+    Builds the corpus as a CSR document-term matrix. Rows follow the order of
+    corpus_dct. Since term frequency is always 1, each nonzero entry holds the
+    BM25 TF weight of its document.
+    '''
+    indptr, indices, data = [0], [], []
+    for doc_key in corpus_dct:
+        d_disease_list, d_symptom_list, d_herb_list = corpus_dct[doc_key]
+        document = get_document(d_symptom_list, d_herb_list, method_type)
 
+        tf = (k_1 + 1) / (1 + k_1 * (1 - b + b * len(document) / avg_doc_len))
+        term_list = set(document.tolist())
+        indices += [code_index[term] for term in term_list]
+        data += [tf] * len(term_list)
+        indptr += [len(indices)]
+    return csr_matrix((data, indices, indptr), shape=(len(corpus_dct),
+        len(code_index)))
+
+def get_query_term_ids(q_symptom_list, code_index):
+    '''
+    Returns the sorted column indices of the distinct query terms. Query terms
+    that never occur in the corpus cannot be shared with a document, so they
+    are dropped.
+    '''
+    return sorted(code_index[term] for term in set(q_symptom_list) if term in
+        code_index)
+
+def get_postings_index(doc_term_matrix, code_index):
+    '''
+    Given the document-term matrix, build the postings lists of the corpus.
+    Key: herb or symptom id -> int
+    Value: sorted ids of the documents containing the key -> np.array(int)
+    '''
+    doc_term_matrix = doc_term_matrix.tocsc()
+    indptr, indices = doc_term_matrix.indptr, doc_term_matrix.indices
+    postings_index = {}
+    for code, i in code_index.iteritems():
+        # Slices are views, so all postings lists share one array.
+        postings_index[code] = indices[indptr[i]:indptr[i + 1]]
+    return postings_index
+
+def get_tf_vector(doc_term_matrix):
+    '''
+    Returns the BM25 TF weight of every document, ordered by document id.
+    '''
+    return np.asarray(doc_term_matrix.max(axis=1).todense()).ravel()
+
+def get_query_matrix(query_dct, code_index, idf_vector):
+    '''
+    Encodes the queries as a CSR query-term matrix weighted by IDF.
+    '''
+    indptr, indices = [0], []
+    for query_key in query_dct:
         q_disease_list, q_symptom_list, q_herb_list = query_dct[query_key]
+        indices += get_query_term_ids(q_symptom_list, code_index)
+        indptr += [len(indices)]
+    indices = np.array(indices, dtype=np.int32)
+    return csr_matrix((idf_vector[indices], indices, indptr), shape=(len(
+        query_dct), len(code_index)))
+
+def get_disease_matrix(record_dct, disease_index):
+    '''
+    Returns a binary CSR record-disease matrix. Diseases missing from
+    disease_index never occur in the corpus, so they are dropped.
+    '''
+    indptr, indices = [0], []
+    for key in record_dct:
+        disease_list = record_dct[key][0]
+        indices += [disease_index[disease] for disease in set(disease_list) if
+            disease in disease_index]
+        indptr += [len(indices)]
+    return csr_matrix((np.ones(len(indices)), indices, indptr), shape=(len(
+        record_dct), len(disease_index)))
+
+def get_relevance_batches(query_dct, corpus_dct):
+    '''
+    Vectorized get_rel_score. Yields (first query index, sparse query x
+    document matrix of relevance judgements) for each batch of queries. Only
+    the relevant documents are stored, with sorted ids in each row.
+    '''
+    disease_index = {}
+    for key in corpus_dct:
+        for disease in corpus_dct[key][0]:
+            if disease not in disease_index:
+                disease_index[disease] = len(disease_index)
+    query_disease_matrix = get_disease_matrix(query_dct, disease_index)
+    corpus_disease_matrix_t = get_disease_matrix(corpus_dct, disease_index
+        ).T.tocsc()
+    num_query_diseases = np.array([float(len(query_dct[key][0])) for key in
+        query_dct])
+    for start in range(0, len(query_dct), query_batch_size):
+        # Size of the disease intersection for every query-document pair.
+        relevance_batch = query_disease_matrix[start:start + query_batch_size
+            ] * corpus_disease_matrix_t
+        relevance_batch.sort_indices()
+        if rank_metric == 'ndcg':
+            row_sizes = np.diff(relevance_batch.indptr)
+            relevance_batch.data /= np.repeat(num_query_diseases[start:start +
+                query_batch_size], row_sizes)
+        # Otherwise, binary relevance.
+        else:
+            relevance_batch.data[:] = 1
+        yield start, relevance_batch
 
-        for doc_key in corpus_dct:
-            d_disease_list, d_symptom_list, d_herb_list = corpus_dct[doc_key]
+def get_ranking_relevance(ranking, relevant_docs, relevant_list):
+    '''
+    Returns the relevance of each ranked document, given the sorted ids of
+    the relevant documents and their relevances.
+    '''
+    rel_list = np.zeros(len(ranking))
+    if len(relevant_docs) == 0:
+        return rel_list
+    positions = np.minimum(np.searchsorted(relevant_docs, ranking), len(
+        relevant_docs) - 1)
+    is_relevant = relevant_docs[positions] == ranking
+    rel_list[is_relevant] = relevant_list[positions[is_relevant]]
+    return rel_list
 
-            # With no query expansion, our document is just the set of symptoms.
-            document = d_symptom_list[:]
-            if 'mixed' in method_type or 'synonym' in method_type:
-                document += d_herb_list
+def get_score_matrix_batches(query_matrix, doc_term_matrix):
+    '''
+    Yields (first query index, dense query x document BM25 scores) for each
+    batch of queries. Each score is the sum of tf * idf over the shared terms,
+    the same products that okapi_bm25 adds up.
+    '''
+    doc_term_matrix_t = doc_term_matrix.T.tocsr()
+    for start in range(0, query_matrix.shape[0], query_batch_size):
+        query_batch = query_matrix[start:start + query_batch_size]
+        yield start, (query_batch * doc_term_matrix_t).toarray()
 
-            # If expanded, q_symptom list might also contain herbs.
-            doc_score = okapi_bm25(q_symptom_list, document, inverted_index,
-                len(corpus_dct))
-            # Compute the relevance judgement.
-            relevance = get_rel_score(q_disease_list, d_disease_list)
-            doc_score_dct[(doc_key, relevance)] = doc_score
+def score_query(query_term_ids, code_list, postings_index, tf_vector,
+    idf_vector):
+    '''
+    Term-at-a-time BM25. Walks only the postings lists of the query terms, and
+    sums each term's tf * idf over the documents they touch. Returns the ids
+    of the documents that share a term with the query, and their scores.
+    '''
+    postings_list, weight_list = [], []
+    for term_id in query_term_ids:
+        postings = postings_index[code_list[term_id]]
+        postings_list += [postings]
+        weight_list += [tf_vector[postings] * idf_vector[term_id]]
+    if len(postings_list) == 0:
+        return np.array([], dtype=int), np.array([])
+    matched_docs, doc_ids = np.unique(np.concatenate(postings_list),
+        return_inverse=True)
+    # Each document's weights are added in query term order, like okapi_bm25.
+    return matched_docs, np.bincount(doc_ids, np.concatenate(weight_list))
 
-        sorted_scores = sorted(doc_score_dct.items(),
-            key=operator.itemgetter(1), reverse=True)
-        # Get the relevance rankings.
-        rel_list = [pair[0][1] for pair in sorted_scores]
+def select_top_k(doc_ids, doc_scores, k):
+    '''
+    Returns the k highest scoring of the documents doc_ids, whose scores are
+    doc_scores, ordered by decreasing score. Ties are broken by document id,
+    i.e., training file order.
+    '''
+    k = min(k, len(doc_ids))
+    if k <= 0:
+        return doc_ids[:0]
+    # Score of the k-th best document, found without sorting.
+    threshold = -np.partition(-doc_scores, k - 1)[k - 1]
+    # Keep every document tied with the k-th one, so the tie-break does not
+    # depend on how np.partition happened to split them.
+    is_top = doc_scores >= threshold
+    top_docs = doc_ids[is_top]
+    order = np.lexsort((top_docs, -doc_scores[is_top]))
+    return top_docs[order[:k]]
 
-        # Compute different rank metrics for different values of k.
-        for k in k_list:
-            if k not in metric_dct:
-                metric_dct[k] = []
-            if rank_metric == 'ndcg':
-                metric_dct[k] += [ndcg_at_k(rel_list, k)]
-            elif rank_metric == 'precision':
-                metric_dct[k] += [precision_at_k(rel_list, k)]
+def get_top_k_docs(doc_scores, k, candidates=None):
+    '''
+    Returns the ids of the k highest scoring candidate documents, given the
+    score of every document. candidates defaults to the whole corpus.
+    '''
+    if candidates is None:
+        candidates = np.arange(len(doc_scores))
+    return select_top_k(candidates, doc_scores[candidates], k)
+
+def rank_docs(doc_scores, k):
+    '''
+    Returns the ids of the k highest scoring documents under the configured
+    ranking_mode. Both modes break ties by training file order.
+    '''
+    if ranking_mode == 'full':
+        # Stable sort, so ties keep the order of the training file.
+        return np.argsort(-doc_scores, kind='mergesort')[:k]
+    return get_top_k_docs(doc_scores, k)
+
+def get_unmatched_docs(matched_docs, num_docs, k):
+    '''
+    Returns the k lowest document ids missing from the sorted matched_docs.
+    '''
+    doc_ids = np.arange(min(num_docs, k + len(matched_docs)))
+    return np.setdiff1d(doc_ids, matched_docs, assume_unique=True)[:k]
+
+def retrieve_top_k(query_term_ids, code_list, postings_index, tf_vector,
+    idf_vector, k):
+    '''
+    Returns the ids of the k best documents for a query. Only the documents
+    that share a term with the query are scored.
+    '''
+    matched_docs, matched_scores = score_query(query_term_ids, code_list,
+        postings_index, tf_vector, idf_vector)
+    if ranking_mode == 'full':
+        doc_scores = np.zeros(len(tf_vector))
+        doc_scores[matched_docs] = matched_scores
+        return rank_docs(doc_scores, k)
+    is_positive = matched_scores > 0
+    top_docs = select_top_k(matched_docs[is_positive], matched_scores[
+        is_positive], k)
+    if len(top_docs) == k:
+        return top_docs
+    # The documents sharing no term with the query score 0, and come next in
+    # training file order, along with any matches scoring exactly 0. Common
+    # terms have a negative IDF, so negative matches come last.
+    num_missing = k - len(top_docs)
+    zero_docs = np.union1d(matched_docs[matched_scores == 0],
+        get_unmatched_docs(matched_docs, len(tf_vector), num_missing))[
+        :num_missing]
+    is_negative = matched_scores < 0
+    negative_docs = select_top_k(matched_docs[is_negative], matched_scores[
+        is_negative], num_missing - len(zero_docs))
+    return np.concatenate((top_docs, zero_docs, negative_docs)).astype(int)
+
+def get_rank_metric(rel_list, relevant_list, num_relevant, k):
+    '''
+    Computes the rank metric at k, given the relevance of the top ranked
+    documents, the nonzero relevances of the corpus documents, and the number
+    of relevant documents in the corpus.
+    '''
+    if rank_metric == 'ndcg':
+        # The ideal ranking only needs the k most relevant documents, which
+        # gives the same value as ndcg_at_k on the full ranking.
+        ideal_list = -np.sort(-relevant_list)[:k]
+        dcg_max = dcg_at_k(ideal_list, k)
+        if not dcg_max:
+            return 0.
+        return dcg_at_k(rel_list, k) / dcg_max
+    elif rank_metric == 'precision':
+        return precision_at_k(rel_list, k)
+    elif rank_metric == 'recall':
+        if num_relevant == 0:
+            return 0.
+        return np.count_nonzero(rel_list[:k]) / float(num_relevant)
+
+def get_ranking_batches(query_dct, corpus_dct, inverted_index, method_type,
+    code_list):
+    '''
+    Yields (first query index, list of top max(k_list) document ids per query)
+    for each batch of queries, using the configured scoring_mode.
+    '''
+    max_k = max(k_list)
+    code_index = get_code_index(inverted_index, code_list)
+    idf_vector = get_idf_vector(inverted_index, code_index, len(corpus_dct))
+    doc_term_matrix = get_doc_term_matrix(corpus_dct, code_index, method_type)
+
+    if scoring_mode == 'matrix':
+        query_matrix = get_query_matrix(query_dct, code_index, idf_vector)
+        for start, score_matrix in get_score_matrix_batches(query_matrix,
+            doc_term_matrix):
+            yield start, [rank_docs(doc_scores, max_k) for doc_scores in
+                score_matrix]
+    elif scoring_mode == 'postings':
+        column_code_ids = sorted(code_index, key=code_index.get)
+        postings_index = get_postings_index(doc_term_matrix, code_index)
+        tf_vector = get_tf_vector(doc_term_matrix)
+        ranking_list = []
+        for query_key in query_dct:
+            q_symptom_list = query_dct[query_key][1]
+            query_term_ids = get_query_term_ids(q_symptom_list, code_index)
+            ranking_list += [retrieve_top_k(query_term_ids, column_code_ids,
+                postings_index, tf_vector, idf_vector, max_k)]
+        yield 0, ranking_list
+
+def evaluate_retrieval(query_dct, corpus_dct, inverted_index, method_type,
+    code_list):
+    '''
+    Given a query dictionary and a corpus dictionary, go through each query and
+    determine the NDCG for its retrieval with the disease labels as relevance
+    measures. code_list names the code ids of the records.
+    '''
+    metric_dct = {}
+
+    ranking_list = []
+    for start, ranking_batch in get_ranking_batches(query_dct, corpus_dct,
+        inverted_index, method_type, code_list):
+        ranking_list += ranking_batch
+    for start, relevance_batch in get_relevance_batches(query_dct,
+        corpus_dct):
+        # Recall needs every relevant document, not just the top ranked ones.
+        num_relevant_list = relevance_batch.getnnz(axis=1)
+        indptr = relevance_batch.indptr
+        for i in range(relevance_batch.shape[0]):
+            relevant_docs = relevance_batch.indices[indptr[i]:indptr[i + 1]]
+            relevant_list = relevance_batch.data[indptr[i]:indptr[i + 1]]
+            # Get the relevance rankings.
+            rel_list = get_ranking_relevance(ranking_list[start + i],
+                relevant_docs, relevant_list)
+
+            # Compute different rank metrics for different values of k.
+            for k in k_list:
+                if k not in metric_dct:
+                    metric_dct[k] = []
+                metric_dct[k] += [get_rank_metric(rel_list, relevant_list,
+                    num_relevant_list[i], k)]
     return metric_dct
 
+def evaluate_fold(run_num, method_type):
+    '''
+    Evaluates the retrievals of one fold. Returns its metric dictionary.
+    '''
+    # Training set is always the same, and is read from the record store.
+    record_list, code_list = get_fold_code_records(run_num, 'train')
+    corpus_dct = get_record_dct(record_list)
+    if method_type == 'no_expansion':
+        query_dct = get_record_dct(get_fold_code_records(run_num, 'test',
+            code_list)[0])
+    else:
+        test_fname = './data/train_test/test_%s_%d.txt' % (method_type,
+            run_num)
+        query_dct = read_input_file(test_fname, code_list)
+    inverted_index = get_inverted_index(corpus_dct, method_type)
+
+    return evaluate_retrieval(query_dct, corpus_dct, inverted_index,
+        method_type, code_list)
+
 def main():
+    num_jobs = get_num_jobs()
     if len(sys.argv) != 3:
         print ('Usage: python %s no/lda_symptoms/lda_herbs/lda_mixed/bilda_'
             'symptoms/bilda_herbs/bilda_mixed/embedding_symptoms/embedding_'
@@ -156,17 +494,8 @@ def main():
     assert rank_metric in ['ndcg', 'precision', 'recall']
 
     all_metric_dct = {}
-    # range(10) because we are performing 10-fold CV.
-    for run_num in range(10):
-        test_fname = './data/train_test/test_%s_%d.txt' % (method_type, run_num)
-        # Training set is always the same.
-        train_fname = './data/train_test/train_no_expansion_%d.txt' % run_num
-        query_dct = read_input_file(test_fname)
-        corpus_dct = read_input_file(train_fname)
-        inverted_index = get_inverted_index(corpus_dct, method_type)
-
-        metric_dct = evaluate_retrieval(query_dct, corpus_dct, inverted_index,
-            method_type)
+    # 10 folds because we are performing 10-fold CV.
+    for metric_dct in run_folds(evaluate_fold, num_jobs, (method_type,)):
         # Compile the metric scores across all runs.
         for k in k_list:
             metric_list = metric_dct[k]
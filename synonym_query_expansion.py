@@ -1,5 +1,6 @@
 ### Author: Edward Huang
 
+from record_store import get_fold_lines
 import time
 
 ### This script performs query expansion by synonyms according to the herb-
@@ -67,8 +68,7 @@ def query_expansion(run_num):
     herb_symptom_dct = get_medicine_dictionary_file(run_num)
 
     out = open('./data/train_test/test_synonym_expansion_%d.txt' % run_num, 'w')
-    f = open('./data/train_test/test_no_expansion_%d.txt' % run_num, 'r')
-    for query in f:
+    for query in get_fold_lines(run_num, 'test'):
         # Split by tab, fifth element, split by comma, take out trailing comma.
         query = query.split('\t')
         symptom_list = query[4].split(':')[:-1]
@@ -80,7 +80,6 @@ def query_expansion(run_num):
         expanded_query[4] += ':'.join(expansion_terms) + ':'
         
         out.write('\t'.join(expanded_query))
-    f.close()
     out.close()
 
 def main():
@@ -0,0 +1,75 @@
+### Author: Edward Huang
+
+import lda_query_expansion
+import numpy as np
+import unittest
+
+### Regression test of the batched LDA expansion term selection against the
+### per-query walk it replaced. Run with
+###     python -m unittest test_lda_query_expansion
+
+def get_highest_prob_words(symptom_list, scaled_topic, code_list,
+    symptom_count_dct):
+    '''
+    The per-query selection before batching, kept as the reference.
+    '''
+    expansion_terms = []
+
+    highest_prob_words = np.array(code_list)[np.argsort(scaled_topic)]
+    for candidate in highest_prob_words:
+        # Decide whether to add a candidate based on expansion_type.
+        candidate_is_symptom = candidate in symptom_count_dct
+        expansion_type = lda_query_expansion.expansion_type
+        if expansion_type == 'herbs' and candidate_is_symptom:
+            continue
+        elif expansion_type == 'symptoms' and not candidate_is_symptom:
+            continue
+        if candidate not in symptom_list:
+            expansion_terms += [candidate]
+        # We only add 10 expansion terms.
+        if len(expansion_terms) == 10:
+            break
+    return expansion_terms
+
+class TestHighestProbWordLists(unittest.TestCase):
+
+    def setUp(self):
+        self.n_top_words = lda_query_expansion.n_top_words
+        lda_query_expansion.n_top_words = 12
+        # Even codes are symptoms, odd codes are herbs.
+        self.code_list = ['code%d' % i for i in range(60)]
+        self.symptom_count_dct = dict((code, '1') for code in
+            self.code_list[::2])
+        # Probabilities rounded to a few levels, so many codes tie, both at
+        # the top word cutoff and at the expansion term cutoff.
+        random_state = np.random.RandomState(1)
+        word_distr = np.round(random_state.dirichlet(np.ones(60), 5), 2)
+        self.word_distr = word_distr / word_distr.sum(axis=1)[:, None]
+        self.symptom_lists = [['code0', 'code3', 'code8'], ['code1'], [],
+            ['code5', 'unknown_code'], ['code%d' % i for i in range(0, 60, 3)],
+            ['code2', 'code2', 'code4', 'code7', 'code9', 'code11']]
+
+    def tearDown(self):
+        lda_query_expansion.n_top_words = self.n_top_words
+
+    def test_matches_per_query_walk(self):
+        top_word_matrix = lda_query_expansion.get_top_word_matrix(
+            self.word_distr)
+        query_matrix = lda_query_expansion.get_query_matrix(
+            self.symptom_lists, self.code_list)
+        scaled_topic_matrix = lda_query_expansion.get_scaled_topic_matrix(
+            query_matrix, top_word_matrix, self.word_distr)
+        for expansion_type in ['herbs', 'symptoms', 'mixed']:
+            lda_query_expansion.expansion_type = expansion_type
+            candidate_mask = lda_query_expansion.get_candidate_mask(
+                self.code_list, self.symptom_count_dct)
+            expansion_term_lists = (
+                lda_query_expansion.get_highest_prob_word_lists(query_matrix,
+                scaled_topic_matrix, self.code_list, candidate_mask))
+            for i, symptom_list in enumerate(self.symptom_lists):
+                self.assertEqual(expansion_term_lists[i],
+                    get_highest_prob_words(symptom_list, scaled_topic_matrix[
+                    i], self.code_list, self.symptom_count_dct))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+### Author: Edward Huang
+
+import neighbour_index
+import numpy as np
+import unittest
+
+### Tests that codes with zero embeddings do not poison the neighbour search.
+### Run with
+###     python -m unittest test_neighbour_index
+
+class TestZeroEmbeddings(unittest.TestCase):
+
+    def setUp(self):
+        self.num_probes = neighbour_index.num_probes
+        random_state = np.random.RandomState(0)
+        # Non-negative, like med2vec's ReLU code embeddings, with zero rows.
+        self.embedding_matrix = np.maximum(random_state.randn(200, 6), 0)
+        self.embedding_matrix[::7] = 0
+        self.query_ids = np.arange(1, 200, 5)
+        self.excluded_id_lists = [[query_id] for query_id in self.query_ids]
+        self.candidate_ids = np.arange(200)
+
+    def tearDown(self):
+        neighbour_index.num_probes = self.num_probes
+
+    def test_zero_rows_stay_zero(self):
+        normalized = neighbour_index.normalize_rows(np.array([[0., 0.], [3.,
+            4.]]))
+        self.assertTrue(np.array_equal(normalized, [[0., 0.], [0.6, 0.8]]))
+
+    def test_backends_agree(self):
+        embedding_matrix = neighbour_index.normalize_rows(
+            self.embedding_matrix)
+        self.assertFalse(np.isnan(embedding_matrix).any())
+        exact_lists = neighbour_index.get_neighbour_lists(
+            neighbour_index.build_index(embedding_matrix, 'exact'),
+            self.query_ids, self.excluded_id_lists, self.candidate_ids, 10)
+        ivf_index = neighbour_index.build_index(embedding_matrix, 'ivf')
+        self.assertFalse(np.isnan(ivf_index['centroids']).any())
+        # Probing every cluster scores every candidate.
+        neighbour_index.num_probes = len(ivf_index['centroids'])
+        ivf_lists = neighbour_index.get_neighbour_lists(ivf_index,
+            self.query_ids, self.excluded_id_lists, self.candidate_ids, 10)
+        for exact_list, ivf_list in zip(exact_lists, ivf_lists):
+            self.assertEqual(ivf_list.tolist(), exact_list.tolist())
+
+if __name__ == '__main__':
+    unittest.main()
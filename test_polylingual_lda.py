@@ -0,0 +1,52 @@
+### Author: Edward Huang
+
+import numpy as np
+import parallel_lda
+from parallel_lda import read_token_arrays
+import polylingual_lda
+import unittest
+
+### Tests that the PLTM sampler works on batches of at most
+### parallel_lda.batch_size tokens, however many documents there are. Run with
+###     python -m unittest test_polylingual_lda
+
+class TestSampleSweepBatches(unittest.TestCase):
+
+    def setUp(self):
+        self.batch_size = parallel_lda.batch_size
+        parallel_lda.batch_size = 37
+        random_state = np.random.RandomState(0)
+        # More documents than a batch holds, in two languages.
+        self.vocab_size_list = [40, 25]
+        self.language_token_list = [read_token_arrays(sorted(set(
+            random_state.randint(0, vocab_size, random_state.randint(1, 9))))
+            for i in range(300)) for vocab_size in self.vocab_size_list]
+
+    def tearDown(self):
+        parallel_lda.batch_size = self.batch_size
+
+    def test_batches_are_bounded(self):
+        doc_ptr = polylingual_lda.get_corpus_arrays(self.language_token_list,
+            self.vocab_size_list)[0]
+        doc_ids = np.repeat(np.arange(len(doc_ptr) - 1), np.diff(doc_ptr))
+        position_token_lists = parallel_lda.get_position_token_lists(doc_ptr,
+            np.arange(len(doc_ptr) - 1))
+        for token_ids in position_token_lists:
+            self.assertTrue(len(token_ids) <= 37)
+            self.assertEqual(len(np.unique(doc_ids[token_ids])), len(
+                token_ids))
+        # Every token is sampled once per sweep.
+        self.assertTrue(np.array_equal(np.sort(np.concatenate(
+            position_token_lists)), np.arange(doc_ptr[-1])))
+
+    def test_counts_match_tokens(self):
+        model = polylingual_lda.fit_polylingual(self.language_token_list,
+            self.vocab_size_list, 5, 20)
+        for (doc_ptr, word_ids), vocab_size, topic_word_count in zip(
+            self.language_token_list, self.vocab_size_list, model[
+            'topic_word_count_list']):
+            self.assertTrue(np.array_equal(topic_word_count.sum(axis=0),
+                np.bincount(word_ids, minlength=vocab_size)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+### Author: Edward Huang
+
+import lda_query_expansion
+import numpy as np
+import query_expansion
+import unittest
+
+### Tests that BiLDA expansion adds the top scoring codes of the requested
+### languages. Run with
+###     python -m unittest test_query_expansion
+
+class TestBiLDAExpansionTerms(unittest.TestCase):
+
+    def setUp(self):
+        self.n_top_words = lda_query_expansion.n_top_words
+        lda_query_expansion.n_top_words = 6
+        # Herbs are language 0, and symptoms language 1.
+        self.code_list = ['herb%d' % i for i in range(30)] + ['symptom%d' % i
+            for i in range(20)]
+        self.language_ptr = np.array([0, 30, 50])
+        random_state = np.random.RandomState(1)
+        # Rounded, so that scores tie.
+        self.word_distr = np.hstack([np.round(random_state.dirichlet(np.ones(
+            30) * 0.3, 8), 2), np.round(random_state.dirichlet(np.ones(20) *
+            0.3, 8), 2)])
+        self.symptom_lists = [['symptom0', 'symptom3'], ['symptom7'],
+            ['symptom1', 'symptom2', 'symptom5', 'symptom9', 'unknown_code'],
+            ['herb4', 'symptom11']]
+
+    def tearDown(self):
+        lda_query_expansion.n_top_words = self.n_top_words
+
+    def get_expansion_term_lists(self, sh_mixed):
+        top_word_matrix = query_expansion.get_bilda_top_word_matrix(
+            self.word_distr, self.language_ptr)
+        query_matrix = lda_query_expansion.get_query_matrix(
+            self.symptom_lists, self.code_list)
+        scaled_topic_matrix = lda_query_expansion.get_scaled_topic_matrix(
+            query_matrix, top_word_matrix, self.word_distr)
+        candidate_mask = query_expansion.get_bilda_candidate_mask(
+            self.language_ptr, sh_mixed)
+        expansion_term_lists = query_expansion.get_bilda_expansion_term_lists(
+            query_matrix, scaled_topic_matrix, self.code_list, candidate_mask)
+        return scaled_topic_matrix, expansion_term_lists
+
+    def test_top_scoring_codes(self):
+        language_dct = {'herb': 'herb', 'sympt': 'symptom', 'mixed': ''}
+        for sh_mixed, prefix in language_dct.items():
+            scaled_topic_matrix, expansion_term_lists = (
+                self.get_expansion_term_lists(sh_mixed))
+            for symptom_list, scaled_topic, expansion_terms in zip(
+                self.symptom_lists, scaled_topic_matrix, expansion_term_lists):
+                # Candidates by decreasing score, then by code list order.
+                candidate_list = [i for i, code in enumerate(self.code_list) if
+                    code.startswith(prefix) and code not in symptom_list]
+                candidate_list.sort(key=lambda i: -scaled_topic[i])
+                self.assertEqual(expansion_terms, [self.code_list[i] for i in
+                    candidate_list[:lda_query_expansion.n_expansion_terms]])
+                self.assertEqual(scaled_topic[self.code_list.index(
+                    expansion_terms[0])], max(scaled_topic[i] for i in
+                    candidate_list))
+
+    def test_other_languages_add_nothing(self):
+        scaled_topic_matrix, expansion_term_lists = (
+            self.get_expansion_term_lists('sympt_only'))
+        self.assertEqual(expansion_term_lists, [[]] * len(self.symptom_lists))
+
+if __name__ == '__main__':
+    unittest.main()
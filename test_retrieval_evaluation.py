@@ -0,0 +1,231 @@
+### Author: Edward Huang
+
+import math
+import numpy as np
+from rank_metrics import ndcg_at_k, precision_at_k
+import retrieval_evaluation
+import unittest
+
+### Regression tests of the retrieval evaluation against the per-pair BM25
+### walk and full sort it replaced, on a small synthetic corpus. Run with
+###     python -m unittest test_retrieval_evaluation
+
+# Codes 0-19 are symptoms, 20-29 herbs and 30-35 diseases. Code 0 is in most
+# documents, so it has a negative IDF, and code 19 is in none.
+code_list = ['code%02d' % i for i in range(36)]
+
+def get_code_records(random_state, num_records, num_symptoms):
+    '''
+    Returns random records, as returned by record_store.get_code_records.
+    '''
+    record_list = []
+    for i in range(num_records):
+        disease_ids = random_state.choice(range(30, 36), random_state.randint(
+            1, 3), replace=False)
+        symptom_ids = random_state.randint(1, num_symptoms,
+            random_state.randint(0, 4))
+        if random_state.rand() < 0.7:
+            symptom_ids = np.append(symptom_ids, 0)
+        herb_ids = random_state.randint(20, 30, random_state.randint(0, 3))
+        record_list += [(disease_ids.astype(np.int32), 'name%d' % i, 'dob',
+            'date', symptom_ids.astype(np.int32), herb_ids.astype(np.int32))]
+    return record_list
+
+def get_reference_scores(q_symptom_list, corpus_dct, inverted_index,
+    method_type):
+    '''
+    The per-pair okapi_bm25 walk over the whole corpus. Query terms are added
+    up in column order, as the postings and matrix modes add them.
+    '''
+    code_index = retrieval_evaluation.get_code_index(inverted_index, code_list)
+    query_terms = sorted((term for term in set(q_symptom_list) if term in
+        code_index), key=code_index.get)
+    avg_doc_len = retrieval_evaluation.avg_doc_len
+    k_1, b = retrieval_evaluation.k_1, retrieval_evaluation.b
+    score_list = []
+    for doc_key in corpus_dct:
+        d_disease_list, d_symptom_list, d_herb_list = corpus_dct[doc_key]
+        document = retrieval_evaluation.get_document(d_symptom_list,
+            d_herb_list, method_type)
+        tf = (k_1 + 1) / (1 + k_1 * (1 - b + b * len(document) / avg_doc_len))
+        score = 0.0
+        for term in query_terms:
+            if term in document:
+                n_docs_term = inverted_index[term]
+                score += tf * math.log((len(corpus_dct) - n_docs_term + 0.5) /
+                    (n_docs_term + 0.5), math.e)
+        score_list += [score]
+    return score_list
+
+class TestRetrievalEvaluation(unittest.TestCase):
+
+    def setUp(self):
+        self.settings = (retrieval_evaluation.scoring_mode,
+            retrieval_evaluation.ranking_mode,
+            retrieval_evaluation.query_batch_size)
+        retrieval_evaluation.query_batch_size = 4
+        random_state = np.random.RandomState(0)
+        self.corpus_dct = retrieval_evaluation.get_record_dct(
+            get_code_records(random_state, 60, 19))
+        query_list = get_code_records(random_state, 15, 20)
+        # Queries sharing no term with the corpus, and only the common term.
+        query_list += [(np.array([30], dtype=np.int32), 'nothing', 'dob',
+            'date', np.array([19], dtype=np.int32), np.array([], dtype=
+            np.int32)), (np.array([31, 32], dtype=np.int32), 'common', 'dob',
+            'date', np.array([0], dtype=np.int32), np.array([], dtype=
+            np.int32))]
+        self.query_dct = retrieval_evaluation.get_record_dct(query_list)
+
+    def tearDown(self):
+        (retrieval_evaluation.scoring_mode, retrieval_evaluation.ranking_mode,
+            retrieval_evaluation.query_batch_size) = self.settings
+
+    def get_reference_ranking_list(self, inverted_index, method_type):
+        '''
+        Full rankings by decreasing score, with ties in training file order.
+        '''
+        ranking_list = []
+        for query_key in self.query_dct:
+            score_list = get_reference_scores(self.query_dct[query_key][1],
+                self.corpus_dct, inverted_index, method_type)
+            ranking_list += [sorted(range(len(score_list)), key=lambda i:
+                -score_list[i])]
+        return ranking_list
+
+    def test_top_k_rankings(self):
+        max_k = max(retrieval_evaluation.k_list)
+        for method_type in ['no_expansion', 'lda_mixed_expansion']:
+            inverted_index = retrieval_evaluation.get_inverted_index(
+                self.corpus_dct, method_type)
+            reference_list = self.get_reference_ranking_list(inverted_index,
+                method_type)
+            # Some queries tie at score 0 within the top max_k.
+            num_tied = sum(sorted(get_reference_scores(self.query_dct[key][1],
+                self.corpus_dct, inverted_index, method_type))[-max_k] == 0 for
+                key in self.query_dct)
+            self.assertTrue(num_tied > 0)
+            for scoring_mode in ['postings', 'matrix']:
+                for ranking_mode in ['partial', 'full']:
+                    retrieval_evaluation.scoring_mode = scoring_mode
+                    retrieval_evaluation.ranking_mode = ranking_mode
+                    ranking_list = []
+                    for start, ranking_batch in (
+                        retrieval_evaluation.get_ranking_batches(
+                        self.query_dct, self.corpus_dct, inverted_index,
+                        method_type, code_list)):
+                        ranking_list += ranking_batch
+                    self.assertEqual([ranking.tolist() for ranking in
+                        ranking_list], [reference[:max_k] for reference in
+                        reference_list])
+
+    def test_rank_metrics(self):
+        method_type = 'no_expansion'
+        inverted_index = retrieval_evaluation.get_inverted_index(
+            self.corpus_dct, method_type)
+        reference_list = self.get_reference_ranking_list(inverted_index,
+            method_type)
+        doc_disease_lists = [self.corpus_dct[key][0] for key in
+            self.corpus_dct]
+        for rank_metric in ['ndcg', 'precision', 'recall']:
+            retrieval_evaluation.rank_metric = rank_metric
+            # Relevance of every corpus document, in reference ranking order.
+            rel_lists = [[retrieval_evaluation.get_rel_score(self.query_dct[
+                key][0], doc_disease_lists[i]) for i in reference] for key,
+                reference in zip(self.query_dct, reference_list)]
+            for scoring_mode in ['postings', 'matrix']:
+                retrieval_evaluation.scoring_mode = scoring_mode
+                metric_dct = retrieval_evaluation.evaluate_retrieval(
+                    self.query_dct, self.corpus_dct, inverted_index,
+                    method_type, code_list)
+                for k in retrieval_evaluation.k_list:
+                    if rank_metric == 'ndcg':
+                        reference_metrics = [ndcg_at_k(rel_list, k) for
+                            rel_list in rel_lists]
+                    elif rank_metric == 'precision':
+                        reference_metrics = [precision_at_k(rel_list, k) for
+                            rel_list in rel_lists]
+                    else:
+                        reference_metrics = [np.count_nonzero(rel_list[:k]) /
+                            float(max(1, np.count_nonzero(rel_list))) for
+                            rel_list in rel_lists]
+                    self.assertEqual(len(metric_dct[k]), len(self.query_dct))
+                    for metric, reference_metric in zip(metric_dct[k],
+                        reference_metrics):
+                        self.assertAlmostEqual(metric, reference_metric,
+                            places=12)
+
+class TestPostingsScoring(unittest.TestCase):
+
+    def setUp(self):
+        self.query_batch_size = retrieval_evaluation.query_batch_size
+        retrieval_evaluation.query_batch_size = 4
+        random_state = np.random.RandomState(1)
+        self.corpus_dct = retrieval_evaluation.get_record_dct(
+            get_code_records(random_state, 60, 19))
+        self.query_dct = retrieval_evaluation.get_record_dct(
+            get_code_records(random_state, 15, 20))
+        self.other_corpus_dct = retrieval_evaluation.get_record_dct(
+            get_code_records(random_state, 40, 19))
+
+    def tearDown(self):
+        retrieval_evaluation.query_batch_size = self.query_batch_size
+
+    def test_avg_doc_len_per_fold(self):
+        # Mixed documents count their symptoms twice, as the original loop did.
+        for method_type, get_len in (('no_expansion', lambda s, h: len(s)), (
+            'lda_mixed_expansion', lambda s, h: 2 * len(s) + len(h))):
+            avg_doc_len = np.mean([get_len(self.corpus_dct[key][1],
+                self.corpus_dct[key][2]) for key in self.corpus_dct])
+            # The fold evaluated before does not carry over.
+            retrieval_evaluation.get_inverted_index(self.other_corpus_dct,
+                method_type)
+            retrieval_evaluation.get_inverted_index(self.corpus_dct,
+                method_type)
+            self.assertAlmostEqual(retrieval_evaluation.avg_doc_len,
+                avg_doc_len, places=12)
+
+    def test_postings_match_matrix(self):
+        for method_type in ['no_expansion', 'lda_mixed_expansion']:
+            inverted_index = retrieval_evaluation.get_inverted_index(
+                self.corpus_dct, method_type)
+            code_index = retrieval_evaluation.get_code_index(inverted_index,
+                code_list)
+            idf_vector = retrieval_evaluation.get_idf_vector(inverted_index,
+                code_index, len(self.corpus_dct))
+            doc_term_matrix = retrieval_evaluation.get_doc_term_matrix(
+                self.corpus_dct, code_index, method_type)
+            query_matrix = retrieval_evaluation.get_query_matrix(
+                self.query_dct, code_index, idf_vector)
+            score_matrix = np.vstack([score_batch for start, score_batch in
+                retrieval_evaluation.get_score_matrix_batches(query_matrix,
+                doc_term_matrix)])
+            column_code_ids = sorted(code_index, key=code_index.get)
+            postings_index = retrieval_evaluation.get_postings_index(
+                doc_term_matrix, code_index)
+            tf_vector = retrieval_evaluation.get_tf_vector(doc_term_matrix)
+            for query_key, matrix_scores in zip(self.query_dct, score_matrix):
+                q_symptom_list = self.query_dct[query_key][1]
+                matched_docs, matched_scores = retrieval_evaluation.score_query(
+                    retrieval_evaluation.get_query_term_ids(q_symptom_list,
+                    code_index), column_code_ids, postings_index, tf_vector,
+                    idf_vector)
+                # Same sums, in the same order, so the scores are equal.
+                doc_scores = np.zeros(len(self.corpus_dct))
+                doc_scores[matched_docs] = matched_scores
+                self.assertTrue(np.array_equal(doc_scores, matrix_scores))
+                okapi_scores = [retrieval_evaluation.okapi_bm25(
+                    q_symptom_list, retrieval_evaluation.get_document(
+                    d_symptom_list, d_herb_list, method_type), inverted_index,
+                    len(self.corpus_dct)) for (d_disease_list, d_symptom_list,
+                    d_herb_list) in self.corpus_dct.values()]
+                self.assertTrue(np.allclose(doc_scores, okapi_scores, rtol=0,
+                    atol=1e-12))
+                # Documents sharing no term with the query are not scored.
+                self.assertEqual(matched_docs.tolist(), [i for i, (
+                    d_disease_list, d_symptom_list, d_herb_list) in enumerate(
+                    self.corpus_dct.values()) if len(np.intersect1d(
+                    q_symptom_list, retrieval_evaluation.get_document(
+                    d_symptom_list, d_herb_list, method_type))) > 0])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,53 +1,124 @@
-from datetime import datetime
+from fold_scheduler import get_num_jobs, run_folds
+import numpy as np
 import os
-import glob
-def make_mallet_herb_symptom_files(fold_num):
-    disease_set = set([])
-    date_format = '%Y-%m-%d'
-    f = open('./data/train_test/train_no_expansion_%s.txt'%fold_num, 'r')
-    os.chdir('data/sequence/')
-    herb_corpus = open('herb%s.txt'%fold_num,'w')
-    symptom_corpus = open('symptom%s.txt'%fold_num,'w')
-    for i, line in enumerate(f):
-    #     if i>10:
-    #         break
-        diseases, name, dob, visit_date, symptoms, herbs = line.split('\t')
-        # Always ends with a colon, so the last element of the split will be
-        # the empty string.
-        disease_list = diseases.split(':')[:-1]
-        disease_set = disease_set.union(disease_list)
-
-        visit_date = visit_date.split('，')[1][:len('xxxx-xx-xx')]
-        # Format the diagnosis date.
-        visit_date = datetime.strptime(visit_date, date_format)
-
-        # Format symptom and herb lists and remove duplicates.
-        symptom_list = list(set(symptoms.split(':')[:-1]))
-        sdoc = diseases+'\t'+'SYMPT'+'\t'
-
-        for symptom in symptom_list:
-            sdoc+=symptom+" "
-        sdoc+="\n"
-    #     print sdoc
-        herb_list = list(set(herbs.split(':')[:-1]))
-        hdoc = diseases+'\t'+'HERB'+'\t'
-        for herb in herb_list:
-            hdoc+=herb+" "
-        hdoc+="\n"
-    #     print hdoc
-        herb_corpus.write(hdoc)
-        symptom_corpus.write(sdoc)
-    herb_corpus.close()
-    symptom_corpus.close()
-    # Convert formatted text file to MALLET sequence files
-    os.system("../../../mallet-2.0.8/bin/mallet import-file --input herb{0}.txt  --output herb{0}.sequences ".format(fold_num)+ "--keep-sequence --token-regex '\p{L}+'")
-    os.system("../../../mallet-2.0.8/bin/mallet import-file --input symptom{0}.txt  --output symptom{0}.sequences ".format(fold_num)+ "--keep-sequence --token-regex '\p{L}+'")
-    os.chdir("../../")
-for fold_num in range(10):
-    make_mallet_herb_symptom_files(fold_num)
-os.chdir("data/sequence/")
-for fold_num in range(10):
-    print "Working on %s "%fold_num
-    os.system("../../../mallet-2.0.8/bin/mallet run cc.mallet.topics.PolylingualTopicModel \
-    --output-topic-keys pltm_output_topics{0}.txt --num-top-words 200\
-    --language-inputs herb{0}.sequences  symptom{0}.sequences  --num-topics 96 --optimize-interval 10".format(fold_num))
+from parallel_lda import read_token_arrays
+from polylingual_lda import fit_polylingual
+from record_store import get_fold_code_records
+import time
+
+### This script runs PLTM on each training set, with the herbs and symptoms of
+### every visit as two languages, which reduces it to BiLDA. The sampler of
+### polylingual_lda.py replaces MALLET's PolylingualTopicModel, run before as
+###     mallet run cc.mallet.topics.PolylingualTopicModel --num-topics 96
+###     --optimize-interval 10 --num-top-words 200
+### and each fold's topic keys are written in the format of its
+### --output-topic-keys. The full topic-word distributions of both languages,
+### which query_expansion.py scores, are saved as one binary array over a
+### shared code list of the herbs followed by the symptoms. A restarted fold
+### resumes from its checkpoint, and folds with both files are skipped. A fold
+### with topic keys but no distributions, e.g., from MALLET, is trained again,
+### resuming from its checkpoint if there is one, and both files are written.
+
+n_topics = 96
+n_iter = 1000
+# Words per topic in the topic keys. Like MALLET, one fewer is written.
+num_top_words = 200
+# Herb is language 0 and symptom is language 1 in the topic keys.
+language_list = ['herb', 'symptom']
+out_dir = './data/sequence/'
+topic_word_fname = '%spltm_topic_word%d.npz'
+checkpoint_fname = './data/lda_checkpoints/pltm_%s.npz'
+
+def get_language_tokens(record_list, store_code_list):
+    '''
+    Returns (language_token_list, code_lists). For each language, the sorted
+    list of its codes, and the token arrays of the code ids of every visit,
+    with duplicates removed. Records are as returned by
+    record_store.get_fold_code_records, with store_code_list its vocabulary.
+    '''
+    # Fields of the record tuples.
+    field_dct = {'herb': 5, 'symptom': 4}
+    code_lists, language_token_list = [], []
+    for language in language_list:
+        field = field_dct[language]
+        # Codes are sorted by name, and numbered in that order.
+        store_ids = sorted(np.unique(np.concatenate([np.zeros(0, dtype=np.int32
+            )] + [record[field] for record in record_list])).tolist(),
+            key=lambda i: store_code_list[i])
+        column_map = np.zeros(len(store_code_list), dtype=np.int32)
+        column_map[store_ids] = np.arange(len(store_ids))
+        code_lists += [[store_code_list[i] for i in store_ids]]
+        language_token_list += [read_token_arrays(np.unique(column_map[record[
+            field]]).tolist() for record in record_list)]
+    return language_token_list, code_lists
+
+def write_topic_word(model, code_lists, fname):
+    '''
+    Saves the topic-word distributions of all languages side by side, as a
+    topic x code float32 array 'topic_word' over 'code_list', the codes of
+    every language in language order. The columns of language l are
+    language_ptr[l] to language_ptr[l + 1], and sum to 1 in each topic. Like
+    the topic keys, it is written under a temporary name and then renamed.
+    '''
+    code_list = [code for language_code_list in code_lists for code in
+        language_code_list]
+    language_ptr = np.concatenate(([0], np.cumsum([len(language_code_list)
+        for language_code_list in code_lists])))
+    # np.savez appends .npz to names without it.
+    temp_fname = '%s.tmp.npz' % fname[:-len('.npz')]
+    np.savez(temp_fname, topic_word=np.hstack(model['topic_word_list']).astype(
+        np.float32), code_list=np.array(code_list), language_ptr=language_ptr)
+    os.rename(temp_fname, fname)
+
+def write_topic_keys(model, code_lists, topic_fname):
+    '''
+    Writes the top words of every topic in each language, by decreasing count.
+    The file is written under a temporary name and then renamed, so that an
+    interrupted run leaves no partial topic keys.
+    '''
+    temp_fname = topic_fname + '.tmp'
+    out = open(temp_fname, 'w')
+    for topic, topic_alpha in enumerate(model['alpha']):
+        out.write('%d\t%.3f\n' % (topic, topic_alpha))
+        for language, code_list in enumerate(code_lists):
+            topic_word_count = model['topic_word_count_list'][language][topic]
+            # Ties are broken by code id.
+            word_ids = np.argsort(-topic_word_count, kind='mergesort')[
+                :num_top_words - 1]
+            word_ids = word_ids[topic_word_count[word_ids] > 0]
+            out.write(' %d\t%d\t%s\t%s\n' % (language, topic_word_count.sum(),
+                model['beta_list'][language], ''.join(code_list[i] + ' ' for i
+                in word_ids)))
+    out.close()
+    os.rename(temp_fname, topic_fname)
+
+def run_fold(fold_num):
+    topic_fname = '%spltm_output_topics%d.txt' % (out_dir, fold_num)
+    word_fname = topic_word_fname % (out_dir, fold_num)
+    if os.path.exists(topic_fname) and os.path.exists(word_fname):
+        print 'Skipping finished fold %d' % fold_num
+        return
+    if os.path.exists(topic_fname):
+        print 'Fold %d has no %s, training it again' % (fold_num, word_fname)
+    print 'Working on %d' % fold_num
+    record_list, store_code_list = get_fold_code_records(fold_num, 'train')
+    language_token_list, code_lists = get_language_tokens(record_list,
+        store_code_list)
+    model = fit_polylingual(language_token_list, [len(code_list) for code_list
+        in code_lists], n_topics, n_iter, checkpoint_fname=checkpoint_fname %
+        fold_num)
+    # Written before the topic keys, so that the topic keys of a fold always
+    # come from the same model as its distributions.
+    write_topic_word(model, code_lists, word_fname)
+    write_topic_keys(model, code_lists, topic_fname)
+
+def main():
+    num_jobs = get_num_jobs()
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    run_folds(run_fold, num_jobs)
+
+if __name__ == '__main__':
+    start_time = time.time()
+    main()
+    print "---%f seconds---" % (time.time() - start_time)
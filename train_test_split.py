@@ -1,44 +1,118 @@
-import numpy as np 
-import pandas as pd
+import numpy as np
 import random
+from record_store import (build_record_store, clean_fname, load_fold_ids,
+    read_line_chunks, save_fold_id_chunks, save_fold_ids)
+import zlib
 
-### This script partitions the patient records into 10 equal test sets and 
-### training sets. Writes out the files to ./data/train_test.
+### This script partitions the patient records into 10 equal test sets and
+### training sets. Builds the record store, and saves the test fold of every
+### record in it. With split_mode = 'files', also writes out the files to
+### ./data/train_test.
 
 np.random.seed(111)
+seed = 111
 out_folder = './data/train_test'
+# 'index' only saves the fold-id vector, and later stages select a fold's
+# records from the record store. 'files' also writes ten train and test files.
+split_mode = 'index'
+# How records are assigned to folds.
+# 'permutation' shuffles all record indices, and needs them all in memory.
+# 'hash' streams the records, and assigns each by a seeded hash of its (name,
+#     dob, visit date) key. Fold sizes are only approximately equal.
+# 'block' streams the records, and assigns each consecutive block of 10 records
+#     to the 10 folds in a seeded random order, so fold sizes differ by at most
+#     one.
+fold_assignment = 'permutation'
 
 def partition(lst, n):
     '''
     Partitions a list of values into 10 approximately equal parts.
     '''
-    division = len(lst) / float(n) 
+    division = len(lst) / float(n)
     return [lst[int(round(division * i)): int(round(division * (i + 1))
         )] for i in xrange(n)]
 
+def get_fold_ids(num_records):
+    '''
+    Returns the test fold of every record. The shuffled record indices are
+    partitioned into 10 test sets, and each training set is every record
+    outside its test set.
+    '''
+    fold_ids = np.zeros(num_records, dtype=np.int8)
+    index_list = np.random.permutation(num_records)
+    for run_num, test_idx in enumerate(partition(index_list, 10)):
+        fold_ids[test_idx] = run_num
+    return fold_ids
+
+def get_hash_fold_ids(line_list):
+    '''
+    Returns the folds of a chunk of lines by a seeded hash of each record key.
+    Visits with the same key always land in the same fold.
+    '''
+    fold_id_list = []
+    for line in line_list:
+        name, dob, visit_date = line.split('\t', 4)[1:4]
+        key = '%d\t%s\t%s\t%s' % (seed, name, dob, visit_date)
+        fold_id_list += [(zlib.crc32(key) & 0xffffffff) % 10]
+    return fold_id_list
+
+def get_block_fold_id_chunks(in_fname):
+    '''
+    Yields the folds of each chunk of lines. Every block of 10 records gets a
+    seeded random order of the 10 folds. Since the random draws do not depend
+    on the chunk boundaries, the folds only depend on the seed.
+    '''
+    random_state = np.random.RandomState(seed)
+    leftover_ids = np.array([], dtype=np.int8)
+    for line_list in read_line_chunks(in_fname):
+        num_blocks = -(-(len(line_list) - len(leftover_ids)) // 10)
+        block_ids = np.argsort(random_state.rand(num_blocks, 10), axis=1)
+        fold_ids = np.concatenate((leftover_ids, block_ids.ravel()))
+        leftover_ids = fold_ids[len(line_list):]
+        yield fold_ids[:len(line_list)]
+
+def get_fold_id_chunks(in_fname):
+    '''
+    Yields the folds of each chunk of lines, for the streaming assignments.
+    '''
+    if fold_assignment == 'hash':
+        for line_list in read_line_chunks(in_fname):
+            yield get_hash_fold_ids(line_list)
+    elif fold_assignment == 'block':
+        for fold_ids in get_block_fold_id_chunks(in_fname):
+            yield fold_ids
+
+def write_fold_files(fold_ids):
+    '''
+    Streams the cleaned file into a copy of each training and test set, in
+    file order.
+    '''
+    test_out_list = [open('%s/test_no_expansion_%d.txt' % (out_folder,
+        run_num), 'w') for run_num in range(10)]
+    train_out_list = [open('%s/train_no_expansion_%d.txt' % (out_folder,
+        run_num), 'w') for run_num in range(10)]
+    num_read = 0
+    for line_list in read_line_chunks(clean_fname):
+        chunk_fold_ids = fold_ids[num_read:num_read + len(line_list)]
+        num_read += len(line_list)
+        for run_num in range(10):
+            is_test_list = (chunk_fold_ids == run_num).tolist()
+            test_out_list[run_num].write(''.join(line for line, is_test in zip(
+                line_list, is_test_list) if is_test))
+            train_out_list[run_num].write(''.join(line for line, is_test in
+                zip(line_list, is_test_list) if not is_test))
+    assert num_read == len(fold_ids)
+    for out in test_out_list + train_out_list:
+        out.close()
+
 def main():
-    records = pd.read_csv('./data/clean_HIS_tuple_word.txt', delimiter='\t',
-        header=None)
-
-    numRecords = records.shape[0]
-    index_list = range(int(numRecords))
-    np.random.shuffle(index_list)
-    # Parition the list of indices into 10 test sets of indices.
-    partitioned_index_list = partition(index_list, 10)
-
-    for run_num in range(10):
-        testIdx = partitioned_index_list[run_num]
-        # Train indices are all indices not in the test indices.
-        trainIdx = [i for i in range(int(numRecords)) if i not in testIdx]
-        # Fetch the actual records by slicing.
-        test_tbl = records.iloc[testIdx]
-        train_tbl = records.iloc[trainIdx]
-        assert len(test_tbl) + len(train_tbl) == numRecords
-        # Write records out to file.
-        test_tbl.to_csv('%s/test_no_expansion_%d.txt' % (out_folder, run_num),
-            sep='\t', delimiter='\t', header=None, index=False)
-        train_tbl.to_csv('%s/train_no_expansion_%d.txt' % (out_folder, run_num),
-            sep='\t', delimiter='\t', header=None, index=False)
+    numRecords = build_record_store()
+    if fold_assignment == 'permutation':
+        save_fold_ids(get_fold_ids(numRecords))
+    else:
+        save_fold_id_chunks(get_fold_id_chunks(clean_fname))
+    if split_mode == 'files':
+        write_fold_files(load_fold_ids())
 
 if __name__ == '__main__':
     main()
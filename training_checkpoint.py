@@ -0,0 +1,72 @@
+### Author: Edward Huang
+
+import numpy as np
+import os
+
+### Checkpoints and the convergence monitor of the iterative topic model
+### trainers. A checkpoint is a .npz file of arrays, written to a temporary
+### file and renamed, so a run killed while saving keeps its last checkpoint.
+### The monitor records the log-likelihood every likelihood_interval
+### iterations. Setting convergence_tol stops training once its relative
+### improvement falls below it. It is off by default, so that trainers run all
+### n_iter iterations, as before.
+### They are used by the AD-LDA sampler of parallel_lda.py, the PLTM sampler of
+### polylingual_lda.py and online_lda.py. The default trainer of
+### monolingual_lda_baseline.py, the lda package, is neither checkpointed nor
+### stopped early.
+
+# Iterations between checkpoints.
+checkpoint_interval = 100
+# Iterations between log-likelihood measurements.
+likelihood_interval = 50
+# Relative log-likelihood improvement below which training stops, e.g., 1e-4.
+# None runs every iteration.
+convergence_tol = None
+
+def save_checkpoint(fname, checkpoint_dct):
+    '''
+    Saves a dictionary of arrays. The file is replaced atomically.
+    '''
+    out_dir = os.path.dirname(fname)
+    if out_dir != '' and not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    # np.savez appends .npz to names without it.
+    temp_fname = '%s.tmp.npz' % fname[:-len('.npz')]
+    np.savez(temp_fname, **checkpoint_dct)
+    os.rename(temp_fname, fname)
+
+def load_checkpoint(fname, config_dct):
+    '''
+    Returns the dictionary of arrays saved in fname, or None if there is no
+    checkpoint, or if it was saved by a run with a different configuration.
+    '''
+    if not os.path.exists(fname):
+        return None
+    data = np.load(fname)
+    checkpoint_dct = dict((key, data[key]) for key in data.files)
+    for key in config_dct:
+        if key not in checkpoint_dct or not np.array_equal(checkpoint_dct[key],
+            config_dct[key]):
+            print 'Ignoring checkpoint %s, saved with another %s' % (fname,
+                key)
+            return None
+    return checkpoint_dct
+
+def is_likelihood_iteration(iteration):
+    '''
+    Whether the log-likelihood is measured after iteration, counted from 0.
+    '''
+    return (iteration + 1) % likelihood_interval == 0
+
+def is_checkpoint_iteration(iteration):
+    return (iteration + 1) % checkpoint_interval == 0
+
+def has_converged(log_likelihood_list):
+    '''
+    Whether the last relative improvement of the log-likelihood is below
+    convergence_tol.
+    '''
+    if convergence_tol is None or len(log_likelihood_list) < 2:
+        return False
+    previous, current = log_likelihood_list[-2], log_likelihood_list[-1]
+    return (current - previous) / abs(previous) < convergence_tol